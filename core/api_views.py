@@ -1,13 +1,12 @@
 from rest_framework import viewsets
-from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from django.contrib.auth.models import User
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.conf import settings
-import stripe
+from django.db import IntegrityError
+import io
 import json
 import time
-import requests
 from core.models import Category, Brand, Product, Address, Cart, CartItem, Order, OrderItem, Payment, Coupon, Refund, Employee, UserProfile
 from core.serializers import (
     CategorySerializer, BrandSerializer, ProductSerializer, AddressSerializer,
@@ -16,12 +15,22 @@ from core.serializers import (
 )
 from rest_framework.decorators import action
 from rest_framework.response import Response
-
-# Configuración de la API de conversión de monedas
-EXCHANGE_API_URL = "https://api.exchangerate-api.com/v4/latest/CLP"  # Alternativa para pruebas
-# Para Banco Central de Chile: "https://api.sbif.cl/api-sbifv3/recursos_api/dolar"
-
-class CategoryViewSet(viewsets.ModelViewSet):
+from rest_framework.parsers import MultiPartParser
+from core.pagination import ProductPagination, clamp_page_size
+from core.conditional import ConditionalGetMixin
+from core.price_history import PERIODS as PRICE_PERIODS, price_buckets
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from datetime import timedelta
+from core import cart_service
+from core.webhooks import InvalidWebhook, receive
+from core.payments import PaymentUnavailable, get_gateway
+from core import exchange_rates
+from core.order_states import TRANSITIONS, TransitionError, allowed_actions, transition
+from core.importers import FORMATS as IMPORT_FORMATS, import_products
+from core.suggest import suggest_index, DEFAULT_LIMIT as DEFAULT_SUGGEST_LIMIT, MAX_LIMIT as MAX_SUGGEST_LIMIT
+
+class CategoryViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticated]
@@ -31,7 +40,7 @@ class CategoryViewSet(viewsets.ModelViewSet):
             return [IsAdminUser()]
         return [IsAuthenticated()]
 
-class BrandViewSet(viewsets.ModelViewSet):
+class BrandViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Brand.objects.all()
     serializer_class = BrandSerializer
     permission_classes = [IsAuthenticated]
@@ -41,16 +50,62 @@ class BrandViewSet(viewsets.ModelViewSet):
             return [IsAdminUser()]
         return [IsAuthenticated()]
 
-class ProductViewSet(viewsets.ModelViewSet):
-    queryset = Product.objects.all()
+class ProductViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
+    queryset = Product.objects.select_related('category', 'brand')
     serializer_class = ProductSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = ProductPagination  # Paginación por cursor: ?cursor=&page_size=&ordering=
+    conditional_related = ('category', 'brand')  # Se serializan anidadas
 
     def get_permissions(self):
-        if self.action in ['create', 'update', 'partial_update', 'destroy']:
+        if self.action in ['create', 'update', 'partial_update', 'destroy', 'bulk_import']:
             return [IsAdminUser()]
+        if self.action == 'suggest':
+            return [AllowAny()]
         return [IsAuthenticated()]
 
+    @action(detail=True, methods=['get'], url_path='price-history')
+    def price_history(self, request, pk=None):
+        # Historial agrupado: ?interval=day|week|month&start=AAAA-MM-DD&end=AAAA-MM-DD&mode=ohlc|last
+        product = self.get_object()
+        interval = request.query_params.get('interval', 'day')
+        mode = request.query_params.get('mode', 'ohlc')
+        if interval not in PRICE_PERIODS or mode not in ('ohlc', 'last'):
+            return Response({'error': 'Parámetros interval o mode inválidos'}, status=400)
+        try:
+            end = parse_date(request.query_params.get('end', '')) or timezone.localdate()
+            start = parse_date(request.query_params.get('start', '')) or end - timedelta(days=90)
+        except ValueError:
+            return Response({'error': 'Formato de fecha inválido, usar AAAA-MM-DD'}, status=400)
+        buckets = price_buckets(product, interval, start, end)
+        if mode == 'last':
+            buckets = [{'start': b['bucket_start'], 'price': b['close']} for b in buckets]
+        else:
+            buckets = [{'start': b.pop('bucket_start'), **b} for b in buckets]
+        return Response({'product': product.id, 'interval': interval, 'start': start, 'end': end, 'buckets': buckets})
+
+    @action(detail=False, methods=['get'])
+    def suggest(self, request):
+        # Autocompletado desde el índice en memoria, sin consultas a la base de datos
+        query = request.query_params.get('q', '')
+        limit = clamp_page_size(request.query_params.get('limit'), DEFAULT_SUGGEST_LIMIT, MAX_SUGGEST_LIMIT)
+        return Response({'query': query, 'results': suggest_index.suggest(query, limit)})
+
+    @action(detail=False, methods=['post'], url_path='import', parser_classes=[MultiPartParser])
+    def bulk_import(self, request):
+        # Carga masiva desde un archivo: file=<csv|jsonl|json>, ?format= opcional (por extensión)
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'error': 'Debe adjuntar un archivo en el campo file'}, status=400)
+        fmt = request.data.get('format') or upload.name.rsplit('.', 1)[-1].lower()
+        if fmt not in IMPORT_FORMATS:
+            return Response({'error': f'Formato inválido, usar uno de: {", ".join(IMPORT_FORMATS)}'}, status=400)
+        try:
+            result = import_products(io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline=''), fmt)
+        except (ValueError, UnicodeDecodeError) as e:
+            return Response({'error': f'Archivo inválido: {e}'}, status=400)
+        return Response(result.as_dict(), status=201 if result.created else 400)
+
 class AddressViewSet(viewsets.ModelViewSet):
     queryset = Address.objects.all()
     serializer_class = AddressSerializer
@@ -72,9 +127,34 @@ class CartViewSet(viewsets.ModelViewSet):
         cart = self.get_object()
         if cart.user != request.user:
             return Response({'error': 'No tienes permiso para limpiar este carrito'}, status=403)
-        cart.items.all().delete()
+        cart_service.clear_cart(cart)
         return Response({'status': 'cart cleared'}, status=200)
 
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def add_item(self, request, pk=None):
+        # Suma unidades con un UPDATE condicional o inserta el ítem (core.cart_service)
+        cart = self.get_object()
+        try:
+            change = cart_service.add_item(cart, request.data.get('product_id'), request.data.get('quantity', 1))
+        except cart_service.ProductNotFound as e:
+            return Response({'error': str(e)}, status=404)
+        except cart_service.CartError as e:
+            return Response({'error': str(e)}, status=400)
+        return Response({'status': 'item added', 'product_id': change.product_id, 'created': change.created}, status=201 if change.created else 200)
+
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def batch(self, request, pk=None):
+        # Varias operaciones en una sola petición y transacción:
+        # {"operations": [{"op": "add|set|remove", "product_id": 1, "quantity": 2}, ...]}
+        cart = self.get_object()
+        try:
+            result = cart_service.apply_batch(cart, request.data.get('operations'))
+        except cart_service.BatchError as e:
+            return Response({'errors': e.errors}, status=400)
+        except IntegrityError:
+            return Response({'error': 'El carrito cambió durante la operación, intenta de nuevo'}, status=409)
+        return Response({'status': 'batch applied', **result})
+
 class OrderViewSet(viewsets.ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
@@ -83,6 +163,23 @@ class OrderViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return Order.objects.filter(user=self.request.user)
 
+    @action(detail=False, methods=['post'], url_path='transition')
+    def bulk_transition(self, request):
+        # POST {"action": "approve", "order_ids": [1, 2, 3]}: un UPDATE para todo el lote
+        action_name = request.data.get('action')
+        if action_name not in TRANSITIONS:
+            return Response({'error': f'Acción inválida, usar una de: {", ".join(TRANSITIONS)}'}, status=400)
+        if action_name not in allowed_actions(request.user):
+            return Response({'error': 'Acción no permitida para tu rol'}, status=403)
+        order_ids = request.data.get('order_ids')
+        if not isinstance(order_ids, list):
+            return Response({'error': 'order_ids debe ser una lista'}, status=400)
+        try:
+            result = transition(order_ids, action_name)
+        except TransitionError as e:
+            return Response({'error': str(e)}, status=400)
+        return Response({'updated': len(result.updated), 'failed': len(result.failed), 'results': result.as_list()})
+
 class PaymentViewSet(viewsets.ModelViewSet):
     queryset = Payment.objects.all()
     serializer_class = PaymentSerializer
@@ -134,43 +231,29 @@ def create_payment_intent(request):
         order_id = data.get('order_id')
         try:
             order = Order.objects.get(id=order_id)
-            intent = stripe.PaymentIntent.create(
-                amount=int(order.get_total() * 100),
-                currency='clp',
-                metadata={'order_id': order.id}
-            )
+            amount = int(order.get_total() * 100)
+            intent = get_gateway().create_payment_intent({
+                'amount': amount,
+                'currency': 'clp',
+                'metadata': {'order_id': order.id},
+            }, idempotency_key=f'payment-intent-{order.id}-{amount}')
             return JsonResponse({'clientSecret': intent.client_secret})
         except Order.DoesNotExist:
             return JsonResponse({'error': 'Orden no encontrada'}, status=404)
+        except PaymentUnavailable:
+            return JsonResponse({'error': 'El servicio de pagos no está disponible, intenta nuevamente en unos minutos.'}, status=503)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=400)
     return JsonResponse({'error': 'Método no permitido'}, status=405)
 
 @csrf_exempt
 def stripe_webhook(request):
-    payload = request.body
-    sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
+    # Sólo verifica y encola el evento; core.webhooks lo procesa en segundo plano
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
-        )
-    except ValueError:
-        return JsonResponse({'error': 'Payload inválido'}, status=400)
-    except stripe.error.SignatureVerificationError:
-        return JsonResponse({'error': 'Firma inválida'}, status=400)
-
-    if event['type'] == 'payment_intent.succeeded':
-        payment_intent = event['data']['object']
-        order_id = payment_intent['metadata']['order_id']
-        order = Order.objects.get(id=order_id)
-        payment = Payment.objects.get(order=order)
-        payment.stripe_payment_intent_id = payment_intent['id']
-        payment.confirmed = True
-        payment.save()
-        order.status = 'approved'
-        order.save()
-
-    return JsonResponse({'status': 'success'}, status=200)
+        event, created = receive(request.body, request.META.get('HTTP_STRIPE_SIGNATURE'))
+    except InvalidWebhook as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'status': 'queued' if created else 'duplicate', 'event': event.event_id})
 
 @csrf_exempt
 def convert_currency(request):
@@ -182,16 +265,13 @@ def convert_currency(request):
             if not amount_clp:
                 return JsonResponse({'error': 'Monto no proporcionado'}, status=400)
 
-            # Llamada a la API de conversión de monedas
-            response = requests.get(EXCHANGE_API_URL)
-            if response.status_code != 200:
-                return JsonResponse({'error': 'Error al obtener tasas de cambio'}, status=500)
-
-            rates = response.json().get('rates', {})
-            if target_currency not in rates:
-                return JsonResponse({'error': f'Moneda {target_currency} no soportada'}, status=400)
-
-            converted_amount = float(amount_clp) * rates[target_currency]
+            # Tasas desde la caché del proceso (core/exchange_rates.py); sin llamadas externas
+            try:
+                converted_amount = exchange_rates.convert(float(amount_clp), target_currency)
+            except exchange_rates.UnsupportedCurrency as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            except exchange_rates.RatesUnavailable:
+                return JsonResponse({'error': 'Error al obtener tasas de cambio'}, status=503)
             return JsonResponse({
                 'amount_clp': amount_clp,
                 'target_currency': target_currency,
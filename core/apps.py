@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        # Registra los signals del índice de búsqueda, las facetas, la caché de páginas
+        # el índice de autocompletado, los resúmenes del historial de precios y las
+        # variantes de imágenes
+        from . import search, facets, page_cache, suggest, price_history, image_pipeline  # noqa: F401
@@ -0,0 +1,245 @@
+# Operaciones sobre el carrito con dos consultas sobre los ítems cada una.
+# Primero se lee en una sola consulta el producto (o ítem) con lo necesario para
+# validar, y luego se escribe con un UPDATE condicional (cantidad con F() y stock
+# comprobado en el mismo WHERE) o un INSERT. Así dos clics simultáneos no pierden
+# unidades ni superan el stock disponible. Cada cambio recalcula además, en la
+# misma transacción, los totales almacenados en Cart (item_count y total).
+from collections import namedtuple
+
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import DecimalField, Exists, F, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Cart, CartItem, Product
+
+CartChange = namedtuple('CartChange', ['product_id', 'product_name', 'quantity', 'created'])
+
+
+class CartError(Exception):
+    pass
+
+
+class InvalidQuantity(CartError):
+    def __init__(self, message='La cantidad debe ser mayor a 0.'):
+        super().__init__(message)
+
+
+class ProductNotFound(CartError):
+    def __init__(self, message='Producto no encontrado.'):
+        super().__init__(message)
+
+
+class ItemNotFound(CartError):
+    def __init__(self, message='Ítem no encontrado.'):
+        super().__init__(message)
+
+
+class InsufficientStock(CartError):
+    def __init__(self, product_name, available):
+        self.product_name = product_name
+        self.available = available
+        super().__init__(f'No hay suficiente stock de {product_name}. Solo hay {available} unidad(es) disponibles.')
+
+
+def parse_quantity(value):
+    try:
+        quantity = int(value)
+    except (TypeError, ValueError):
+        raise InvalidQuantity('Cantidad inválida.')
+    if quantity <= 0:
+        raise InvalidQuantity()
+    return quantity
+
+
+def _pk(value, error):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise error
+
+
+def _product_stock():
+    # Stock vigente como subconsulta correlacionada, evaluada dentro del mismo UPDATE
+    return Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('stock')[:1])
+
+
+def cart_totals():
+    # Expresiones por carrito (para UPDATE o annotate sobre Cart) calculadas desde sus ítems
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    return {
+        'item_count': Coalesce(Subquery(items.annotate(n=Sum('quantity')).values('n'), output_field=IntegerField()), 0),
+        'total': Coalesce(
+            Subquery(items.annotate(t=Sum(F('quantity') * F('price'))).values('t'), output_field=DecimalField(max_digits=12, decimal_places=2)),
+            Value(Decimal('0')),
+        ),
+    }
+
+
+def refresh_totals(cart_ids):
+    # Un solo UPDATE con subconsultas, para uno o varios carritos
+    if isinstance(cart_ids, (int, Cart)):
+        cart_ids = [cart_ids.pk if isinstance(cart_ids, Cart) else cart_ids]
+    return Cart.objects.filter(pk__in=cart_ids).update(**cart_totals(), updated_at=timezone.now())
+
+
+@transaction.atomic
+def clear_cart(cart):
+    CartItem.objects.filter(cart=cart).delete()
+    Cart.objects.filter(pk=cart.pk).update(item_count=0, total=0, updated_at=timezone.now())
+
+
+@transaction.atomic
+def add_item(cart, product_id, quantity):
+    quantity = parse_quantity(quantity)
+    product_id = _pk(product_id, ProductNotFound())
+    product = (
+        Product.objects.filter(pk=product_id)
+        .annotate(in_cart=Exists(CartItem.objects.filter(cart=cart, product_id=OuterRef('pk'))))
+        .values('name', 'stock', 'price', 'discount_price', 'in_cart')
+        .first()
+    )
+    if product is None:
+        raise ProductNotFound()
+    if quantity > product['stock']:
+        raise InsufficientStock(product['name'], product['stock'])
+    price = product['discount_price'] or product['price']
+
+    if not product['in_cart']:
+        try:
+            with transaction.atomic():
+                CartItem.objects.create(cart=cart, product_id=product_id, quantity=quantity, price=price)
+            refresh_totals(cart)
+            return CartChange(product_id, product['name'], quantity, True)
+        except IntegrityError:
+            pass  # Otra petición insertó el ítem primero: se suma con el UPDATE de abajo
+
+    updated = (
+        CartItem.objects.filter(cart=cart, product_id=product_id)
+        .alias(stock=_product_stock())
+        .filter(stock__gte=F('quantity') + quantity)
+        .update(quantity=F('quantity') + quantity, price=price)
+    )
+    if not updated:
+        raise InsufficientStock(product['name'], product['stock'])
+    refresh_totals(cart)
+    return CartChange(product_id, product['name'], quantity, False)
+
+
+@transaction.atomic
+def set_quantity(cart, item_id, quantity):
+    quantity = parse_quantity(quantity)
+    item_id = _pk(item_id, ItemNotFound())
+    item = (
+        CartItem.objects.filter(pk=item_id, cart=cart)
+        .values('product_id', 'product__name', 'product__stock', 'product__price', 'product__discount_price')
+        .first()
+    )
+    if item is None:
+        raise ItemNotFound()
+    if quantity > item['product__stock']:
+        raise InsufficientStock(item['product__name'], item['product__stock'])
+    updated = (
+        CartItem.objects.filter(pk=item_id, cart=cart)
+        .alias(stock=_product_stock())
+        .filter(stock__gte=quantity)
+        .update(quantity=quantity, price=item['product__discount_price'] or item['product__price'])
+    )
+    if not updated:
+        raise InsufficientStock(item['product__name'], item['product__stock'])
+    refresh_totals(cart)
+    return CartChange(item['product_id'], item['product__name'], quantity, False)
+
+
+@transaction.atomic
+def remove_item(cart, item_id):
+    item_id = _pk(item_id, ItemNotFound())
+    item = CartItem.objects.filter(pk=item_id, cart=cart).values_list('product_id', 'product__name').first()
+    if item is None:
+        raise ItemNotFound()
+    # Sin signals ni cascadas, delete() sobre el queryset es un único DELETE
+    CartItem.objects.filter(pk=item_id, cart=cart).delete()
+    refresh_totals(cart)
+    return CartChange(item[0], item[1], 0, False)
+
+
+MAX_BATCH_OPERATIONS = 100
+BATCH_OPERATIONS = ('add', 'set', 'remove')
+
+
+class BatchError(CartError):
+    def __init__(self, errors):
+        self.errors = errors  # Lista de {'index', 'error'}
+        super().__init__('; '.join(f"#{e['index']}: {e['error']}" for e in errors))
+
+
+@transaction.atomic
+def apply_batch(cart, operations):
+    # Aplica una lista de operaciones {'op': add|set|remove, 'product_id', 'quantity'}
+    # todo o nada, con un número fijo de consultas: ítems bloqueados, productos con
+    # in_bulk, y luego bulk_create, bulk_update, un DELETE y el UPDATE de totales.
+    if not isinstance(operations, list) or not operations:
+        raise BatchError([{'index': None, 'error': 'Se esperaba una lista de operaciones.'}])
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise BatchError([{'index': None, 'error': f'Máximo {MAX_BATCH_OPERATIONS} operaciones por lote.'}])
+
+    errors, parsed = [], []
+    for index, operation in enumerate(operations):
+        try:
+            if not isinstance(operation, dict) or operation.get('op') not in BATCH_OPERATIONS:
+                raise CartError(f'Operación inválida; usar una de: {", ".join(BATCH_OPERATIONS)}.')
+            product_id = _pk(operation.get('product_id'), ProductNotFound())
+            quantity = 0 if operation['op'] == 'remove' else parse_quantity(operation.get('quantity', 1))
+        except CartError as e:
+            errors.append({'index': index, 'error': str(e)})
+            continue
+        parsed.append((index, operation['op'], product_id, quantity))
+    if errors:
+        raise BatchError(errors)
+
+    items = {item.product_id: item for item in CartItem.objects.select_for_update().filter(cart=cart)}
+    products = Product.objects.in_bulk({product_id for _, _, product_id, _ in parsed})
+    quantities = {product_id: item.quantity for product_id, item in items.items()}
+    touched = set()
+    for index, op, product_id, quantity in parsed:
+        product = products.get(product_id)
+        if product is None:
+            errors.append({'index': index, 'error': str(ProductNotFound())})
+            continue
+        current = quantities.get(product_id, 0)
+        if op == 'remove':
+            if product_id not in quantities:
+                errors.append({'index': index, 'error': str(ItemNotFound())})
+                continue
+            del quantities[product_id]
+        else:
+            new_quantity = current + quantity if op == 'add' else quantity
+            if new_quantity > product.stock:
+                errors.append({'index': index, 'error': str(InsufficientStock(product.name, product.stock))})
+                continue
+            quantities[product_id] = new_quantity
+        touched.add(product_id)
+    if errors:
+        raise BatchError(errors)
+
+    to_create, to_update, to_delete = [], [], []
+    for product_id in touched:
+        item = items.get(product_id)
+        if product_id not in quantities:
+            if item is not None:
+                to_delete.append(item.pk)
+        elif item is None:
+            to_create.append(CartItem(cart=cart, product_id=product_id, quantity=quantities[product_id], price=products[product_id].get_final_price()))
+        else:
+            item.quantity, item.price = quantities[product_id], products[product_id].get_final_price()
+            to_update.append(item)
+    if to_create:
+        CartItem.objects.bulk_create(to_create)
+    if to_update:
+        CartItem.objects.bulk_update(to_update, ['quantity', 'price'])
+    if to_delete:
+        CartItem.objects.filter(pk__in=to_delete).delete()
+    refresh_totals(cart)
+    return {'created': len(to_create), 'updated': len(to_update), 'removed': len(to_delete), 'item_count': sum(quantities.values())}
@@ -0,0 +1,65 @@
+# GET condicional (ETag / Last-Modified) para los endpoints de sólo lectura.
+# Los validadores salen de una consulta agregada barata (máximo updated_at y
+# cantidad de filas) en vez de serializar el payload completo; si el cliente ya
+# tiene la versión vigente se responde 304 sin cuerpo.
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+class ConditionalGetMixin:
+    # Relaciones cuyo updated_at también afecta la representación (ej: 'category')
+    conditional_related = ()
+
+    def get_validators(self, request, queryset):
+        fields = ['updated_at'] + [f'{related}__updated_at' for related in self.conditional_related]
+        aggregates = queryset.order_by().aggregate(
+            total=Count('pk'), **{f'max_{i}': Max(field) for i, field in enumerate(fields)}
+        )
+        total = aggregates.pop('total')
+        timestamps = [value for value in aggregates.values() if value is not None]
+        last_modified = max(timestamps) if timestamps else None
+        fingerprint = '|'.join([
+            request.get_full_path(),
+            getattr(request.accepted_renderer, 'format', ''),
+            str(total),
+            *(value.isoformat() if value else '' for value in aggregates.values()),
+        ])
+        etag = f'"{hashlib.sha1(fingerprint.encode()).hexdigest()}"'
+        return etag, last_modified
+
+    def conditional_response(self, request, queryset):
+        # Devuelve un 304 si corresponde; si no, guarda los validadores para la respuesta
+        self._validators = self.get_validators(request, queryset)
+        etag, last_modified = self._validators
+        return get_conditional_response(
+            request,
+            etag=etag,
+            last_modified=int(last_modified.timestamp()) if last_modified else None,
+        )
+
+    def list(self, request, *args, **kwargs):
+        not_modified = self.conditional_response(request, self.filter_queryset(self.get_queryset()))
+        return not_modified or super().list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            queryset = self.filter_queryset(self.get_queryset()).filter(**{self.lookup_field: kwargs[lookup_url_kwarg]})
+            not_modified = self.conditional_response(request, queryset)
+        except (TypeError, ValueError):
+            not_modified = None  # Identificador inválido: get_object() responderá 404
+        return not_modified or super().retrieve(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        validators = getattr(self, '_validators', None)
+        if validators and request.method in ('GET', 'HEAD') and response.status_code in (200, 304):
+            etag, last_modified = validators
+            response['ETag'] = etag
+            if last_modified:
+                response['Last-Modified'] = http_date(last_modified.timestamp())
+            response['Cache-Control'] = 'no-cache'  # Siempre revalidar, pero sin volver a descargar
+        return response
@@ -0,0 +1,18 @@
+from django.utils.functional import SimpleLazyObject
+
+from .models import Cart
+from .session_cart import COOKIE_NAME, SessionCart
+
+
+def cart_summary(request):
+    # Cantidad y total del carrito para el menú; se consulta sólo si la plantilla lo usa.
+    # Para anónimos se lee la cookie del carrito, sin consultas.
+    if not getattr(request, 'user', None):
+        return {}
+    if not request.user.is_authenticated:
+        if COOKIE_NAME not in request.COOKIES:
+            return {}
+        return {'cart_summary': {'item_count': SessionCart.from_request(request).item_count}}
+    return {'cart_summary': SimpleLazyObject(
+        lambda: Cart.objects.filter(user=request.user).values('item_count', 'total').first() or {}
+    )}
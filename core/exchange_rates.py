@@ -0,0 +1,190 @@
+# Tasas de cambio para convert_currency.
+# La tabla de tasas vive en memoria del proceso: mientras está vigente (TTL) una
+# conversión es una búsqueda en un diccionario, sin E/S. Vencida, se sigue usando
+# (stale-while-revalidate) y un hilo en segundo plano la renueva con una sesión
+# HTTP con pool; un solo refresco a la vez. La última tabla obtenida se guarda en
+# ExchangeRateTable: al arrancar un proceso se carga de ahí y, antes de llamar a
+# la API, un refresco revisa si otro proceso ya dejó una tabla vigente. Sin
+# ninguna tabla, la primera obtención es una sola aunque lleguen varias peticiones
+# a la vez. Pasado MAX_STALE sin poder renovarla, las conversiones fallan con
+# RatesUnavailable.
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from .models import ExchangeRateTable
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'URL': 'https://api.exchangerate-api.com/v4/latest/CLP',
+    'BASE': 'CLP',
+    'TTL': 60 * 60,  # Segundos que una tabla se considera vigente
+    'MAX_STALE': 60 * 60 * 24,  # Segundos que se sigue usando una tabla vencida si la API falla
+    'RETRY_DELAY': 60,  # Segundos entre intentos tras una falla de la API
+    'CONNECT_TIMEOUT': 3,
+    'TIMEOUT': 5,
+    'ASYNC': True,
+}
+
+_service = None
+_service_lock = threading.Lock()
+
+
+class RatesUnavailable(Exception):
+    pass
+
+
+class UnsupportedCurrency(ValueError):
+    pass
+
+
+def _config():
+    return {**DEFAULTS, **getattr(settings, 'EXCHANGE_RATES', {})}
+
+
+class RateTable:
+    # Tabla inmutable; los plazos se guardan en reloj monotónico para comparar rápido
+    __slots__ = ('base', 'rates', 'fetched_at', 'fresh_until', 'usable_until')
+
+    def __init__(self, base, rates, fetched_at, ttl, max_stale):
+        self.base = base
+        self.rates = rates
+        self.fetched_at = fetched_at
+        age = max((timezone.now() - fetched_at).total_seconds(), 0)
+        now = time.monotonic()
+        self.fresh_until = now + ttl - age
+        self.usable_until = now + max_stale - age
+
+
+class ExchangeRateService:
+    def __init__(self, config=None):
+        self.config = config or _config()
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self._table = None
+        self._loaded = False  # Ya se intentó cargar la tabla guardada
+        self._refreshing = False
+        self._retry_at = 0
+        self._lock = threading.Lock()
+        self._cold_lock = threading.Lock()  # Serializa la primera obtención de la tabla
+        self._executor = None
+
+    def rates(self):
+        # Camino rápido: tabla vigente en memoria, sin locks ni E/S
+        table = self._table
+        if table is not None and time.monotonic() < table.fresh_until:
+            return table
+        return self._stale_rates()
+
+    def _stale_rates(self):
+        if self._table is None:
+            # Arranque en frío: una sola petición carga la tabla guardada o llama a la API
+            # y las concurrentes esperan su resultado en vez de salir cada una a buscarla
+            with self._cold_lock:
+                if not self._loaded:
+                    self._loaded = True
+                    self._load()  # La tabla que dejó el último refresco
+                if self._table is None:
+                    self.refresh()  # Nunca se obtuvo una tabla: única vez que la petición espera a la API
+        table = self._table
+        if table is not None and time.monotonic() >= table.fresh_until:
+            self.schedule_refresh()
+        if table is None or time.monotonic() >= table.usable_until:
+            raise RatesUnavailable('Tasas de cambio no disponibles')
+        return table
+
+    def convert(self, amount, currency):
+        rate = self.rates().rates.get(currency)
+        if rate is None:
+            raise UnsupportedCurrency(f'Moneda {currency} no soportada')
+        return amount * rate
+
+    def _load(self):
+        row = ExchangeRateTable.objects.filter(base=self.config['BASE']).first()
+        if row is not None and (self._table is None or row.fetched_at > self._table.fetched_at):
+            self._table = RateTable(row.base, row.rates, row.fetched_at, self.config['TTL'], self.config['MAX_STALE'])
+        return self._table
+
+    def _claim(self, force=False):
+        # Un solo refresco a la vez, y no antes de RETRY_DELAY tras una falla
+        with self._lock:
+            if self._refreshing or (not force and time.monotonic() < self._retry_at):
+                return False
+            self._refreshing = True
+            return True
+
+    def refresh(self, force=False):
+        if not self._claim(force):
+            return False
+        return self._refresh(force)
+
+    def schedule_refresh(self):
+        if not self._claim():
+            return
+        if self.config['ASYNC']:
+            self._get_executor().submit(self._refresh_job)
+        else:
+            self._refresh()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='exchange-rates')
+            return self._executor
+
+    def _refresh_job(self):
+        close_old_connections()
+        try:
+            self._refresh()
+        finally:
+            close_old_connections()
+
+    def _refresh(self, force=False):
+        try:
+            table = None if force else self._load()
+            if table is not None and time.monotonic() < table.fresh_until:
+                return True  # Otro proceso ya la renovó
+            response = self.session.get(self.config['URL'], timeout=(self.config['CONNECT_TIMEOUT'], self.config['TIMEOUT']))
+            response.raise_for_status()
+            rates = {currency: float(rate) for currency, rate in response.json()['rates'].items()}
+            fetched_at = timezone.now()
+            ExchangeRateTable.objects.update_or_create(base=self.config['BASE'], defaults={'rates': rates, 'fetched_at': fetched_at})
+            self._table = RateTable(self.config['BASE'], rates, fetched_at, self.config['TTL'], self.config['MAX_STALE'])
+            self._retry_at = 0
+            return True
+        except Exception as e:
+            logger.warning(f'No se pudieron actualizar las tasas de cambio: {e}')
+            self._retry_at = time.monotonic() + self.config['RETRY_DELAY']
+            return False
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+def get_service():
+    global _service
+    if _service is not None:
+        return _service
+    with _service_lock:
+        if _service is None:
+            _service = ExchangeRateService()
+        return _service
+
+
+def reset_service():
+    global _service
+    with _service_lock:
+        _service = None
+
+
+def convert(amount, currency):
+    return get_service().convert(amount, currency)
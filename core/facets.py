@@ -0,0 +1,96 @@
+# Navegación por facetas del catálogo: conteo de productos por categoría y por marca
+# según la búsqueda y los filtros actuales. Ambos conteos salen de una sola consulta
+# agrupada por (categoría, marca) y se guardan en caché por combinación de filtros.
+# Cualquier cambio en Product, Category o Brand invalida todas las entradas subiendo
+# un número de versión incluido en la clave.
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db.models import Count
+from django.db.models.signals import post_delete, post_save
+
+from .models import Brand, Category, Product
+from .search import filter_products, normalize
+
+FACETS_VERSION_KEY = 'catalog:facets:version'
+FACETS_TIMEOUT = 60 * 10
+
+
+def _parse_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def facets_version():
+    version = cache.get(FACETS_VERSION_KEY)
+    if version is None:
+        version = int(time.time() * 1000)
+        cache.add(FACETS_VERSION_KEY, version, None)
+        version = cache.get(FACETS_VERSION_KEY, version)
+    return version
+
+
+def invalidate_facets(*args, **kwargs):
+    try:
+        cache.incr(FACETS_VERSION_KEY)
+    except ValueError:
+        # La versión fue expulsada de la caché: se parte de una nueva que no choque
+        cache.set(FACETS_VERSION_KEY, int(time.time() * 1000), None)
+
+
+def _cache_key(search_query, category_id, brand_id):
+    raw = f'{normalize(search_query or "").strip()}|{category_id or ""}|{brand_id or ""}'
+    return f'catalog:facets:{facets_version()}:{hashlib.sha1(raw.encode()).hexdigest()}'
+
+
+def compute_facets(search_query=None, category_id=None, brand_id=None):
+    products = Product.objects.all()
+    if search_query:
+        products = filter_products(products, search_query)
+    rows = (
+        products
+        .values('category_id', 'category__name', 'brand_id', 'brand__name')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    # Cada faceta respeta todos los filtros excepto el suyo propio, para que el
+    # usuario vea cuántos productos obtendría al cambiar esa selección.
+    categories, brands = {}, {}
+    for row in rows:
+        if brand_id is None or row['brand_id'] == brand_id:
+            entry = categories.setdefault(row['category_id'], {'id': row['category_id'], 'name': row['category__name'], 'count': 0})
+            entry['count'] += row['count']
+        if category_id is None or row['category_id'] == category_id:
+            entry = brands.setdefault(row['brand_id'], {'id': row['brand_id'], 'name': row['brand__name'], 'count': 0})
+            entry['count'] += row['count']
+    # La opción seleccionada se mantiene visible aunque no tenga resultados
+    if category_id is not None and category_id not in categories:
+        category = Category.objects.filter(pk=category_id).values('id', 'name').first()
+        if category:
+            categories[category_id] = dict(category, count=0)
+    if brand_id is not None and brand_id not in brands:
+        brand = Brand.objects.filter(pk=brand_id).values('id', 'name').first()
+        if brand:
+            brands[brand_id] = dict(brand, count=0)
+    return {
+        'categories': sorted(categories.values(), key=lambda f: f['name']),
+        'brands': sorted(brands.values(), key=lambda f: f['name']),
+    }
+
+
+def catalog_facets(search_query=None, category_id=None, brand_id=None):
+    category_id, brand_id = _parse_id(category_id), _parse_id(brand_id)
+    key = _cache_key(search_query, category_id, brand_id)
+    facets = cache.get(key)
+    if facets is None:
+        facets = compute_facets(search_query, category_id, brand_id)
+        cache.set(key, facets, FACETS_TIMEOUT)
+    return facets
+
+
+for model in (Product, Category, Brand):
+    post_save.connect(invalidate_facets, sender=model, dispatch_uid=f'facets_save_{model.__name__}')
+    post_delete.connect(invalidate_facets, sender=model, dispatch_uid=f'facets_delete_{model.__name__}')
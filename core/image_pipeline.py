@@ -0,0 +1,135 @@
+# Variantes optimizadas (WebP/JPEG) de las imágenes de producto.
+# Al subir una imagen se encola su procesamiento en un pool de procesos para no
+# bloquear la petición; cuando termina, el resultado se guarda en
+# Product.image_variants con un UPDATE (Product.save() no escribe esa columna, así
+# que una instancia leída antes no lo pisa) y se invalidan las páginas cacheadas
+# del producto. Los nombres incluyen un hash del original, así que las URLs nunca
+# cambian de contenido y se pueden cachear indefinidamente en el navegador.
+import hashlib
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from .imaging import render_variants
+from .models import Product
+from .page_cache import invalidate_tags
+
+logger = logging.getLogger(__name__)
+
+VARIANTS_DIR = 'products/variants'
+DEFAULT_WORKERS = 2
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = set()  # (product_id, nombre de imagen) ya encolados en este proceso
+_pending_lock = threading.Lock()  # Lo tocan la petición y los hilos que reciben resultados
+
+
+def _config():
+    return {'WORKERS': DEFAULT_WORKERS, 'ASYNC': True, **getattr(settings, 'IMAGE_PIPELINE', {})}
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=_config()['WORKERS'])
+        return _executor
+
+
+def variant_job(product_id, image_name):
+    # Argumentos para render_variants: sólo rutas, sin objetos de Django
+    stem = f'{product_id}-{hashlib.sha1(image_name.encode()).hexdigest()[:10]}'
+    return default_storage.path(image_name), default_storage.path(VARIANTS_DIR), stem
+
+
+def store_variants(product_id, image_name, variants):
+    # Se guarda sólo si el producto sigue teniendo la misma imagen que se procesó
+    previous = Product.objects.filter(pk=product_id).values_list('image_variants', 'slug', 'category_id').first()
+    if previous is None:
+        return None
+    new_files = set()
+    if variants:
+        for data in variants.values():
+            for names in data['files']:
+                names['webp'] = f'{VARIANTS_DIR}/{names["webp"]}'
+                names['jpeg'] = f'{VARIANTS_DIR}/{names["jpeg"]}'
+                new_files.update((names['webp'], names['jpeg']))
+        variants = {'source': image_name, **variants}
+    same_image = Q(image=image_name) if image_name else Q(image='') | Q(image__isnull=True)
+    updated = Product.objects.filter(same_image, pk=product_id).update(
+        image_variants=variants or {}, updated_at=timezone.now()
+    )
+    if not updated:
+        return None
+    # Archivos de la imagen anterior que ya no se usan
+    for key, data in (previous[0] or {}).items():
+        if key == 'source':
+            continue
+        for names in data['files']:
+            for name in (names['webp'], names['jpeg']):
+                if name not in new_files:
+                    default_storage.delete(name)
+    invalidate_tags(f'product:{previous[1]}', f'catalog:category:{previous[2]}', 'catalog:all')
+    return variants or {}
+
+
+def _finish(product_id, image_name, future):
+    # Corre en un hilo del pool en este proceso: abre y cierra su propia conexión
+    with _pending_lock:
+        _pending.discard((product_id, image_name))
+    try:
+        store_variants(product_id, image_name, future.result())
+    except Exception:
+        logger.exception('No se pudieron generar las variantes de la imagen %s', image_name)
+    finally:
+        close_old_connections()
+
+
+def _submit(product_id, image_name, job):
+    with _pending_lock:
+        if (product_id, image_name) in _pending:
+            return
+        _pending.add((product_id, image_name))
+    future = get_executor().submit(render_variants, *job)
+    future.add_done_callback(lambda f: _finish(product_id, image_name, f))
+
+
+def generate_variants(product_id, image_name, wait=False):
+    # Con wait (o ASYNC desactivado) procesa aquí mismo y devuelve las variantes guardadas;
+    # si no, encola el trabajo al confirmar la transacción y devuelve None
+    if not image_name:
+        return store_variants(product_id, '', {})
+    try:
+        job = variant_job(product_id, image_name)
+    except NotImplementedError:
+        logger.warning('El almacenamiento no expone rutas locales; se omiten las variantes de %s', image_name)
+        return None
+    if wait or not _config()['ASYNC']:
+        return store_variants(product_id, image_name, render_variants(*job))
+    transaction.on_commit(lambda: _submit(product_id, image_name, job))
+    return None
+
+
+def product_image_receiver(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    image_name = instance.image.name if instance.image else ''
+    if image_name == (instance.image_variants or {}).get('source', ''):
+        return  # Sin cambios de imagen
+    try:
+        variants = generate_variants(instance.pk, image_name)
+        if variants is not None:
+            instance.image_variants = variants
+    except (OSError, ValueError):
+        logger.exception('No se pudieron generar las variantes de la imagen %s', image_name)
+
+
+post_save.connect(product_image_receiver, sender=Product)
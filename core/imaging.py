@@ -0,0 +1,64 @@
+# Generación de variantes de imágenes de producto con Pillow.
+# Este módulo no importa Django: lo cargan los procesos del pool de
+# core.image_pipeline, que reciben rutas de archivo y devuelven nombres.
+import os
+
+from PIL import Image, ImageOps
+
+# nombre -> (ancho, alto, recortar). Las variantes recortadas llenan la caja
+# exacta (tarjetas y miniaturas); las demás sólo se achican manteniendo proporción.
+VARIANTS = {
+    'thumbnail': (150, 150, True),
+    'card': (400, 300, True),
+    'detail': (1200, 1200, False),
+}
+DENSITIES = (1, 2)  # 1x y 2x (pantallas retina) si el original tiene resolución suficiente
+FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def _to_rgb(image):
+    # JPEG no admite transparencia: se aplana sobre fondo blanco
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _resize(image, width, height, crop):
+    if crop:
+        return ImageOps.fit(image, (width, height), Image.LANCZOS)
+    resized = image.copy()
+    resized.thumbnail((width, height), Image.LANCZOS)
+    return resized
+
+
+def render_variants(source_path, output_dir, stem):
+    # Devuelve {variante: {'width', 'height', 'files': [{'width', 'height', 'webp', 'jpeg'}, ...]}}
+    # con nombres de archivo relativos a output_dir, ordenados por ancho
+    os.makedirs(output_dir, exist_ok=True)
+    result = {}
+    with Image.open(source_path) as original:
+        image = _to_rgb(ImageOps.exif_transpose(original))
+    for variant, (width, height, crop) in VARIANTS.items():
+        files = []
+        for density in DENSITIES:
+            box = (width * density, height * density)
+            # No se amplía: una densidad extra sólo se genera si agrega resolución real
+            if files and crop and (image.width < box[0] or image.height < box[1]):
+                break
+            resized = _resize(image, box[0], box[1], crop)
+            if files and resized.width <= files[-1]['width']:
+                break
+            names = {'width': resized.width, 'height': resized.height}
+            for key, (pil_format, extension, options) in FORMATS.items():
+                name = f'{stem}-{variant}-{density}x.{extension}'
+                resized.save(os.path.join(output_dir, name), pil_format, **options)
+                names[key] = name
+            files.append(names)
+        result[variant] = {'width': files[0]['width'], 'height': files[0]['height'], 'files': files}
+    return result
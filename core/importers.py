@@ -0,0 +1,251 @@
+# Importación masiva de productos desde CSV o JSON.
+# Las filas se leen en streaming, se validan por bloques y se insertan con
+# bulk_create (productos e historial de precios). Categorías y marcas se
+# resuelven por nombre con un mapa en memoria y las que faltan se crean dentro de
+# la transacción del bloque, los códigos FER se asignan en bloque y al final se
+# actualizan los índices y cachés del catálogo que los signals no alcanzan a ver
+# con bulk_create. Si el archivo se corta o se vuelve ilegible a mitad de camino,
+# los bloques anteriores quedan importados y el resultado indica la fila del error.
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from .facets import invalidate_facets
+from .models import Brand, Category, PriceHistory, Product
+from .page_cache import invalidate_tags
+from .price_history import record_price_points
+from .search import index_products
+from .sequences import next_codes
+from .suggest import suggest_index
+
+DEFAULT_CHUNK_SIZE = 1000
+FORMATS = ('csv', 'jsonl', 'json')
+MAX_REPORTED_ERRORS = 100
+
+
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        self.errors = []  # Lista de (número de fila, mensaje)
+        self.stopped_at = None  # Fila en la que el archivo dejó de poder leerse
+
+    def add_error(self, line, message):
+        self.errors.append((line, message))
+
+    def as_dict(self):
+        return {
+            'created': self.created,
+            'error_count': len(self.errors),
+            'errors': [{'row': line, 'error': message} for line, message in self.errors[:MAX_REPORTED_ERRORS]],
+            'stopped_at_row': self.stopped_at,
+        }
+
+
+class InvalidRow:
+    # Línea de JSON Lines que no se pudo decodificar; se informa como error de esa fila
+    def __init__(self, message):
+        self.message = message
+
+
+def _json_lines(stream):
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield InvalidRow(f'JSON inválido: {e}')
+
+
+def read_rows(stream, fmt):
+    # Devuelve un iterador de diccionarios; csv y jsonl no cargan el archivo completo
+    if fmt == 'csv':
+        return csv.DictReader(stream)
+    if fmt == 'jsonl':
+        return _json_lines(stream)
+    if fmt == 'json':
+        data = json.load(stream)
+        if not isinstance(data, list):
+            raise ValueError('El JSON debe ser una lista de productos')
+        return iter(data)
+    raise ValueError(f'Formato no soportado: {fmt}')
+
+
+def _decimal(value, field, required=True):
+    if value in (None, ''):
+        if required:
+            raise ValueError(f'{field} es obligatorio')
+        return None
+    try:
+        number = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f'{field} no es un número válido')
+    if number < 0 or number.as_tuple().exponent < -2 or abs(number) >= Decimal('1e8'):
+        raise ValueError(f'{field} fuera de rango')
+    return number
+
+
+def _text(row, field, max_length=None):
+    value = (row.get(field) or '').strip()
+    if not value:
+        raise ValueError(f'{field} es obligatorio')
+    if max_length and len(value) > max_length:
+        raise ValueError(f'{field} supera {max_length} caracteres')
+    return value
+
+
+class ProductImporter:
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, create_missing=True):
+        self.chunk_size = chunk_size
+        self.create_missing = create_missing
+        self.categories = {name.lower(): pk for pk, name in Category.objects.values_list('pk', 'name')}
+        self.brands = {name.lower(): pk for pk, name in Brand.objects.values_list('pk', 'name')}
+        self.seen_names = set()
+        self.seen_slugs = set()
+        self.result = ImportResult()
+
+    def run(self, rows):
+        chunk = []
+        line = 0
+        rows = iter(rows)
+        while True:
+            try:
+                row = next(rows)
+            except StopIteration:
+                break
+            except (ValueError, csv.Error) as e:  # UnicodeDecodeError es un ValueError
+                # El archivo no se puede seguir leyendo: se importa lo leído y se informa la fila
+                self.result.stopped_at = line + 1
+                self.result.add_error(line + 1, f'Archivo inválido: {e}')
+                break
+            line += 1
+            chunk.append((line, row))
+            if len(chunk) >= self.chunk_size:
+                self._import_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._import_chunk(chunk)
+        if self.result.created:
+            invalidate_facets()
+            invalidate_tags('catalog')
+            suggest_index.invalidate()
+        return self.result
+
+    def _resolve(self, mapping, model, name, max_length):
+        # pk de una categoría o marca existente; None si hay que crearla con el bloque
+        key = name.lower()
+        if key not in mapping:
+            if not self.create_missing:
+                raise ValueError(f'{model._meta.verbose_name} "{name}" no existe')
+            if len(name) > max_length:
+                raise ValueError(f'{model._meta.verbose_name} supera {max_length} caracteres')
+            return None
+        return mapping[key]
+
+    def _create_lookups(self, candidates, created):
+        # Dentro de la transacción del bloque: si éste se revierte, no quedan huérfanas
+        for _, product, names in candidates:
+            for field, mapping, model in (('category_id', self.categories, Category), ('brand_id', self.brands, Brand)):
+                if getattr(product, field) is None:
+                    key = names[field].lower()
+                    if key not in mapping:
+                        mapping[key] = model.objects.get_or_create(name=names[field])[0].pk
+                        created.append((mapping, key))
+                    setattr(product, field, mapping[key])
+
+    def _build(self, row):
+        # Devuelve el producto y los nombres de su categoría y marca
+        name = _text(row, 'name', 100)
+        price = _decimal(row.get('price'), 'price')
+        discount_price = _decimal(row.get('discount_price'), 'discount_price', required=False)
+        try:
+            stock = int(row.get('stock') or 0)
+        except (TypeError, ValueError):
+            raise ValueError('stock no es un entero válido')
+        if stock < 0:
+            raise ValueError('stock no puede ser negativo')
+        slug = slugify(row.get('slug') or name)
+        if not slug:
+            raise ValueError('No se pudo generar el slug')
+        names = {'category_id': _text(row, 'category'), 'brand_id': _text(row, 'brand')}
+        product = Product(
+            name=name,
+            description=_text(row, 'description'),
+            category_id=self._resolve(self.categories, Category, names['category_id'], 30),
+            brand_id=self._resolve(self.brands, Brand, names['brand_id'], 50),
+            price=price,
+            discount_price=discount_price,
+            stock=stock,
+            slug=slug,
+        )
+        return product, names
+
+    def _import_chunk(self, chunk):
+        candidates = []
+        for line, row in chunk:
+            try:
+                if isinstance(row, InvalidRow):
+                    raise ValueError(row.message)
+                if not isinstance(row, dict):
+                    raise ValueError('La fila no es un objeto')
+                product, names = self._build(row)
+            except ValueError as e:
+                self.result.add_error(line, str(e))
+                continue
+            if product.name.lower() in self.seen_names or product.slug in self.seen_slugs:
+                self.result.add_error(line, f'Producto duplicado en el archivo: {product.name}')
+                continue
+            self.seen_names.add(product.name.lower())
+            self.seen_slugs.add(product.slug)
+            candidates.append((line, product, names))
+
+        # Una consulta por bloque para descartar nombres o slugs ya existentes
+        names = [p.name for _, p, _ in candidates]
+        slugs = [p.slug for _, p, _ in candidates]
+        taken_names = {n.lower() for n in Product.objects.filter(name__in=names).values_list('name', flat=True)}
+        taken_slugs = set(Product.objects.filter(slug__in=slugs).values_list('slug', flat=True))
+        accepted = []
+        for candidate in candidates:
+            line, product, _ = candidate
+            if product.name.lower() in taken_names or product.slug in taken_slugs:
+                self.result.add_error(line, f'El producto ya existe: {product.name}')
+            else:
+                accepted.append(candidate)
+        if not accepted:
+            return
+        products = [product for _, product, _ in accepted]
+
+        created_lookups = []
+        try:
+            with transaction.atomic():
+                self._create_lookups(accepted, created_lookups)
+                for product, code in zip(products, next_codes('product', len(products))):
+                    product.code = code
+                Product.objects.bulk_create(products, batch_size=self.chunk_size)
+                ids = dict(Product.objects.filter(name__in=[p.name for p in products]).values_list('name', 'pk'))
+                now = timezone.now()
+                history = []
+                for product in products:
+                    product.pk = ids[product.name]
+                    history.append(PriceHistory(product_id=product.pk, price=product.get_final_price(), created_at=now))
+                PriceHistory.objects.bulk_create(history, batch_size=self.chunk_size)
+                record_price_points([(h.product_id, h.price, now) for h in history])
+                index_products([p.pk for p in products])
+        except Exception as e:
+            # Las categorías y marcas creadas en el bloque se revirtieron con él
+            for mapping, key in created_lookups:
+                mapping.pop(key, None)
+            if not isinstance(e, IntegrityError):
+                raise
+            first_line = chunk[0][0]
+            self.result.add_error(first_line, f'Bloque de filas {first_line}-{chunk[-1][0]} rechazado: {e}')
+            return
+        self.result.created += len(products)
+
+
+def import_products(stream, fmt='csv', chunk_size=DEFAULT_CHUNK_SIZE, create_missing=True):
+    importer = ProductImporter(chunk_size=chunk_size, create_missing=create_missing)
+    return importer.run(read_rows(stream, fmt))
@@ -0,0 +1,62 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import stripe
+from django.core.management.base import BaseCommand
+
+from core.payment_fakes import FakeStripeServer
+from core.payments import PaymentGateway, PaymentUnavailable, _config
+
+
+class Command(BaseCommand):
+    help = 'Mide la pasarela de pagos contra un Stripe simulado local: latencia, reintentos y circuit breaker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=500, help='Llamadas a realizar')
+        parser.add_argument('--concurrency', type=int, default=8, help='Llamadas simultáneas')
+        parser.add_argument('--latency', type=float, default=0.0, help='Segundos que tarda el servidor simulado')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Proporción de respuestas 500 simuladas')
+
+    def handle(self, *args, **options):
+        with FakeStripeServer(latency=options['latency'], error_rate=options['error_rate'], seed=42) as server:
+            config = {**_config(), 'API_BASE': server.url, 'POOL_SIZE': options['concurrency']}
+            gateway = PaymentGateway('sk_test_benchmark', config)
+
+            def pooled(i):
+                gateway.create_payment_intent({'amount': 1000 + i, 'currency': 'clp'}, idempotency_key=f'bench-{i}')
+
+            def unpooled(i):
+                # Lo que hacía el código antes: SDK sin pool compartido, sin reintentos ni timeouts propios
+                client = stripe.StripeClient(
+                    'sk_test_benchmark', base_addresses={'api': server.url},
+                    http_client=stripe.RequestsClient(session=requests.Session()),
+                )
+                client.v1.payment_intents.create({'amount': 1000 + i, 'currency': 'clp'})
+
+            self.stdout.write(f'{"modo":<12}{"llamadas/s":>12}{"p50 (ms)":>10}{"p95 (ms)":>10}{"p99 (ms)":>10}{"fallas":>8}')
+            for name, func in (('sin pool', unpooled), ('pasarela', pooled)):
+                self._run(name, func, options['calls'], options['concurrency'])
+            for operation, stats in gateway.metrics_snapshot().items():
+                self.stdout.write(f'{operation}: {stats}')
+
+    def _run(self, name, func, calls, concurrency):
+        samples, failures = [], 0
+
+        def timed(i):
+            start = time.perf_counter()
+            try:
+                func(i)
+                return (time.perf_counter() - start) * 1000, True
+            except (stripe.error.StripeError, PaymentUnavailable):
+                return (time.perf_counter() - start) * 1000, False
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for elapsed, ok in pool.map(timed, range(calls)):
+                samples.append(elapsed)
+                failures += not ok
+        total = time.perf_counter() - start
+        cuts = statistics.quantiles(samples, n=100)
+        self.stdout.write(f'{name:<12}{calls / total:>12.1f}{cuts[49]:>10.2f}{cuts[94]:>10.2f}{cuts[98]:>10.2f}{failures:>8}')
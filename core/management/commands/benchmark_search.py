@@ -0,0 +1,83 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from core.models import Brand, Category, Product
+from core.search import index_products, search_products
+
+NOUNS = ['Taladro', 'Martillo', 'Sierra', 'Alicate', 'Destornillador', 'Llave', 'Escalera', 'Lijadora',
+         'Linterna', 'Multímetro', 'Rotomartillo', 'Esmeril', 'Huincha', 'Nivel', 'Serrucho', 'Pistola']
+ADJECTIVES = ['Eléctrico', 'Inalámbrico', 'Profesional', 'Compacto', 'Industrial', 'Percutor', 'Telescópica',
+              'Reforzado', 'Magnético', 'Ajustable', 'Digital', 'Angular']
+BRANDS = ['Bosch', 'Makita', 'DeWalt', 'Stanley', 'Truper', 'Bahco', 'Einhell', 'Black+Decker']
+CATEGORIES = ['Herramientas Eléctricas', 'Herramientas Manuales', 'Iluminación', 'Medición', 'Escaleras']
+QUERIES = ['martillo', 'Martíllo', 'taladro bosch', 'sierra inalambrica', 'escaleras', 'multimetro digital']
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compara la búsqueda con icontains contra el índice invertido sobre un catálogo sintético'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000, help='Cantidad de productos sintéticos')
+        parser.add_argument('--repeat', type=int, default=5, help='Repeticiones por consulta')
+        parser.add_argument('--keep', action='store_true', help='Conservar los productos sintéticos')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._run(options['products'], options['repeat'])
+                if not options['keep']:
+                    raise _Rollback
+        except _Rollback:
+            self.stdout.write('Datos sintéticos descartados.')
+
+    def _run(self, total, repeat):
+        rng = random.Random(42)
+        categories = [Category.objects.get_or_create(name=f'Bench {name}'[:30])[0] for name in CATEGORIES]
+        brands = [Brand.objects.get_or_create(name=f'Bench {name}')[0] for name in BRANDS]
+
+        self.stdout.write(f'Creando {total} productos...')
+        start = time.perf_counter()
+        products = []
+        for i in range(total):
+            brand = rng.choice(brands)
+            name = f'{rng.choice(NOUNS)} {rng.choice(ADJECTIVES)} {brand.name[6:]} B{i}'
+            products.append(Product(
+                name=name, slug=f'bench-{i}', code=f'BENCH-{i}',
+                description=f'{name} para uso {rng.choice(ADJECTIVES).lower()} en obra y taller.',
+                category=rng.choice(categories), brand=brand,
+                price=rng.randint(1000, 500000), stock=rng.randint(0, 100),
+            ))
+        Product.objects.bulk_create(products, batch_size=2000)
+        ids = list(Product.objects.filter(code__startswith='BENCH-').values_list('pk', flat=True))
+        index_products(ids)
+        self.stdout.write(f'Catálogo e índice listos en {time.perf_counter() - start:.1f}s')
+
+        self.stdout.write(f'{"consulta":<22}{"icontains (ms)":>16}{"índice (ms)":>14}{"resultados":>12}')
+        for query in QUERIES:
+            scan = self._time(repeat, lambda: list(
+                Product.objects.filter(Q(name__icontains=query) | Q(description__icontains=query))
+                .values_list('pk', flat=True)
+            ))
+            indexed = self._time(repeat, lambda: list(
+                search_products(Product.objects.all(), query).order_by('-search_rank', 'id')
+                .values_list('pk', flat=True)
+            ))
+            hits = search_products(Product.objects.all(), query).count()
+            self.stdout.write(f'{query:<22}{scan:>16.2f}{indexed:>14.2f}{hits:>12}')
+
+    def _time(self, repeat, func):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples)
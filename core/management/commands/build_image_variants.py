@@ -0,0 +1,34 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+
+from core.image_pipeline import DEFAULT_WORKERS, store_variants, variant_job
+from core.imaging import render_variants
+from core.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Genera las variantes WebP/JPEG de las imágenes de producto existentes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Procesos en paralelo')
+        parser.add_argument('--force', action='store_true', help='Regenerar también las que ya tienen variantes')
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True).values_list('pk', 'image', 'image_variants')
+        pending = [
+            (pk, image) for pk, image, variants in products.iterator()
+            if options['force'] or (variants or {}).get('source') != image
+        ]
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {executor.submit(render_variants, *variant_job(pk, image)): (pk, image) for pk, image in pending}
+            for future in as_completed(futures):
+                pk, image = futures[future]
+                try:
+                    store_variants(pk, image, future.result())
+                    done += 1
+                except (OSError, ValueError) as e:
+                    failed += 1
+                    self.stderr.write(f'Producto {pk} ({image}): {e}')
+        self.stdout.write(self.style.SUCCESS(f'Variantes generadas para {done} productos ({failed} con errores).'))
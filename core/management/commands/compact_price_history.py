@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+
+from core.models import PriceHistory, Product
+
+
+class Command(BaseCommand):
+    help = 'Elimina del historial de precios las filas consecutivas con el mismo precio'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Filas eliminadas por DELETE')
+        parser.add_argument('--products-per-scan', type=int, default=500, help='Productos revisados por consulta')
+        parser.add_argument('--dry-run', action='store_true', help='Sólo contar, sin eliminar')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        scanned = removed = 0
+        pending = []
+        last_product_id = 0
+        while True:
+            # Se recorre por rangos de productos para no mantener abierto un cursor enorme
+            product_ids = list(
+                Product.objects.filter(pk__gt=last_product_id).order_by('pk')
+                .values_list('pk', flat=True)[:options['products_per_scan']]
+            )
+            if not product_ids:
+                break
+            last_product_id = product_ids[-1]
+            rows = (
+                PriceHistory.objects.filter(product_id__in=product_ids)
+                .order_by('product_id', 'created_at', 'id')
+                .values_list('id', 'product_id', 'price')
+            )
+            previous = None
+            for history_id, product_id, price in rows:
+                scanned += 1
+                if previous == (product_id, price):
+                    pending.append(history_id)
+                previous = (product_id, price)
+                if len(pending) >= batch_size:
+                    removed += self._delete(pending, dry_run)
+                    pending = []
+        removed += self._delete(pending, dry_run)
+        action = 'eliminarían' if dry_run else 'eliminaron'
+        self.stdout.write(self.style.SUCCESS(f'Revisadas {scanned} filas; se {action} {removed} duplicadas.'))
+
+    def _delete(self, ids, dry_run):
+        if not ids:
+            return 0
+        if dry_run:
+            return len(ids)
+        deleted, _ = PriceHistory.objects.filter(id__in=ids).delete()
+        return deleted
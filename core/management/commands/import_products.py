@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.importers import DEFAULT_CHUNK_SIZE, FORMATS, import_products
+
+
+class Command(BaseCommand):
+    help = 'Importa productos en masa desde un archivo CSV, JSON Lines o JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Archivo a importar')
+        parser.add_argument('--format', choices=FORMATS, help='Formato del archivo (por defecto según la extensión)')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Filas validadas e insertadas por bloque')
+        parser.add_argument('--no-create-missing', action='store_true', help='Rechazar filas con categorías o marcas inexistentes')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if fmt not in FORMATS:
+            raise CommandError(f'Formato no soportado: {fmt}')
+        start = time.perf_counter()
+        try:
+            with open(path, encoding='utf-8-sig', newline='') as stream:
+                result = import_products(
+                    stream, fmt,
+                    chunk_size=options['chunk_size'],
+                    create_missing=not options['no_create_missing'],
+                )
+        except (OSError, ValueError) as e:
+            raise CommandError(f'No se pudo importar {path}: {e}')
+        for line, message in result.errors:
+            self.stderr.write(f'Fila {line}: {message}')
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Importados {result.created} productos en {elapsed:.1f}s ({len(result.errors)} filas con errores).'
+        ))
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.webhooks import drain
+
+
+class Command(BaseCommand):
+    help = 'Procesa los eventos de Stripe pendientes, incluidos los reintentos programados'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Seguir ejecutándose como trabajador en segundo plano')
+        parser.add_argument('--interval', type=int, default=10, help='Segundos entre revisiones con --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = drain()
+            if processed or not options['loop']:
+                self.stdout.write(self.style.SUCCESS(f'Procesados {processed} eventos.'))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from core.models import PriceRollup
+from core.price_history import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recalcula los resúmenes diarios, semanales y mensuales del historial de precios'
+
+    def handle(self, *args, **options):
+        rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(f'Resúmenes recalculados: {PriceRollup.objects.count()} filas.'))
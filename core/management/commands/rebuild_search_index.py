@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from core.models import SearchTerm
+from core.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Reconstruye el índice de búsqueda de productos desde cero'
+
+    def handle(self, *args, **options):
+        rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Índice reconstruido: {SearchTerm.objects.count()} términos.'))
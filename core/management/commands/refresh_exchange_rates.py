@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.exchange_rates import get_service
+
+
+class Command(BaseCommand):
+    help = 'Obtiene las tasas de cambio de la API y guarda la tabla para los procesos web'
+
+    def handle(self, *args, **options):
+        service = get_service()
+        if not service.refresh(force=True):
+            raise CommandError('No se pudieron obtener las tasas de cambio; revisa el log.')
+        table = service.rates()
+        self.stdout.write(self.style.SUCCESS(f'Tasas {table.base} actualizadas: {len(table.rates)} monedas.'))
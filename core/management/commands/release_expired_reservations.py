@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.reservations import RELEASE_BATCH_SIZE, release_expired
+
+
+class Command(BaseCommand):
+    help = 'Libera el stock retenido por reservas de checkout vencidas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=RELEASE_BATCH_SIZE, help='Reservas liberadas por transacción')
+        parser.add_argument('--loop', action='store_true', help='Seguir ejecutándose como barrendero en segundo plano')
+        parser.add_argument('--interval', type=int, default=60, help='Segundos entre barridos con --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_expired(batch_size=options['batch_size'])
+            if released or not options['loop']:
+                self.stdout.write(self.style.SUCCESS(f'Liberadas {released} reservas vencidas.'))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
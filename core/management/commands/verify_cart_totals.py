@@ -0,0 +1,33 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from core.cart_service import cart_totals, refresh_totals
+from core.models import Cart
+
+
+class Command(BaseCommand):
+    help = 'Compara los totales almacenados de los carritos con los calculados desde sus ítems'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Recalcular los carritos con diferencias')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Carritos leídos por consulta')
+
+    def handle(self, *args, **options):
+        expected = cart_totals()
+        rows = (
+            Cart.objects.annotate(expected_count=expected['item_count'], expected_total=expected['total'])
+            .values_list('pk', 'item_count', 'total', 'expected_count', 'expected_total')
+        )
+        checked, drifted = 0, []
+        for pk, item_count, total, expected_count, expected_total in rows.iterator(chunk_size=options['batch_size']):
+            checked += 1
+            # Se normaliza a dos decimales: algunos motores devuelven la suma como float
+            if item_count != expected_count or Decimal(str(total)).quantize(Decimal('0.01')) != Decimal(str(expected_total)).quantize(Decimal('0.01')):
+                drifted.append(pk)
+                self.stderr.write(f'Carrito {pk}: almacenado {item_count} u. / ${total}, calculado {expected_count} u. / ${expected_total}')
+        if drifted and options['fix']:
+            for start in range(0, len(drifted), options['batch_size']):
+                refresh_totals(drifted[start:start + options['batch_size']])
+        action = 'corregidos' if options['fix'] else 'con diferencias'
+        self.stdout.write(self.style.SUCCESS(f'Revisados {checked} carritos; {len(drifted)} {action}.'))
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_search_index(apps, schema_editor):
+    # Indexa los productos existentes con los modelos históricos
+    from core.search import product_terms
+    Product = apps.get_model('core', 'Product')
+    SearchTerm = apps.get_model('core', 'SearchTerm')
+    rows = [
+        SearchTerm(product_id=product.pk, term=term, weight=weight)
+        for product in Product.objects.select_related('category', 'brand').iterator()
+        for term, weight in product_terms(product).items()
+    ]
+    SearchTerm.objects.bulk_create(rows, batch_size=2000)
+
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_address_city'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=40)),
+                ('weight', models.PositiveIntegerField(default=1)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='core.product')),
+            ],
+            options={
+                'verbose_name': 'Término de Búsqueda',
+                'verbose_name_plural': 'Términos de Búsqueda',
+                'indexes': [models.Index(fields=['term', 'product'], name='core_searchterm_term_idx')],
+                'unique_together': {('product', 'term')},
+            },
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
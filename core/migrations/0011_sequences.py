@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:11
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seed_sequences(apps, schema_editor):
+    # Los códigos existentes se derivaron del id (FER-{id}) o de un conteo menor que él
+    # (ORD-{count+1}); empezar tras el id máximo evita repetirlos
+    Sequence = apps.get_model('core', 'Sequence')
+    for name, model_name in (('product', 'Product'), ('order', 'Order')):
+        last = apps.get_model('core', model_name).objects.aggregate(last=Max('pk'))['last'] or 0
+        Sequence.objects.update_or_create(name=name, defaults={'next_value': last + 1})
+
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_stock_reservations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Sequence',
+            fields=[
+                ('name', models.CharField(max_length=30, primary_key=True, serialize=False)),
+                ('next_value', models.BigIntegerField(default=1)),
+            ],
+            options={
+                'verbose_name': 'Secuencia',
+                'verbose_name_plural': 'Secuencias',
+            },
+        ),
+        migrations.RunPython(seed_sequences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:12
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least
+
+
+def backfill_order_totals(apps, schema_editor):
+    # Calcula los totales de las órdenes existentes en un solo UPDATE (ver core/order_totals.py)
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    Coupon = apps.get_model('core', 'Coupon')
+    money = models.DecimalField(max_digits=12, decimal_places=2)
+    items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    subtotal = Coalesce(
+        Subquery(items.annotate(t=Sum(F('quantity') * F('price'))).values('t'), output_field=money),
+        Value(Decimal('0')), output_field=money,
+    )
+    coupon = Coalesce(
+        Subquery(Coupon.objects.filter(pk=OuterRef('coupon_id'), active=True).values('amount')[:1], output_field=money),
+        Value(Decimal('0')), output_field=money,
+    )
+    discount = Greatest(Least(coupon, subtotal, output_field=money), Value(Decimal('0')), output_field=money)
+    Order.objects.update(
+        item_count=Coalesce(Subquery(items.annotate(n=Sum('quantity')).values('n'), output_field=models.IntegerField()), 0),
+        subtotal=subtotal,
+        discount=discount,
+        total=subtotal - discount,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_sequences'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='discount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.RunPython(backfill_order_totals, migrations.RunPython.noop),
+    ]
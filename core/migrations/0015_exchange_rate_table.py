@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_webhook_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRateTable',
+            fields=[
+                ('base', models.CharField(max_length=3, primary_key=True, serialize=False)),
+                ('rates', models.JSONField()),
+                ('fetched_at', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Tabla de tasas de cambio',
+                'verbose_name_plural': 'Tablas de tasas de cambio',
+            },
+        ),
+    ]
@@ -5,11 +5,13 @@ from django_countries.fields import CountryField
 from django.db.models.signals import post_save
 from django.conf import settings
 from django.utils.text import slugify
+from decimal import Decimal
 
 # Modelo para categorías de productos (ej: herramientas, pinturas)
 class Category(models.Model):
     name = models.CharField(max_length=30, unique=True)  # Nombre único de la categoría
     description = models.TextField(blank=True, null=True)  # Descripción opcional
+    updated_at = models.DateTimeField(auto_now=True)  # Usado para ETag/Last-Modified en la API
 
     def __str__(self):
         return self.name
@@ -21,6 +23,7 @@ class Category(models.Model):
 # Modelo para marcas de productos (ej: Bosch, Makita)
 class Brand(models.Model):
     name = models.CharField(max_length=50, unique=True)  # Nombre único de la marca
+    updated_at = models.DateTimeField(auto_now=True)  # Usado para ETag/Last-Modified en la API
 
     def __str__(self):
         return self.name
@@ -39,7 +42,9 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     discount_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
     stock = models.PositiveIntegerField(default=0)
+    reserved = models.PositiveIntegerField(default=0, editable=False)  # Unidades retenidas por checkouts en curso (core.reservations)
     image = models.ImageField(upload_to='products/', blank=True, null=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)  # Generadas por core.image_pipeline
     slug = models.SlugField(unique=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -50,19 +55,74 @@ class Product(models.Model):
     def get_final_price(self):
         return self.discount_price if self.discount_price else self.price
 
+    # Columnas que sólo escriben sus módulos (core.image_pipeline, core.stock) con UPDATE directos
+    MANAGED_FIELDS = ('image_variants', 'reserved')
+
+    @property
+    def available_stock(self):
+        return max(self.stock - self.reserved, 0)
+
+    @property
+    def images(self):
+        # URLs por variante (thumbnail, card, detail) listas para <picture> y srcset.
+        # Mientras no existan las variantes se usa la imagen original.
+        if not self.image:
+            return None
+        url = self.image.storage.url
+        variants = self.image_variants or {}
+        if variants.get('source') != self.image.name:
+            original = {'jpeg': self.image.url, 'webp': None, 'jpeg_srcset': '', 'webp_srcset': '', 'width': None, 'height': None}
+            return {name: original for name in ('thumbnail', 'card', 'detail')}
+        images = {}
+        for name, data in variants.items():
+            if name == 'source':
+                continue
+            files = data['files']
+            images[name] = {
+                'jpeg': url(files[0]['jpeg']),
+                'webp': url(files[0]['webp']),
+                'jpeg_srcset': ', '.join(f"{url(f['jpeg'])} {f['width']}w" for f in files),
+                'webp_srcset': ', '.join(f"{url(f['webp'])} {f['width']}w" for f in files),
+                'width': data['width'],
+                'height': data['height'],
+            }
+        return images
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Precio final con el que se cargó, para registrar historial sólo si cambia
+        if 'price' in field_names and 'discount_price' in field_names:
+            instance._recorded_price = instance.get_final_price()
+        return instance
+
+    def _record_price_change(self, adding):
+        final_price = Decimal(str(self.get_final_price()))
+        previous = getattr(self, '_recorded_price', None)
+        if previous is None and not adding:
+            previous = self.price_history.order_by('-created_at', '-id').values_list('price', flat=True).first()
+        if previous is None or Decimal(str(previous)) != final_price:
+            PriceHistory.objects.create(product=self, price=final_price)
+        self._recorded_price = final_price
+
     def save(self, *args, **kwargs):
+        adding = self._state.adding
+        update_fields = kwargs.get('update_fields')
+        if not adding and update_fields is None:
+            # Un save() completo no pisa las columnas que se escriben con UPDATE propios
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.MANAGED_FIELDS
+            ]
         if not self.code:
-            # Use a temporary code if saving for the first time
-            temp_code = f"FER-{Product.objects.count() + 1:05d}"
-            self.code = temp_code
+            from .sequences import next_code
+            self.code = next_code('product')
         if not self.slug:
             self.slug = slugify(self.name)
         super().save(*args, **kwargs)
-        # Update code with ID after saving
-        if self.code == temp_code:
-            self.code = f"FER-{self.id:05d}"
-            super().save(update_fields=['code'])
-        PriceHistory.objects.create(product=self, price=self.get_final_price())
+        # Sólo se guarda historial cuando cambia el precio final (no por stock, slug, etc.)
+        if update_fields is None or {'price', 'discount_price'}.intersection(update_fields):
+            self._record_price_change(adding)
 
     class Meta:
         verbose_name = 'Producto'
@@ -81,6 +141,47 @@ class PriceHistory(models.Model):
         verbose_name = 'Historial de Precios'
         verbose_name_plural = 'Historial de Precios'
 
+# Modelo para el resumen del historial de precios por periodo (día, semana, mes),
+# mantenido de forma incremental por core/price_history.py
+class PriceRollup(models.Model):
+    PERIOD_CHOICES = (
+        ('day', 'Día'),
+        ('week', 'Semana'),
+        ('month', 'Mes'),
+    )
+    product = models.ForeignKey('Product', on_delete=models.CASCADE, related_name='price_rollups')
+    period = models.CharField(max_length=5, choices=PERIOD_CHOICES)
+    bucket_start = models.DateField()  # Primer día del periodo
+    open = models.DecimalField(max_digits=10, decimal_places=2)
+    high = models.DecimalField(max_digits=10, decimal_places=2)
+    low = models.DecimalField(max_digits=10, decimal_places=2)
+    close = models.DecimalField(max_digits=10, decimal_places=2)
+    first_at = models.DateTimeField()  # Fecha del precio usado como apertura
+    last_at = models.DateTimeField()  # Fecha del precio usado como cierre
+
+    def __str__(self):
+        return f"{self.product_id} {self.period} {self.bucket_start}: {self.close}"
+
+    class Meta:
+        verbose_name = 'Resumen de Precios'
+        verbose_name_plural = 'Resúmenes de Precios'
+        unique_together = ('product', 'period', 'bucket_start')
+
+# Modelo para el índice invertido de búsqueda de productos (ver core/search.py)
+class SearchTerm(models.Model):
+    product = models.ForeignKey('Product', on_delete=models.CASCADE, related_name='search_terms')
+    term = models.CharField(max_length=40)  # Término normalizado (sin tildes, minúsculas)
+    weight = models.PositiveIntegerField(default=1)  # Relevancia del término en el producto
+
+    def __str__(self):
+        return f"{self.term} -> {self.product_id} ({self.weight})"
+
+    class Meta:
+        verbose_name = 'Término de Búsqueda'
+        verbose_name_plural = 'Términos de Búsqueda'
+        unique_together = ('product', 'term')
+        indexes = [models.Index(fields=['term', 'product'], name='core_searchterm_term_idx')]
+
 # Modelo para el perfil de usuario con integración de Stripe
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -121,12 +222,15 @@ class Cart(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='carts')
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
+    # Totales almacenados; los mantiene core.cart_service en cada cambio de ítems
+    item_count = models.PositiveIntegerField(default=0)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
 
     def __str__(self):
         return f"Carrito {self.id} - {self.user.username}"
 
     def get_total(self):
-        return sum(item.get_total_price() for item in self.items.all())
+        return self.total
 
     class Meta:
         verbose_name = 'Carrito'
@@ -148,6 +252,8 @@ class CartItem(models.Model):
     class Meta:
         verbose_name = 'Ítem de Carrito'
         verbose_name_plural = 'Ítems de Carrito'
+        # Un producto aparece una sola vez por carrito; las cantidades se suman en el ítem
+        constraints = [models.UniqueConstraint(fields=['cart', 'product'], name='core_cartitem_unique_cart_product')]
 
 # Modelo para pedidos
 class Order(models.Model):
@@ -169,6 +275,11 @@ class Order(models.Model):
     shipping_address = models.ForeignKey('Address', related_name='shipping_orders', on_delete=models.SET_NULL, blank=True, null=True)
     billing_address = models.ForeignKey('Address', related_name='billing_orders', on_delete=models.SET_NULL, blank=True, null=True)
     coupon = models.ForeignKey('Coupon', on_delete=models.SET_NULL, blank=True, null=True)
+    # Calculados al cerrar la orden por core/order_totals.py
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
+    discount = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
+    item_count = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -176,19 +287,22 @@ class Order(models.Model):
         return f"Orden {self.ref_code} - {self.user.username}"
 
     def get_total(self):
-        total = sum(item.get_total_price() for item in self.items.all())
-        if self.coupon and self.coupon.active:
-            total -= self.coupon.amount
-        return max(total, 0)
+        return self.total
 
     def save(self, *args, **kwargs):
         if not self.ref_code:
-            self.ref_code = f"ORD-{self.id or Order.objects.count() + 1:05d}"
+            from .sequences import next_code
+            self.ref_code = next_code('order')
         super().save(*args, **kwargs)
 
     class Meta:
         verbose_name = 'Orden'
         verbose_name_plural = 'Ordenes'
+        # Listados del personal filtrados por estado y ordenados por fecha (core/tables.py)
+        indexes = [
+            models.Index(fields=['status', 'ordered_date'], name='core_order_status_date_idx'),
+            models.Index(fields=['ordered_date'], name='core_order_date_idx'),
+        ]
 
 # Modelo para ítems de pedido
 class OrderItem(models.Model):
@@ -207,6 +321,28 @@ class OrderItem(models.Model):
         verbose_name = 'Ítem de Orden'
         verbose_name_plural = 'Ítems de Orden'
 
+# Modelo para reservas de stock durante el checkout
+class StockReservation(models.Model):
+    STATUS_CHOICES = (
+        ('active', 'Activa'),
+        ('converted', 'Convertida'),
+        ('released', 'Liberada'),
+    )
+    order = models.ForeignKey('Order', on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey('Product', on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='active')
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Reserva {self.quantity} x {self.product_id} - Orden {self.order_id} ({self.status})"
+
+    class Meta:
+        verbose_name = 'Reserva de Stock'
+        verbose_name_plural = 'Reservas de Stock'
+        indexes = [models.Index(fields=['status', 'expires_at'], name='core_reservation_expiry_idx')]
+
 # Modelo para pagos
 class Payment(models.Model):
     PAYMENT_METHODS = (
@@ -228,6 +364,41 @@ class Payment(models.Model):
     class Meta:
         verbose_name = 'Pago'
         verbose_name_plural = 'Pagos'
+        # Pagos por confirmar y listados por fecha del contador (core/tables.py)
+        indexes = [
+            models.Index(fields=['confirmed', 'created_at'], name='core_payment_confirmed_idx'),
+            models.Index(fields=['created_at'], name='core_payment_date_idx'),
+        ]
+
+# Modelo para los eventos de Stripe recibidos por el webhook. El id del evento es
+# único: un reintento de Stripe no crea una segunda fila. core/webhooks.py los procesa
+class WebhookEvent(models.Model):
+    STATUS_CHOICES = (
+        ('pending', 'Pendiente'),
+        ('processing', 'Procesando'),
+        ('done', 'Procesado'),
+        ('failed', 'Fallido'),
+    )
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    order_id = models.PositiveIntegerField(blank=True, null=True, db_index=True)  # Para procesar en orden los eventos de una misma orden
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    available_at = models.DateTimeField(default=timezone.now)  # No se reintenta antes de esta hora
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.type} ({self.event_id})"
+
+    class Meta:
+        verbose_name = 'Evento de Webhook'
+        verbose_name_plural = 'Eventos de Webhook'
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='core_webhook_queue_idx'),
+        ]
 
 # Modelo para cupones de descuento
 class Coupon(models.Model):
@@ -281,6 +452,33 @@ class Employee(models.Model):
         verbose_name = 'Empleado'
         verbose_name_plural = 'Empleados'
 
+# Modelo para los contadores de códigos legibles (FER-00001, ORD-00001).
+# core/sequences.py reserva bloques de valores de una vez (hi/lo)
+class Sequence(models.Model):
+    name = models.CharField(max_length=30, primary_key=True)
+    next_value = models.BigIntegerField(default=1)  # Primer valor aún no entregado a ningún proceso
+
+    def __str__(self):
+        return f"{self.name}: {self.next_value}"
+
+    class Meta:
+        verbose_name = 'Secuencia'
+        verbose_name_plural = 'Secuencias'
+
+# Última tabla de tasas de cambio obtenida; permite convertir tras un reinicio sin
+# llamar a la API externa (ver core/exchange_rates.py)
+class ExchangeRateTable(models.Model):
+    base = models.CharField(max_length=3, primary_key=True)
+    rates = models.JSONField()  # moneda -> unidades por 1 de la moneda base
+    fetched_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.base} ({self.fetched_at:%Y-%m-%d %H:%M})"
+
+    class Meta:
+        verbose_name = 'Tabla de tasas de cambio'
+        verbose_name_plural = 'Tablas de tasas de cambio'
+
 # Signal para crear UserProfile automáticamente al crear un usuario
 def userprofile_receiver(sender, instance, created, *args, **kwargs):
     if created:
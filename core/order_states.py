@@ -0,0 +1,87 @@
+# Máquina de estados de las órdenes: pending -> approved -> prepared -> delivered.
+# Cada acción se aplica a una lista de órdenes con un único UPDATE filtrado por el
+# estado de origen, así dos empleados procesando el mismo lote no pueden saltarse
+# ni repetir un paso. Una segunda consulta informa el resultado de cada id.
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order
+
+# acción -> (estado de origen, estado de destino)
+TRANSITIONS = {
+    'approve': ('pending', 'approved'),
+    'prepare': ('approved', 'prepared'),
+    'deliver': ('prepared', 'delivered'),
+}
+
+# Acciones permitidas para cada rol de empleado
+ROLE_ACTIONS = {
+    'seller': ('approve',),
+    'warehouse': ('prepare', 'deliver'),
+}
+
+MAX_BULK_TRANSITION = 500
+
+STATUS_LABELS = dict(Order.STATUS_CHOICES)
+
+
+class TransitionError(Exception):
+    pass
+
+
+def allowed_actions(user):
+    employee = getattr(user, 'employee', None)
+    return ROLE_ACTIONS.get(employee.role, ()) if employee else ()
+
+
+def parse_order_ids(values):
+    try:
+        ids = list(dict.fromkeys(int(value) for value in values))
+    except (TypeError, ValueError):
+        raise TransitionError('Los ids de las órdenes deben ser números enteros.')
+    if not ids:
+        raise TransitionError('No se seleccionaron órdenes.')
+    if len(ids) > MAX_BULK_TRANSITION:
+        raise TransitionError(f'Se pueden procesar hasta {MAX_BULK_TRANSITION} órdenes por vez.')
+    return ids
+
+
+class TransitionResult:
+    def __init__(self, action, order_ids):
+        self.action = action
+        self.order_ids = order_ids
+        self.updated = []
+        self.failed = {}  # id -> motivo
+        self.ref_codes = {}
+
+    def as_list(self):
+        return [
+            {'id': pk, 'ok': True} if pk not in self.failed else {'id': pk, 'ok': False, 'error': self.failed[pk]}
+            for pk in self.order_ids
+        ]
+
+
+@transaction.atomic
+def transition(order_ids, action):
+    if action not in TRANSITIONS:
+        raise TransitionError(f'Acción desconocida: {action}')
+    source, target = TRANSITIONS[action]
+    order_ids = parse_order_ids(order_ids)
+    result = TransitionResult(action, order_ids)
+    # El mismo instante marca las filas que cambió este UPDATE; quedan bloqueadas
+    # hasta el commit, así que la lectura siguiente no ve cambios de otros
+    now = timezone.now()
+    Order.objects.filter(pk__in=order_ids, status=source).update(status=target, updated_at=now)
+    current = {}
+    for pk, status, updated_at, ref_code in Order.objects.filter(pk__in=order_ids).values_list('pk', 'status', 'updated_at', 'ref_code'):
+        current[pk] = (status, updated_at)
+        result.ref_codes[pk] = ref_code
+    for pk in order_ids:
+        if pk not in current:
+            result.failed[pk] = 'La orden no existe.'
+        elif current[pk] == (target, now):
+            result.updated.append(pk)
+        else:
+            status = current[pk][0]
+            result.failed[pk] = f'Estado actual "{STATUS_LABELS.get(status, status)}"; se requiere "{STATUS_LABELS[source]}".'
+    return result
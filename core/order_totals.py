@@ -0,0 +1,39 @@
+# Totales almacenados de las órdenes: subtotal, descuento del cupón, total y unidades.
+# Se calculan una sola vez al cerrar la orden (con sus ítems ya creados) en un único
+# UPDATE, así los listados del personal no recorren ítems ni cupones por fila.
+from decimal import Decimal
+
+from django.db.models import DecimalField, F, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
+
+from .models import Coupon, Order, OrderItem
+
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+
+
+def order_totals():
+    # Expresiones por orden (para UPDATE o annotate sobre Order) calculadas desde sus ítems
+    items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    subtotal = Coalesce(
+        Subquery(items.annotate(t=Sum(F('quantity') * F('price'))).values('t'), output_field=MONEY),
+        Value(Decimal('0')), output_field=MONEY,
+    )
+    # Sólo descuentan los cupones activos y nunca más que el subtotal
+    coupon = Coalesce(
+        Subquery(Coupon.objects.filter(pk=OuterRef('coupon_id'), active=True).values('amount')[:1], output_field=MONEY),
+        Value(Decimal('0')), output_field=MONEY,
+    )
+    discount = Greatest(Least(coupon, subtotal, output_field=MONEY), Value(Decimal('0')), output_field=MONEY)
+    return {
+        'item_count': Coalesce(Subquery(items.annotate(n=Sum('quantity')).values('n'), output_field=IntegerField()), 0),
+        'subtotal': subtotal,
+        'discount': discount,
+        'total': subtotal - discount,
+    }
+
+
+def finalize_totals(order_ids):
+    if isinstance(order_ids, (int, Order)):
+        order_ids = [order_ids.pk if isinstance(order_ids, Order) else order_ids]
+    return Order.objects.filter(pk__in=order_ids).update(**order_totals(), updated_at=timezone.now())
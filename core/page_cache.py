@@ -0,0 +1,243 @@
+# Caché de páginas del catálogo con invalidación por etiquetas (tags).
+# Cada respuesta se guarda junto a la versión de sus etiquetas al momento de
+# renderizarla; invalidar una etiqueta le asigna una versión nueva, con lo que
+# todas las páginas que la usaban dejan de ser válidas sin tener que buscarlas.
+# El almacenamiento es intercambiable (PAGE_CACHE['BACKEND'] en settings):
+# LRUBackend guarda en memoria del proceso y DjangoCacheBackend usa un alias de
+# CACHES (por ejemplo memcached o redis local compartido entre workers).
+import hashlib
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils.module_loading import import_string
+
+from .models import Brand, Category, Product
+from .session_cart import COOKIE_NAME as CART_COOKIE_NAME
+
+DEFAULT_TIMEOUT = 60 * 5
+CSRF_PLACEHOLDER = '__page_cache_csrf_token__'
+CSRF_INPUT_RE = re.compile(r'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+
+
+class LRUBackend:
+    # Caché en memoria del proceso con expulsión LRU y expiración por entrada
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                item = self._data.get(key)
+                if item is None:
+                    continue
+                value, expires = item
+                if expires is not None and expires < now:
+                    del self._data[key]
+                    continue
+                self._data.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, mapping, timeout=None):
+        expires = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            for key, value in mapping.items():
+                self._data[key] = (value, expires)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoCacheBackend:
+    # Usa un alias de CACHES como almacenamiento compartido entre procesos
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set_many(self, mapping, timeout=None):
+        self.cache.set_many(mapping, timeout)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class PageCache:
+    def __init__(self, backend, timeout=DEFAULT_TIMEOUT):
+        self.backend = backend
+        self.timeout = timeout
+
+    def _tag_keys(self, tags):
+        return {f'page_cache:tag:{tag}': tag for tag in tags}
+
+    def get(self, key, tags):
+        tag_keys = self._tag_keys(tags)
+        found = self.backend.get_many([key, *tag_keys])
+        entry = found.get(key)
+        if entry is None:
+            return None
+        for tag_key, tag in tag_keys.items():
+            if found.get(tag_key) is None or found[tag_key] != entry['tags'].get(tag):
+                return None
+        return entry
+
+    def set(self, key, content, content_type, tags):
+        tag_keys = self._tag_keys(tags)
+        versions = self.backend.get_many(list(tag_keys))
+        missing = {tag_key: uuid.uuid4().hex for tag_key in tag_keys if tag_key not in versions}
+        if missing:
+            self.backend.set_many(missing)
+            versions.update(missing)
+        entry = {
+            'content': content,
+            'content_type': content_type,
+            'tags': {tag: versions[tag_key] for tag_key, tag in tag_keys.items()},
+        }
+        self.backend.set_many({key: entry}, self.timeout)
+
+    def invalidate(self, *tags):
+        self.backend.set_many({tag_key: uuid.uuid4().hex for tag_key in self._tag_keys(tags)})
+
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+
+def get_page_cache():
+    global _page_cache
+    if _page_cache is None:
+        with _page_cache_lock:
+            if _page_cache is None:
+                config = getattr(settings, 'PAGE_CACHE', {})
+                backend_class = import_string(config.get('BACKEND', 'core.page_cache.LRUBackend'))
+                _page_cache = PageCache(backend_class(**config.get('OPTIONS', {})), config.get('TIMEOUT', DEFAULT_TIMEOUT))
+    return _page_cache
+
+
+def invalidate_tags(*tags):
+    get_page_cache().invalidate(*tags)
+
+
+def invalidate_products(product_ids):
+    # Para escrituras masivas (queryset.update) que no disparan los signals de Product
+    rows = Product.objects.filter(pk__in=product_ids).values_list('slug', 'category_id')
+    tags = {'catalog:all'}
+    for slug, category_id in rows:
+        tags.update({f'product:{slug}', f'catalog:category:{category_id}'})
+    invalidate_tags(*tags)
+
+
+def _cacheable(request):
+    # Sólo tráfico anónimo de lectura, sin carrito propio y sin mensajes pendientes por mostrar
+    return (
+        request.method in ('GET', 'HEAD')
+        and not request.user.is_authenticated
+        and CART_COOKIE_NAME not in request.COOKIES  # El menú muestra su carrito
+        and len(get_messages(request)) == 0
+    )
+
+
+def _page_key(view_name, request):
+    query = '&'.join(sorted(request.GET.urlencode().split('&')))
+    raw = f'{view_name}|{request.path}|{query}'
+    return f'page_cache:page:{hashlib.sha1(raw.encode()).hexdigest()}'
+
+
+def cache_page_with_tags(get_tags):
+    # Decorador de vistas: get_tags(request, *args, **kwargs) devuelve las etiquetas
+    # de la página. El token CSRF se reemplaza por uno propio de cada visitante.
+    def decorator(view):
+        view_name = f'{view.__module__}.{view.__name__}'
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not _cacheable(request):
+                return view(request, *args, **kwargs)
+            cache = get_page_cache()
+            key = _page_key(view_name, request)
+            tags = get_tags(request, *args, **kwargs)
+            entry = cache.get(key, tags)
+            if entry is not None:
+                content = entry['content'].replace(CSRF_PLACEHOLDER, get_token(request))
+                response = HttpResponse(content, content_type=entry['content_type'])
+                response['X-Page-Cache'] = 'hit'
+                return response
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming and not response.cookies:
+                content = CSRF_INPUT_RE.sub(rf'\g<1>{CSRF_PLACEHOLDER}\g<2>', response.content.decode(response.charset))
+                cache.set(key, content, response['Content-Type'], tags)
+                response['X-Page-Cache'] = 'miss'
+            return response
+        return wrapper
+    return decorator
+
+
+# Etiquetas usadas por las vistas del catálogo
+def catalog_tags(request, *args, **kwargs):
+    # Las facetas de una página filtrada cuentan productos de otras categorías y
+    # marcas: catalog:facets se invalida cuando cambia cualquiera de esos conteos
+    category_id = request.GET.get('category')
+    return ['catalog', 'catalog:facets', f'catalog:category:{category_id}' if category_id else 'catalog:all']
+
+
+def index_tags(request, *args, **kwargs):
+    return ['catalog', 'catalog:all']
+
+
+def product_tags(request, slug, *args, **kwargs):
+    return ['catalog', f'product:{slug}']
+
+
+# Signals de invalidación: un producto afecta su detalle, el catálogo general y
+# las páginas de su categoría (la anterior y la nueva si cambió). Si entra, sale o
+# cambia lo que cuentan las facetas (categoría, marca o el texto que se busca),
+# también todas las páginas filtradas.
+FACET_FIELDS = ('category_id', 'brand_id', 'name', 'description')
+
+
+def product_pre_save_receiver(sender, instance, **kwargs):
+    instance._page_cache_previous = None
+    if instance.pk:
+        instance._page_cache_previous = Product.objects.filter(pk=instance.pk).values('slug', *FACET_FIELDS).first()
+
+
+def product_changed_receiver(sender, instance, signal=None, **kwargs):
+    tags = {'catalog:all', f'product:{instance.slug}', f'catalog:category:{instance.category_id}'}
+    previous = getattr(instance, '_page_cache_previous', None)
+    if previous:
+        tags.update({f'product:{previous["slug"]}', f'catalog:category:{previous["category_id"]}'})
+    if signal is post_delete or not previous or any(previous[name] != getattr(instance, name) for name in FACET_FIELDS):
+        tags.add('catalog:facets')
+    invalidate_tags(*tags)
+
+
+def taxonomy_changed_receiver(sender, instance, **kwargs):
+    # Los nombres de categorías y marcas aparecen en todas las páginas del catálogo
+    invalidate_tags('catalog')
+
+
+pre_save.connect(product_pre_save_receiver, sender=Product)
+post_save.connect(product_changed_receiver, sender=Product)
+post_delete.connect(product_changed_receiver, sender=Product)
+for model in (Category, Brand):
+    post_save.connect(taxonomy_changed_receiver, sender=model, dispatch_uid=f'page_cache_save_{model.__name__}')
+    post_delete.connect(taxonomy_changed_receiver, sender=model, dispatch_uid=f'page_cache_delete_{model.__name__}')
@@ -0,0 +1,204 @@
+# Paginación por keyset (cursor) para el catálogo HTML y la API de productos.
+# En vez de OFFSET, cada página filtra por los valores de ordenamiento del último
+# elemento visto, de modo que una página profunda cuesta lo mismo que la primera.
+# Los cursores son opacos (JSON en base64) y el tamaño de página está acotado.
+import base64
+import binascii
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import DecimalField, Q, Value
+from django.db.models.functions import Coalesce, NullIf
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+# Precio final igual a Product.get_final_price(): discount_price si existe y no es cero
+FINAL_PRICE = Coalesce(NullIf('discount_price', Value(0)), 'price', output_field=DecimalField(max_digits=10, decimal_places=2))
+
+# Ordenamientos permitidos para productos; el último campo debe ser único
+PRODUCT_ORDERINGS = {
+    'newest': ('-id',),
+    'oldest': ('id',),
+    'price': ('final_price', 'id'),
+    '-price': ('-final_price', '-id'),
+}
+SEARCH_ORDERING = ('-search_rank', 'id')
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def with_final_price(queryset):
+    return queryset.annotate(final_price=FINAL_PRICE)
+
+
+def encode_cursor(ordering, values, reverse=False):
+    payload = {'o': list(ordering), 'v': [str(value) for value in values], 'r': int(reverse)}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, ordering, fields=None):
+    # fields: campo del modelo (o output_field de la anotación) de cada columna del
+    # ordenamiento; cada valor se convierte a su tipo para que un cursor manipulado
+    # falle aquí y no al ejecutar la consulta
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        values, reverse = payload['v'], bool(payload['r'])
+    except (ValueError, KeyError, TypeError, AttributeError, binascii.Error):
+        raise InvalidCursor('Cursor inválido')
+    if payload.get('o') != list(ordering) or not isinstance(values, list) or len(values) != len(ordering):
+        raise InvalidCursor('El cursor no corresponde al ordenamiento')
+    if fields is not None:
+        try:
+            values = [field.to_python(value) for field, value in zip(fields, values)]
+        except (ValidationError, ValueError, TypeError):
+            raise InvalidCursor('Cursor inválido')
+    return values, reverse
+
+
+def clamp_page_size(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, maximum))
+
+
+class KeysetPage:
+    def __init__(self, items, ordering, has_next, has_previous):
+        self.items = items
+        self.ordering = ordering
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _values(self, obj):
+        return [getattr(obj, field.lstrip('-')) for field in self.ordering]
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+        return encode_cursor(self.ordering, self._values(self.items[-1]))
+
+    @property
+    def previous_cursor(self):
+        if not self.has_previous or not self.items:
+            return None
+        return encode_cursor(self.ordering, self._values(self.items[0]), reverse=True)
+
+
+class KeysetPaginator:
+    def __init__(self, queryset, ordering, page_size=DEFAULT_PAGE_SIZE):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.page_size = page_size
+
+    def _fields(self):
+        fields = []
+        for field in self.ordering:
+            name = field.lstrip('-')
+            annotation = self.queryset.query.annotations.get(name)
+            try:
+                fields.append(annotation.output_field if annotation is not None else self.queryset.model._meta.get_field(name))
+            except FieldDoesNotExist:
+                fields.append(None)
+        return None if None in fields else fields
+
+    def _seek(self, values, reverse):
+        # (a, b) > (x, y) se expresa como a > x OR (a = x AND b > y) para respetar
+        # la dirección de cada campo y poder usar los índices.
+        condition = Q()
+        equal = {}
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            descending = field.startswith('-') != reverse
+            lookup = f'{name}__lt' if descending else f'{name}__gt'
+            condition |= Q(**equal, **{lookup: value})
+            equal[name] = value
+        return condition
+
+    def get_page(self, cursor=None):
+        reverse = False
+        queryset = self.queryset
+        if cursor:
+            values, reverse = decode_cursor(cursor, self.ordering, self._fields())
+            queryset = queryset.filter(self._seek(values, reverse))
+        ordering = self.ordering
+        if reverse:
+            ordering = tuple(field[1:] if field.startswith('-') else f'-{field}' for field in ordering)
+        rows = list(queryset.order_by(*ordering)[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+            return KeysetPage(rows, self.ordering, has_next=True, has_previous=has_more)
+        return KeysetPage(rows, self.ordering, has_next=has_more, has_previous=bool(cursor))
+
+
+class KeysetPagination(BasePagination):
+    # Paginación DRF por keyset: ?cursor=<opaco>&page_size=<n>&ordering=<clave>
+    page_size = DEFAULT_PAGE_SIZE
+    max_page_size = MAX_PAGE_SIZE
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    ordering_query_param = 'ordering'
+    orderings = {'newest': ('-id',), 'oldest': ('id',)}
+    default_ordering = 'newest'
+
+    def prepare_queryset(self, queryset):
+        return queryset
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        ordering = self.orderings.get(request.query_params.get(self.ordering_query_param), self.orderings[self.default_ordering])
+        page_size = clamp_page_size(request.query_params.get(self.page_size_query_param), self.page_size, self.max_page_size)
+        paginator = KeysetPaginator(self.prepare_queryset(queryset), ordering, page_size)
+        try:
+            self.page = paginator.get_page(request.query_params.get(self.cursor_query_param))
+        except InvalidCursor as e:
+            raise NotFound(str(e))
+        return self.page.items
+
+    def _link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self._link(self.page.next_cursor),
+            'previous': self._link(self.page.previous_cursor),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class ProductPagination(KeysetPagination):
+    orderings = PRODUCT_ORDERINGS
+
+    def prepare_queryset(self, queryset):
+        return with_final_price(queryset)
@@ -0,0 +1,119 @@
+# Servidor HTTP local que imita la API de Stripe, para pruebas y benchmarks de
+# core.payments sin salir a internet. Responde customers, payment_intents y
+# checkout/sessions, respeta las claves de idempotencia como Stripe (misma clave,
+# misma respuesta) y permite simular latencia y errores 5xx.
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+OBJECTS = {
+    '/v1/customers': ('customer', 'cus'),
+    '/v1/payment_intents': ('payment_intent', 'pi'),
+    '/v1/checkout/sessions': ('checkout.session', 'cs_test'),
+}
+
+
+def unflatten(pairs):
+    # metadata[order_id]=5 -> {'metadata': {'order_id': '5'}}; los índices de listas quedan como claves
+    result = {}
+    for key, value in pairs:
+        parts = key.replace(']', '').split('[')
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return result
+
+
+class FakeStripeServer:
+    def __init__(self, latency=0, error_rate=0, seed=None):
+        self.latency = latency  # Segundos de espera antes de responder
+        self.error_rate = error_rate  # Proporción de respuestas 500 al azar
+        self.requests = []  # (ruta, parámetros, clave de idempotencia) recibidos
+        self._failures = []  # Códigos de estado forzados para las próximas respuestas
+        self._responses = {}  # clave de idempotencia -> (estado, cuerpo)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def fail(self, count=1, status=500):
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, como la API real
+            wbufsize = 1 << 16  # Cabeceras y cuerpo en un solo envío
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                status, payload, replayed = fake.handle(self.path, unflatten(parse_qsl(body)), self.headers.get('Idempotency-Key'))
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                if replayed:
+                    self.send_header('Idempotent-Replayed', 'true')
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handle(self, path, params, idempotency_key):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests.append((path, params, idempotency_key))
+            if self._failures or (self.error_rate and self._random.random() < self.error_rate):
+                status = self._failures.pop(0) if self._failures else 500
+                return status, {'error': {'type': 'api_error', 'message': 'Falla simulada'}}, False
+            if idempotency_key in self._responses:
+                return (*self._responses[idempotency_key], True)
+            if path not in OBJECTS:
+                return 404, {'error': {'type': 'invalid_request_error', 'message': f'Ruta desconocida: {path}'}}, False
+            kind, prefix = OBJECTS[path]
+            obj_id = f'{prefix}_{uuid.uuid4().hex[:24]}'
+            payload = {'id': obj_id, 'object': kind, 'livemode': False, **params}
+            if kind == 'payment_intent':
+                payload.update(client_secret=f'{obj_id}_secret_{uuid.uuid4().hex[:12]}', status='requires_payment_method')
+            elif kind == 'checkout.session':
+                payload.update(url=f'https://checkout.stripe.com/c/pay/{obj_id}', status='open')
+            if idempotency_key:
+                self._responses[idempotency_key] = (200, payload)
+            return 200, payload, False
+
+    def count(self, path):
+        with self._lock:
+            return sum(1 for request_path, _, _ in self.requests if request_path == path)
@@ -0,0 +1,234 @@
+# Pasarela de pagos: todas las llamadas salientes a Stripe pasan por aquí.
+# Un único StripeClient por proceso reutiliza conexiones keep-alive de un pool de
+# requests, cada operación tiene su propio tiempo límite y las creaciones llevan
+# una clave de idempotencia, así un reintento nunca duplica un cobro o una sesión.
+# Los errores transitorios (conexión, tiempo agotado, 429, 5xx) se reintentan con
+# espera exponencial con jitter; si se acumulan, el circuit breaker se abre y las
+# llamadas fallan de inmediato con PaymentUnavailable en lugar de dejar a los
+# workers esperando a un Stripe caído. Cada operación registra sus latencias.
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+import requests
+import stripe
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUTS = {  # Segundos de lectura por operación
+    'customer': 5,
+    'payment_intent': 10,
+    'checkout_session': 10,
+}
+DEFAULTS = {
+    'API_BASE': None,  # p. ej. la URL de FakeStripeServer en pruebas y benchmarks
+    'CONNECT_TIMEOUT': 3,
+    'TIMEOUTS': DEFAULT_TIMEOUTS,
+    'POOL_SIZE': 10,
+    'MAX_RETRIES': 2,
+    'BACKOFF': 0.25,  # Base de la espera entre reintentos; se duplica en cada intento
+    'MAX_BACKOFF': 2,
+    'BREAKER_THRESHOLD': 5,  # Fallas seguidas que abren el circuito
+    'BREAKER_RESET': 30,  # Segundos abierto antes de dejar pasar una llamada de prueba
+}
+LATENCY_SAMPLES = 1000
+
+TRANSIENT_ERRORS = (stripe.error.APIConnectionError, stripe.error.RateLimitError, stripe.error.APIError)
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+class PaymentUnavailable(stripe.error.StripeError):
+    # Stripe no responde: circuito abierto o reintentos agotados
+    pass
+
+
+def _config():
+    config = {**DEFAULTS, **getattr(settings, 'PAYMENT_GATEWAY', {})}
+    config['TIMEOUTS'] = {**DEFAULT_TIMEOUTS, **config['TIMEOUTS']}
+    return config
+
+
+def is_transient(error):
+    if isinstance(error, stripe.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+class CircuitBreaker:
+    # closed: todo pasa. open: todo falla de inmediato hasta reset_timeout.
+    # half_open: deja pasar una sola llamada; si sale bien se cierra, si no vuelve a abrirse.
+    def __init__(self, threshold, reset_timeout, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'open' if self.clock() - self.opened_at < self.reset_timeout else 'half_open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'open' or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                if self.opened_at is None or self._probing:
+                    logger.warning(f'Circuito de pagos abierto tras {self.failures} fallas')
+                self.opened_at = self.clock()
+            self._probing = False
+
+
+class LatencyStats:
+    # Latencias recientes y contadores de una operación
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.samples = deque(maxlen=samples)
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, ok):
+        with self._lock:
+            self.samples.append(seconds)
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+
+    def count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            samples = sorted(self.samples)
+            counters = {'calls': self.calls, 'errors': self.errors, 'retries': self.retries, 'rejected': self.rejected}
+
+        def percentile(p):
+            return round(samples[min(int(len(samples) * p), len(samples) - 1)] * 1000, 1) if samples else None
+
+        return {**counters, 'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99),
+                'max_ms': round(samples[-1] * 1000, 1) if samples else None}
+
+
+class PaymentGateway:
+    def __init__(self, api_key, config=None, sleep=time.sleep):
+        self.config = config or _config()
+        self.api_key = api_key
+        self.sleep = sleep
+        self.breaker = CircuitBreaker(self.config['BREAKER_THRESHOLD'], self.config['BREAKER_RESET'])
+        self.metrics = {}
+        self._metrics_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.config['POOL_SIZE'])
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+    def client(self, operation):
+        # Un StripeClient por tiempo límite, todos sobre la misma sesión (mismo pool)
+        timeout = (self.config['CONNECT_TIMEOUT'], self.config['TIMEOUTS'][operation])
+        with self._clients_lock:
+            if timeout not in self._clients:
+                base = {'api': self.config['API_BASE']} if self.config['API_BASE'] else None
+                self._clients[timeout] = stripe.StripeClient(
+                    self.api_key,
+                    base_addresses=base,
+                    http_client=stripe.RequestsClient(timeout=timeout, session=self.session),
+                    max_network_retries=0,  # Los reintentos los maneja call()
+                )
+            return self._clients[timeout]
+
+    def stats(self, operation):
+        with self._metrics_lock:
+            return self.metrics.setdefault(operation, LatencyStats())
+
+    def metrics_snapshot(self):
+        with self._metrics_lock:
+            operations = dict(self.metrics)
+        return {'breaker': self.breaker.state, **{name: stats.snapshot() for name, stats in operations.items()}}
+
+    def backoff(self, attempt):
+        # Espera exponencial con jitter completo: evita que los workers reintenten a la vez
+        return random.uniform(0, min(self.config['MAX_BACKOFF'], self.config['BACKOFF'] * 2 ** attempt))
+
+    def call(self, operation, method, params, idempotency_key=None):
+        # method: función del servicio de StripeClient, p. ej. lambda c: c.v1.customers.create
+        options = {'idempotency_key': idempotency_key or f'{operation}-{uuid.uuid4()}'}
+        stats = self.stats(operation)
+        attempts = self.config['MAX_RETRIES'] + 1
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                stats.count('rejected')
+                raise PaymentUnavailable('La pasarela de pago no está disponible, intenta nuevamente en unos minutos.')
+            start = time.perf_counter()
+            try:
+                result = method(self.client(operation))(params, options)
+            except stripe.error.StripeError as e:
+                stats.record(time.perf_counter() - start, ok=False)
+                if not is_transient(e):
+                    self.breaker.record_success()  # Stripe respondió: el error es de la solicitud
+                    raise
+                self.breaker.record_failure()
+                if attempt == attempts - 1:
+                    raise PaymentUnavailable(f'Stripe no respondió tras {attempts} intentos: {e}') from e
+                stats.count('retries')
+                delay = self.backoff(attempt)
+                logger.warning(f'Reintentando {operation} en {delay:.2f}s: {e}')
+                self.sleep(delay)
+            else:
+                stats.record(time.perf_counter() - start, ok=True)
+                self.breaker.record_success()
+                return result
+
+    def create_customer(self, params, idempotency_key=None):
+        return self.call('customer', lambda c: c.v1.customers.create, params, idempotency_key)
+
+    def create_payment_intent(self, params, idempotency_key=None):
+        return self.call('payment_intent', lambda c: c.v1.payment_intents.create, params, idempotency_key)
+
+    def create_checkout_session(self, params, idempotency_key=None):
+        return self.call('checkout_session', lambda c: c.v1.checkout.sessions.create, params, idempotency_key)
+
+
+def get_gateway():
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = PaymentGateway(settings.STRIPE_SECRET_KEY)
+        return _gateway
+
+
+def reset_gateway():
+    # Descarta la pasarela del proceso (p. ej. tras cambiar PAYMENT_GATEWAY en pruebas)
+    global _gateway
+    with _gateway_lock:
+        _gateway = None
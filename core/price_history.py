@@ -0,0 +1,109 @@
+# Historial de precios agrupado por periodo (día, semana, mes) en formato OHLC.
+# Cada nuevo PriceHistory actualiza los tres resúmenes de su producto, de modo que
+# la API lee unas pocas filas de PriceRollup en vez de todo el historial crudo.
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from .models import PriceHistory, PriceRollup
+
+PERIODS = ('day', 'week', 'month')
+ROLLUP_BATCH_SIZE = 1000
+MAX_BUCKETS = 1000
+LOOKUP_CHUNK_SIZE = 500  # Productos por consulta al buscar resúmenes existentes
+
+
+def bucket_start(period, moment):
+    day = timezone.localtime(moment).date() if isinstance(moment, datetime) else moment
+    if period == 'week':
+        return day - timedelta(days=day.weekday())  # Lunes de esa semana
+    if period == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _existing_rollups(keys):
+    # Resúmenes ya guardados para las claves (producto, periodo, inicio). Se buscan por
+    # tandas de productos y rango de fechas, y se cruzan en memoria: un OR por clave
+    # produce sentencias enormes y supera el límite de profundidad de SQLite.
+    product_ids = sorted({product_id for product_id, _, _ in keys})
+    starts = [start for _, _, start in keys]
+    existing = {}
+    for i in range(0, len(product_ids), LOOKUP_CHUNK_SIZE):
+        rollups = PriceRollup.objects.select_for_update().filter(
+            product_id__in=product_ids[i:i + LOOKUP_CHUNK_SIZE], bucket_start__gte=min(starts), bucket_start__lte=max(starts),
+        )
+        for rollup in rollups:
+            key = (rollup.product_id, rollup.period, rollup.bucket_start)
+            if key in keys:
+                existing[key] = rollup
+    return existing
+
+
+def record_price_points(points):
+    # points: iterable de (product_id, price, created_at). Agrupa primero en memoria
+    # y luego combina con los resúmenes existentes en una consulta y dos escrituras.
+    buckets = {}
+    for product_id, price, created_at in sorted(points, key=lambda p: (p[0], p[2])):
+        for period in PERIODS:
+            key = (product_id, period, bucket_start(period, created_at))
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = {'open': price, 'high': price, 'low': price, 'close': price, 'first_at': created_at, 'last_at': created_at}
+            else:
+                bucket['high'] = max(bucket['high'], price)
+                bucket['low'] = min(bucket['low'], price)
+                bucket['close'], bucket['last_at'] = price, created_at
+    if not buckets:
+        return
+
+    with transaction.atomic():
+        existing = _existing_rollups(buckets)
+        to_create, to_update = [], []
+        for key, bucket in buckets.items():
+            rollup = existing.get(key)
+            if rollup is None:
+                to_create.append(PriceRollup(product_id=key[0], period=key[1], bucket_start=key[2], **bucket))
+                continue
+            rollup.high = max(rollup.high, bucket['high'])
+            rollup.low = min(rollup.low, bucket['low'])
+            if bucket['first_at'] < rollup.first_at:
+                rollup.open, rollup.first_at = bucket['open'], bucket['first_at']
+            if bucket['last_at'] >= rollup.last_at:
+                rollup.close, rollup.last_at = bucket['close'], bucket['last_at']
+            to_update.append(rollup)
+        PriceRollup.objects.bulk_create(to_create, batch_size=ROLLUP_BATCH_SIZE)
+        PriceRollup.objects.bulk_update(to_update, ['open', 'high', 'low', 'close', 'first_at', 'last_at'], batch_size=ROLLUP_BATCH_SIZE)
+
+
+def rebuild_rollups(batch_size=ROLLUP_BATCH_SIZE * 10):
+    # Recalcula todos los resúmenes recorriendo el historial crudo por lotes
+    PriceRollup.objects.all().delete()
+    batch = []
+    rows = PriceHistory.objects.order_by('product_id', 'created_at').values_list('product_id', 'price', 'created_at')
+    for row in rows.iterator(chunk_size=batch_size):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            record_price_points(batch)
+            batch = []
+    record_price_points(batch)
+
+
+def price_buckets(product, period, start, end):
+    # Resúmenes del producto cuyos periodos se cruzan con el rango de fechas [start, end]
+    return (
+        PriceRollup.objects
+        .filter(product=product, period=period, bucket_start__gte=bucket_start(period, start), bucket_start__lte=end)
+        .order_by('bucket_start')
+        .values('bucket_start', 'open', 'high', 'low', 'close')[:MAX_BUCKETS]
+    )
+
+
+def price_history_receiver(sender, instance, created, **kwargs):
+    if created:
+        record_price_points([(instance.product_id, instance.price, instance.created_at)])
+
+
+post_save.connect(price_history_receiver, sender=PriceHistory)
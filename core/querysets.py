@@ -0,0 +1,33 @@
+# Consultas de los paneles del personal. Cada una trae en la misma consulta (o en
+# un prefetch fijo) todo lo que recorre su plantilla, así el número de consultas
+# de la página no depende de cuántas filas muestra. Los totales de las órdenes
+# salen de las columnas almacenadas (ver core/order_totals.py).
+from django.contrib.auth.models import User
+from django.db.models import Prefetch
+
+from .models import Order, OrderItem, Payment, Refund
+
+
+def staff_orders(statuses=None):
+    orders = Order.objects.select_related('user')
+    if statuses:
+        orders = orders.filter(status__in=statuses)
+    return orders
+
+
+def order_with_items():
+    return Order.objects.select_related('user').prefetch_related(
+        Prefetch('items', queryset=OrderItem.objects.select_related('product').order_by('id'))
+    )
+
+
+def staff_payments():
+    return Payment.objects.select_related('order', 'confirmed_by')
+
+
+def staff_refunds():
+    return Refund.objects.select_related('order')
+
+
+def staff_users():
+    return User.objects.select_related('employee').order_by('id')
@@ -0,0 +1,98 @@
+# Reservas de stock para el checkout.
+# Al crear la sesión de pago se retienen las unidades de todas las líneas con un
+# único UPDATE condicional (ver core/stock.py); si alguna no alcanza, la
+# transacción se revierte completa. Las reservas vencen tras RESERVATION_TTL y las
+# libera el comando release_expired_reservations; al confirmarse el pago se
+# convierten en un descuento real del stock. Las reservas convertidas son el
+# registro de qué unidades de cada orden ya salieron de Product.stock.
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import stock
+from .models import OrderItem, StockReservation
+from .stock import OutOfStock, quantities_by_product
+
+DEFAULT_TTL = 60 * 30  # Stripe exige al menos 30 minutos de vigencia para una sesión
+RELEASE_BATCH_SIZE = 500
+
+ReservationError = OutOfStock  # Nombre histórico; lleva .products con los nombres sin stock
+
+
+def reservation_ttl():
+    return timedelta(seconds=getattr(settings, 'STOCK_RESERVATION_TTL', DEFAULT_TTL))
+
+
+def reserve_order(order, lines=None):
+    # lines: iterable de (product_id, cantidad); por defecto los ítems de la orden
+    if lines is None:
+        lines = order.items.values_list('product_id', 'quantity')
+    quantities = quantities_by_product(lines)
+    if not quantities:
+        return []
+    expires_at = timezone.now() + reservation_ttl()
+    with transaction.atomic():
+        stock.hold(quantities)
+        return StockReservation.objects.bulk_create([
+            StockReservation(order=order, product_id=product_id, quantity=quantity, expires_at=expires_at)
+            for product_id, quantity in quantities.items()
+        ])
+
+
+def _release(reservation_ids, status):
+    # Devuelve las unidades de un conjunto de reservas activas bloqueadas por el llamador
+    quantities = quantities_by_product(StockReservation.objects.filter(pk__in=reservation_ids).values_list('product_id', 'quantity'))
+    stock.unhold(quantities)
+    StockReservation.objects.filter(pk__in=reservation_ids).update(status=status)
+    return quantities
+
+
+def release_order(order):
+    with transaction.atomic():
+        ids = list(StockReservation.objects.select_for_update().filter(order=order, status='active').values_list('pk', flat=True))
+        _release(ids, 'released')
+    return len(ids)
+
+
+def release_expired(now=None, batch_size=RELEASE_BATCH_SIZE):
+    # Libera las reservas vencidas por lotes; skip_locked evita chocar con otro barrido
+    now = now or timezone.now()
+    released = 0
+    while True:
+        with transaction.atomic():
+            ids = list(
+                StockReservation.objects.select_for_update(skip_locked=True)
+                .filter(status='active', expires_at__lte=now)
+                .order_by('expires_at')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                return released
+            _release(ids, 'released')
+        released += len(ids)
+
+
+def convert_order(order):
+    # Pago confirmado: las reservas activas pasan a descuento de stock. Las líneas cuya
+    # reserva ya venció se descuentan si aún hay unidades libres. Todo o nada.
+    with transaction.atomic():
+        reservations = list(
+            StockReservation.objects.select_for_update().filter(order=order, status='active').values_list('pk', 'product_id', 'quantity')
+        )
+        held = quantities_by_product((product_id, quantity) for _, product_id, quantity in reservations)
+        ordered = quantities_by_product(OrderItem.objects.filter(order=order).values_list('product_id', 'quantity'))
+        unreserved = {pk: qty - held[pk] for pk, qty in ordered.items() if qty > held[pk]}
+
+        stock.commit_held(held)
+        StockReservation.objects.filter(pk__in=[pk for pk, _, _ in reservations]).update(status='converted')
+        # Si falta stock, la excepción revierte también la conversión de las reservas
+        stock.decrement(unreserved)
+        # Lo descontado sin reserva previa también queda registrado como convertido
+        now = timezone.now()
+        StockReservation.objects.bulk_create([
+            StockReservation(order=order, product_id=product_id, quantity=quantity, status='converted', expires_at=now)
+            for product_id, quantity in unreserved.items()
+        ])
+    return sum(ordered.values())
@@ -0,0 +1,159 @@
+# Motor de búsqueda de productos basado en un índice invertido (tabla SearchTerm).
+# Cada producto se descompone en términos normalizados (sin tildes, en minúsculas,
+# sin palabras vacías y con plurales simples reducidos) con un peso según el campo
+# donde aparecen. Las búsquedas consultan el índice por prefijo en vez de recorrer
+# la tabla de productos con icontains.
+import re
+import unicodedata
+from collections import Counter
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Case, IntegerField, Max, OuterRef, Q, Subquery, Sum, When
+from django.db.models.signals import post_save
+
+from .models import Brand, Category, Product, SearchTerm
+
+# Peso de cada campo en el ranking: coincidir en el nombre vale más que en la descripción
+FIELD_WEIGHTS = {
+    'name': 8,
+    'brand': 4,
+    'category': 2,
+    'description': 1,
+}
+
+# Palabras vacías en español que no aportan a la búsqueda
+STOPWORDS = frozenset({
+    'a', 'al', 'con', 'de', 'del', 'e', 'el', 'en', 'es', 'la', 'las', 'lo', 'los',
+    'o', 'para', 'por', 'se', 'sin', 'su', 'sus', 'un', 'una', 'unas', 'unos', 'y',
+})
+
+MAX_TERM_LENGTH = 40  # Igual al max_length de SearchTerm.term
+MAX_QUERY_TERMS = 6  # Evita consultas con demasiadas condiciones
+MIN_TOKEN_LENGTH = 2
+INDEX_BATCH_SIZE = 500
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def normalize(text):
+    # Quita tildes y pasa a minúsculas: "Martíllo" -> "martillo"
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def stem(token):
+    # Reduce plurales simples: "destornilladores" -> "destornillador", "llaves" -> "llave"
+    if len(token) > 4 and token.endswith('es') and token[-3] in 'rlndj':
+        return token[:-2]
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_RE.findall(normalize(text)):
+        if len(token) < MIN_TOKEN_LENGTH or token in STOPWORDS:
+            continue
+        tokens.append(stem(token)[:MAX_TERM_LENGTH])
+    return tokens
+
+
+def product_terms(product):
+    # Devuelve {término: peso} para un producto con category y brand ya cargados
+    weights = Counter()
+    fields = {
+        'name': product.name,
+        'brand': product.brand.name,
+        'category': product.category.name,
+        'description': product.description,
+    }
+    for field, text in fields.items():
+        for token in tokenize(text):
+            weights[token] += FIELD_WEIGHTS[field]
+    return weights
+
+
+def index_products(product_ids):
+    # Reindexa los productos indicados reemplazando sus términos por lotes
+    product_ids = list(product_ids)
+    for start in range(0, len(product_ids), INDEX_BATCH_SIZE):
+        batch = product_ids[start:start + INDEX_BATCH_SIZE]
+        products = Product.objects.filter(pk__in=batch).select_related('category', 'brand')
+        rows = [
+            SearchTerm(product_id=product.pk, term=term, weight=weight)
+            for product in products
+            for term, weight in product_terms(product).items()
+        ]
+        with transaction.atomic():
+            SearchTerm.objects.filter(product_id__in=batch).delete()
+            SearchTerm.objects.bulk_create(rows, batch_size=INDEX_BATCH_SIZE * 4)
+
+
+def rebuild_index():
+    ids = Product.objects.order_by('pk').values_list('pk', flat=True)
+    index_products(ids.iterator(chunk_size=INDEX_BATCH_SIZE))
+
+
+def matching_products(query):
+    # Subconsulta agrupada por producto con los que contienen todos los términos
+    # (por prefijo) y su ranking; None si la consulta no tiene términos útiles.
+    tokens = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not tokens:
+        return None
+    return (
+        SearchTerm.objects
+        .filter(reduce(or_, [Q(term__startswith=token) for token in tokens]))
+        .values('product')
+        .annotate(
+            rank=Sum('weight'),
+            **{
+                f'hit_{i}': Max(Case(When(term__startswith=token, then=1), default=0, output_field=IntegerField()))
+                for i, token in enumerate(tokens)
+            }
+        )
+        .filter(**{f'hit_{i}': 1 for i in range(len(tokens))})
+    )
+
+
+def filter_products(queryset, query):
+    # Filtra sin anotar el ranking (para conteos y agregados)
+    matches = matching_products(query)
+    if matches is None:
+        return queryset.none()
+    return queryset.filter(pk__in=matches.values('product'))
+
+
+def search_products(queryset, query):
+    # Filtra el queryset a los productos que coinciden y lo anota con search_rank
+    # para ordenar por relevancia.
+    matches = matching_products(query)
+    if matches is None:
+        return queryset.none()
+    return queryset.filter(pk__in=matches.values('product')).annotate(
+        search_rank=Subquery(matches.filter(product=OuterRef('pk')).values('rank')[:1])
+    )
+
+
+# Signals para mantener el índice actualizado de forma incremental
+INDEXED_FIELDS = {'name', 'description', 'category', 'category_id', 'brand', 'brand_id'}
+
+
+def product_index_receiver(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields and not INDEXED_FIELDS.intersection(update_fields):
+        return
+    index_products([instance.pk])
+
+
+def taxonomy_index_receiver(sender, instance, created, **kwargs):
+    # Renombrar una categoría o marca cambia los términos de todos sus productos
+    if created:
+        return
+    index_products(instance.products.order_by('pk').values_list('pk', flat=True))
+
+
+post_save.connect(product_index_receiver, sender=Product)
+post_save.connect(taxonomy_index_receiver, sender=Category)
+post_save.connect(taxonomy_index_receiver, sender=Brand)
@@ -0,0 +1,123 @@
+# Códigos legibles (FER-00001, ORD-00001) sin COUNT ni reintentos al insertar.
+# Cada proceso reserva un bloque de valores con un único UPDATE sobre la fila de
+# la secuencia (hi/lo) y los entrega desde memoria, así que sólo una de cada
+# SEQUENCE_BLOCK_SIZE altas toca la tabla. El bloque se confirma por su cuenta,
+# fuera de la transacción de quien pide el código (salvo en SQLite, ver
+# SINGLE_WRITER_VENDORS): la fila queda bloqueada sólo lo que dura ese UPDATE y
+# un rollback posterior no devuelve los valores, así que nunca se entregan dos
+# veces. Los valores son únicos y crecientes dentro de cada
+# proceso; entre procesos se intercalan, y reinicios y rollbacks dejan huecos.
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Max
+
+from .models import Order, Product, Sequence
+
+DEFAULT_BLOCK_SIZE = 50
+# Motores con un solo escritor por base: SQLite bloquea toda la base durante una
+# transacción de escritura, así que no se puede reservar en otra conexión
+SINGLE_WRITER_VENDORS = {'sqlite'}
+
+# nombre -> (prefijo, dígitos, modelo cuyo id máximo fija el valor inicial)
+SEQUENCES = {
+    'product': ('FER', 5, Product),
+    'order': ('ORD', 5, Order),
+}
+
+
+class _Block:
+    def __init__(self, start, end):
+        self.next = start
+        self.end = end
+
+    @property
+    def remaining(self):
+        return self.end - self.next
+
+    def take(self, count):
+        values = list(range(self.next, self.next + count))
+        self.next += count
+        return values
+
+
+class SequenceAllocator:
+    def __init__(self):
+        self._blocks = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def block_size(self):
+        return max(1, getattr(settings, 'SEQUENCE_BLOCK_SIZE', DEFAULT_BLOCK_SIZE))
+
+    def reset(self):
+        with self._lock:
+            self._blocks.clear()
+
+    def _get_executor(self):
+        # Un hilo con su propia conexión en autocommit; se usa siempre bajo self._lock
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sequences')
+        return self._executor
+
+    def _start_value(self, name):
+        model = SEQUENCES[name][2]
+        return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+
+    def _reserve(self, name, size):
+        with transaction.atomic():
+            if not Sequence.objects.filter(name=name).update(next_value=F('next_value') + size):
+                Sequence.objects.get_or_create(name=name, defaults={'next_value': self._start_value(name)})
+                Sequence.objects.filter(name=name).update(next_value=F('next_value') + size)
+            # El UPDATE deja la fila bloqueada hasta el commit: nadie más lee este valor
+            end = Sequence.objects.filter(name=name).values_list('next_value', flat=True).get()
+        return _Block(end - size, end)
+
+    def _reserve_job(self, name, size):
+        try:
+            return self._reserve(name, size)
+        finally:
+            close_old_connections()
+
+    def _grab(self, name, size):
+        if not connection.in_atomic_block:
+            return self._reserve(name, size)  # En autocommit el atomic de _reserve ya es independiente
+        # Dentro de la transacción del llamador la fila quedaría bloqueada hasta su commit
+        return self._get_executor().submit(self._reserve_job, name, size).result()
+
+    def allocate(self, name, count=1):
+        with self._lock:
+            block = self._blocks.get(name)
+            values = []
+            if block is not None and block.remaining:
+                values = block.take(min(count, block.remaining))
+            if len(values) < count:
+                missing = count - len(values)
+                if connection.in_atomic_block and connection.vendor in SINGLE_WRITER_VENDORS:
+                    # Otra conexión no podría escribir hasta que termine la transacción del
+                    # llamador (que la espera): se reserva justo lo pedido dentro de ella, sin
+                    # guardar un bloque que un rollback dejaría repetido
+                    return values + self._reserve(name, missing).take(missing)
+                # Una importación grande pide su propio bloque contiguo
+                block = self._grab(name, max(missing, self.block_size()))
+                self._blocks[name] = block
+                values += block.take(missing)
+            return values
+
+
+allocator = SequenceAllocator()
+
+
+def format_code(name, value):
+    prefix, digits = SEQUENCES[name][:2]
+    return f'{prefix}-{value:0{digits}d}'
+
+
+def next_code(name):
+    return format_code(name, allocator.allocate(name)[0])
+
+
+def next_codes(name, count):
+    return [format_code(name, value) for value in allocator.allocate(name, count)]
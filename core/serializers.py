@@ -1,6 +1,8 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from django.utils import timezone
+from . import cart_service
+from .order_totals import finalize_totals
 from .models import Product, Category, Brand, Cart, CartItem, Order, OrderItem, Payment, Address, Coupon, Refund, Employee, UserProfile, PriceHistory  # [CAMBIO] Añadir PriceHistory a las importaciones
 
 # [CAMBIO] Nuevo serializador para el historial de precios
@@ -31,11 +33,12 @@ class ProductSerializer(serializers.ModelSerializer):
     brand_id = serializers.PrimaryKeyRelatedField(queryset=Brand.objects.all(), source='brand', write_only=True)
     final_price = serializers.SerializerMethodField()  # Campo calculado para precio final
     brand_code = serializers.CharField(source='brand.name', read_only=True)  # [CAMBIO] Campo para el "Código" (nombre de la marca)
-    price_history = PriceHistorySerializer(many=True, read_only=True)  # [CAMBIO] Campo para el historial de precios
+    # El historial de precios ya no se anida: se consulta agrupado en /api/products/<id>/price-history/
+    images = serializers.ReadOnlyField()  # Variantes redimensionadas (URLs y srcset WebP/JPEG)
 
     class Meta:
         model = Product
-        fields = ['id', 'code', 'name', 'description', 'category', 'category_id', 'brand', 'brand_id', 'brand_code', 'price', 'discount_price', 'final_price', 'stock', 'image', 'slug', 'created_at', 'updated_at', 'price_history']  # [CAMBIO] Añadir code, brand_code, price_history
+        fields = ['id', 'code', 'name', 'description', 'category', 'category_id', 'brand', 'brand_id', 'brand_code', 'price', 'discount_price', 'final_price', 'stock', 'image', 'images', 'slug', 'created_at', 'updated_at']  # [CAMBIO] Añadir code, brand_code
 
     def get_final_price(self, obj):
         return obj.get_final_price()  # Usa el método del modelo
@@ -63,20 +66,19 @@ class CartItemSerializer(serializers.ModelSerializer):
 class CartSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     items = CartItemSerializer(many=True)
-    total = serializers.SerializerMethodField()  # Campo calculado para total del carrito
 
     class Meta:
         model = Cart
-        fields = ['id', 'user', 'items', 'created_at', 'updated_at', 'total']  # Serializa carrito
-
-    def get_total(self, obj):
-        return sum(item.get_total_price() for item in obj.items.all())  # Calcula total del carrito
+        fields = ['id', 'user', 'items', 'created_at', 'updated_at', 'item_count', 'total']  # Serializa carrito
+        read_only_fields = ['item_count', 'total']  # Totales almacenados, mantenidos por core.cart_service
 
     def create(self, validated_data):
         items_data = validated_data.pop('items', [])
         cart = Cart.objects.create(**validated_data)
         for item_data in items_data:
             CartItem.objects.create(cart=cart, **item_data)
+        cart_service.refresh_totals(cart)
+        cart.refresh_from_db(fields=['item_count', 'total'])
         return cart
 
 class OrderItemSerializer(serializers.ModelSerializer):
@@ -110,12 +112,12 @@ class OrderSerializer(serializers.ModelSerializer):
         return obj.get_total()  # Usa el método del modelo
 
     def create(self, validated_data):
-        import uuid
         items_data = validated_data.pop('items', [])
-        validated_data['ref_code'] = str(uuid.uuid4())[:20]  # Genera ref_code único
         order = Order.objects.create(**validated_data)
         for item_data in items_data:
             OrderItem.objects.create(order=order, **item_data)
+        finalize_totals(order)
+        order.refresh_from_db()
         return order
 
 class PaymentSerializer(serializers.ModelSerializer):
@@ -0,0 +1,137 @@
+# Carrito de visitantes anónimos guardado en una cookie firmada.
+# Sólo contiene {product_id: cantidad}; precios, nombres y stock se leen del
+# catálogo al mostrarlo. No escribe en la base de datos: al iniciar sesión o
+# registrarse se fusiona con el Cart del usuario respetando el stock disponible.
+import json
+from decimal import Decimal
+
+from django.core import signing
+
+from . import cart_service
+from .cart_service import CartChange, InsufficientStock, ItemNotFound, ProductNotFound, parse_quantity
+from .models import Cart, CartItem, Product
+
+COOKIE_NAME = 'ferremas_cart'
+COOKIE_SALT = 'core.session_cart'
+COOKIE_MAX_AGE = 60 * 60 * 24 * 30
+MAX_LINES = 50  # Mantiene la cookie muy por debajo del límite de 4 KB
+
+
+class SessionCartItem:
+    # Misma interfaz que CartItem en las plantillas; el id es el del producto
+    def __init__(self, product, quantity):
+        self.id = product.id
+        self.product = product
+        self.quantity = quantity
+        self.price = product.get_final_price()
+
+    def get_total_price(self):
+        return self.quantity * self.price
+
+
+class SessionCart:
+    def __init__(self, lines=None):
+        self.lines = lines or {}  # {product_id (str): cantidad}
+        self.modified = False
+        self.total = Decimal('0')
+
+    @classmethod
+    def from_request(cls, request):
+        try:
+            raw = request.get_signed_cookie(COOKIE_NAME, salt=COOKIE_SALT, max_age=COOKIE_MAX_AGE)
+            data = json.loads(raw)
+            lines = {str(int(pk)): int(qty) for pk, qty in data.items() if int(qty) > 0}
+        except (KeyError, signing.BadSignature, ValueError, TypeError, AttributeError):
+            lines = {}
+        return cls(lines)
+
+    @property
+    def item_count(self):
+        return sum(self.lines.values())
+
+    def _product(self, product_id, error):
+        try:
+            product = Product.objects.only('id', 'name', 'stock').get(pk=int(product_id))
+        except (Product.DoesNotExist, TypeError, ValueError):
+            raise error
+        return product
+
+    def add(self, product_id, quantity):
+        quantity = parse_quantity(quantity)
+        product = self._product(product_id, ProductNotFound())
+        key = str(product.id)
+        new_quantity = self.lines.get(key, 0) + quantity
+        if new_quantity > product.stock:
+            raise InsufficientStock(product.name, product.stock)
+        if key not in self.lines and len(self.lines) >= MAX_LINES:
+            raise cart_service.CartError(f'El carrito admite hasta {MAX_LINES} productos distintos. Inicia sesión para agregar más.')
+        created = key not in self.lines
+        self.lines[key] = new_quantity
+        self.modified = True
+        return CartChange(product.id, product.name, quantity, created)
+
+    def set_quantity(self, product_id, quantity):
+        quantity = parse_quantity(quantity)
+        if str(product_id) not in self.lines:
+            raise ItemNotFound()
+        product = self._product(product_id, ItemNotFound())
+        if quantity > product.stock:
+            raise InsufficientStock(product.name, product.stock)
+        self.lines[str(product.id)] = quantity
+        self.modified = True
+        return CartChange(product.id, product.name, quantity, False)
+
+    def remove(self, product_id):
+        if self.lines.pop(str(product_id), None) is None:
+            raise ItemNotFound()
+        self.modified = True
+        name = Product.objects.filter(pk=int(product_id)).values_list('name', flat=True).first() or 'Producto'
+        return CartChange(int(product_id), name, 0, False)
+
+    def items(self):
+        # Productos eliminados del catálogo se descartan; deja calculado self.total
+        products = Product.objects.in_bulk([int(pk) for pk in self.lines])
+        items = [SessionCartItem(products[int(pk)], qty) for pk, qty in self.lines.items() if int(pk) in products]
+        self.total = sum((item.get_total_price() for item in items), Decimal('0'))
+        return items
+
+    def save(self, response):
+        if not self.modified:
+            return
+        if self.lines:
+            response.set_signed_cookie(
+                COOKIE_NAME, json.dumps(self.lines, separators=(',', ':')), salt=COOKIE_SALT,
+                max_age=COOKIE_MAX_AGE, httponly=True, samesite='Lax',
+            )
+        else:
+            response.delete_cookie(COOKIE_NAME, samesite='Lax')
+
+
+def merge_into_user_cart(request, response, user):
+    # Fusiona el carrito de la cookie con el del usuario; las cantidades que
+    # superen el stock se recortan. Devuelve los nombres de productos recortados.
+    session_cart = SessionCart.from_request(request)
+    if not session_cart.lines:
+        return []
+    cart = Cart.objects.filter(user=user).first() or Cart.objects.create(user=user)
+    in_cart = dict(CartItem.objects.filter(cart=cart).values_list('product_id', 'quantity'))
+    products = Product.objects.in_bulk([int(pk) for pk in session_cart.lines])
+    trimmed = []
+    for pk, quantity in session_cart.lines.items():
+        product = products.get(int(pk))
+        if product is None:
+            continue
+        available = product.stock - in_cart.get(product.id, 0)
+        if quantity > available:
+            trimmed.append(product.name)
+            quantity = available
+        if quantity <= 0:
+            continue
+        try:
+            cart_service.add_item(cart, product.id, quantity)
+        except InsufficientStock:
+            trimmed.append(product.name)  # El stock cambió entre la lectura y el UPDATE
+    session_cart.lines = {}
+    session_cart.modified = True
+    session_cart.save(response)
+    return trimmed
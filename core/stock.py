@@ -0,0 +1,121 @@
+# Movimientos de stock en bloque.
+# Cada función recibe las cantidades por producto y actualiza todas las filas con
+# un único UPDATE condicional (CASE id WHEN ... THEN cantidad), sin leer productos
+# ni pasar por Product.save(): no hay N+1, no se registra historial de precios y
+# la condición del WHERE evita vender dos veces la misma unidad. Si alguna línea
+# no alcanza se lanza OutOfStock y la transacción se revierte completa.
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from .models import Product
+from .page_cache import invalidate_products
+
+
+class OutOfStock(Exception):
+    def __init__(self, products):
+        self.products = products  # Nombres de productos sin stock suficiente
+        super().__init__(f'Stock insuficiente para: {", ".join(products)}')
+
+
+def quantities_by_product(lines):
+    # (product_id, cantidad), ... -> Counter sumando las líneas repetidas
+    quantities = Counter()
+    for product_id, quantity in lines:
+        quantities[product_id] += quantity
+    return quantities
+
+
+def per_product(quantities):
+    # CASE id WHEN 1 THEN 2 WHEN 5 THEN 1 ... para actualizar varias filas en una sentencia
+    return Case(*[When(pk=pk, then=Value(qty)) for pk, qty in quantities.items()], default=Value(0), output_field=IntegerField())
+
+
+def shortages(quantities):
+    # Productos cuyas unidades libres no cubren la cantidad pedida
+    available = {
+        pk: (name, stock - reserved)
+        for pk, name, stock, reserved in Product.objects.filter(pk__in=quantities.keys()).values_list('pk', 'name', 'stock', 'reserved')
+    }
+    return [
+        available[pk][0] if pk in available else f'producto {pk}'
+        for pk, quantity in quantities.items() if pk not in available or available[pk][1] < quantity
+    ]
+
+
+def _invalidate_on_commit(quantities):
+    # El stock mostrado en las páginas cacheadas cambió
+    changed = list(quantities.keys())
+    transaction.on_commit(lambda: invalidate_products(changed))
+
+
+def decrement(quantities):
+    # Descuenta unidades libres (stock - reserved); todo o nada
+    if not quantities:
+        return 0
+    try:
+        with transaction.atomic():
+            updated = (
+                Product.objects.filter(pk__in=quantities.keys(), stock__gte=F('reserved') + per_product(quantities))
+                .update(stock=F('stock') - per_product(quantities), updated_at=timezone.now())
+            )
+            if updated != len(quantities):
+                raise OutOfStock([])  # Revierte lo descontado; abajo se identifican los productos
+    except OutOfStock:
+        raise OutOfStock(shortages(quantities))
+    _invalidate_on_commit(quantities)
+    return sum(quantities.values())
+
+
+def adjust(product_id, delta):
+    # Corrección manual de inventario relativa al valor leído: un descuento o una
+    # reserva que ocurra entre la lectura y el UPDATE no se pierde. No deja el stock
+    # por debajo de las unidades retenidas.
+    if not delta:
+        return 0
+    products = Product.objects.filter(pk=product_id)
+    if delta < 0:
+        # Sólo al descontar; sumando al lado de reserved nunca se resta de una columna
+        # sin signo (en MySQL, reserved - delta fuera de rango es un error 1690)
+        products = products.filter(stock__gte=F('reserved') + (-delta))
+    updated = products.update(stock=F('stock') + delta, updated_at=timezone.now())
+    if not updated:
+        raise OutOfStock(shortages({product_id: -delta}))
+    _invalidate_on_commit({product_id: delta})
+    return delta
+
+
+def hold(quantities):
+    # Retiene unidades libres sin descontarlas (reservas del checkout); todo o nada
+    if not quantities:
+        return 0
+    try:
+        with transaction.atomic():
+            held = (
+                Product.objects.filter(pk__in=quantities.keys(), stock__gte=F('reserved') + per_product(quantities))
+                .update(reserved=F('reserved') + per_product(quantities))
+            )
+            if held != len(quantities):
+                raise OutOfStock([])
+    except OutOfStock:
+        raise OutOfStock(shortages(quantities))
+    return sum(quantities.values())
+
+
+def unhold(quantities):
+    # Devuelve unidades retenidas con hold()
+    if quantities:
+        Product.objects.filter(pk__in=quantities.keys()).update(reserved=F('reserved') - per_product(quantities))
+
+
+def commit_held(quantities):
+    # Las unidades retenidas salen del stock: baja stock y reserved a la vez
+    if not quantities:
+        return 0
+    Product.objects.filter(pk__in=quantities.keys()).update(
+        stock=F('stock') - per_product(quantities), reserved=F('reserved') - per_product(quantities), updated_at=timezone.now(),
+    )
+    _invalidate_on_commit(quantities)
+    return sum(quantities.values())
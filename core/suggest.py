@@ -0,0 +1,202 @@
+# Índice en memoria para el autocompletado del buscador del catálogo.
+# Guarda claves normalizadas (nombre de producto desde cada palabra, código FER
+# y nombre de marca) en un arreglo ordenado; una consulta es una búsqueda binaria
+# por prefijo, sin tocar la base de datos. Se construye en la primera consulta
+# (única vez que una consulta espera a la base), se parchea con los signals de
+# Product y, al expirar su TTL, se sigue sirviendo mientras un hilo en segundo
+# plano lo reconstruye para recoger cambios hechos por otros procesos; una sola
+# reconstrucción a la vez.
+import bisect
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models.signals import post_delete, post_save
+
+from .models import Brand, Product
+from .search import normalize
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 60 * 10
+DEFAULT_LIMIT = 8
+MAX_LIMIT = 20
+SCAN_FACTOR = 8  # Candidatos revisados por cada resultado pedido antes de ordenar
+
+
+def _name_keys(name):
+    # "Taladro Percutor Bosch" -> ["taladro percutor bosch", "percutor bosch", "bosch"]
+    words = normalize(name).split()
+    return [(' '.join(words[i:]), i) for i in range(len(words))]
+
+
+class SuggestIndex:
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.built_at = None
+        self._keys = []  # Tuplas ordenadas (clave, posición, entrada)
+        self._entries = {}  # entrada -> datos devueltos al cliente
+        self._entry_keys = {}  # entrada -> claves que le pertenecen
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()  # Una sola construcción a la vez
+        self._generation = 0  # Cambia con invalidate(): descarta construcciones ya empezadas
+        self._patches = None  # Cambios de productos recibidos durante una construcción
+        self._refreshing = False
+        self._executor = None
+
+    @property
+    def is_stale(self):
+        return self.built_at is None or time.monotonic() - self.built_at > self.ttl
+
+    def _product_entry(self, product_id, name, code, slug, brand_name):
+        entry = ('product', product_id)
+        data = {'type': 'product', 'id': product_id, 'label': name, 'code': code, 'slug': slug, 'brand': brand_name}
+        keys = [(key, position, entry) for key, position in _name_keys(name)]
+        if code:
+            keys.append((normalize(code), 0, entry))
+        return entry, data, keys
+
+    def _brand_entry(self, brand_id, name):
+        entry = ('brand', brand_id)
+        data = {'type': 'brand', 'id': brand_id, 'label': name}
+        return entry, data, [(normalize(name), 0, entry)]
+
+    def build(self):
+        with self._lock:
+            generation = self._generation
+            self._patches = []
+        entries, entry_keys = {}, {}
+        try:
+            products = Product.objects.values_list('id', 'name', 'code', 'slug', 'brand__name')
+            brands = Brand.objects.values_list('id', 'name')
+            for entry, data, keys in [self._product_entry(*row) for row in products.iterator()] + [self._brand_entry(*row) for row in brands]:
+                entries[entry] = data
+                entry_keys[entry] = keys
+        except Exception:
+            with self._lock:
+                self._patches = None
+            raise
+        sorted_keys = sorted(key for keys in entry_keys.values() for key in keys)
+        with self._lock:
+            patches, self._patches = self._patches, None
+            if generation != self._generation:
+                return  # Se invalidó mientras se leía: lo leído puede estar viejo
+            self._keys, self._entries, self._entry_keys = sorted_keys, entries, entry_keys
+            for entry, data, keys in patches:
+                self._remove(entry)
+                if data is not None:
+                    self._add(entry, data, keys)
+            self.built_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self.built_at = None
+
+    def _ensure_built(self):
+        if self.built_at is None:
+            with self._build_lock:
+                if self.built_at is None:
+                    self.build()
+        elif self.is_stale:
+            self.schedule_rebuild()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='suggest-index')
+            return self._executor
+
+    def schedule_rebuild(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        self._get_executor().submit(self._rebuild_job)
+
+    def _rebuild_job(self):
+        close_old_connections()
+        try:
+            with self._build_lock:
+                self.build()
+        except Exception:
+            logger.exception('No se pudo reconstruir el índice de sugerencias')
+        finally:
+            with self._lock:
+                self._refreshing = False
+            close_old_connections()
+
+    def _remove(self, entry):
+        for key in self._entry_keys.pop(entry, []):
+            i = bisect.bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+        self._entries.pop(entry, None)
+
+    def _add(self, entry, data, keys):
+        self._entries[entry] = data
+        self._entry_keys[entry] = keys
+        for key in keys:
+            bisect.insort(self._keys, key)
+
+    def update_product(self, product):
+        if self.built_at is None:
+            return
+        entry, data, keys = self._product_entry(product.pk, product.name, product.code, product.slug, product.brand.name)
+        with self._lock:
+            if self._patches is not None:
+                self._patches.append((entry, data, keys))
+            self._remove(entry)
+            self._add(entry, data, keys)
+
+    def remove_product(self, product_id):
+        if self.built_at is None:
+            return
+        with self._lock:
+            if self._patches is not None:
+                self._patches.append((('product', product_id), None, None))
+            self._remove(('product', product_id))
+
+    def suggest(self, query, limit=DEFAULT_LIMIT):
+        prefix = ' '.join(normalize(query).split())
+        if not prefix:
+            return []
+        self._ensure_built()
+        candidates = {}
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (prefix,))
+            while i < len(self._keys) and len(candidates) < limit * SCAN_FACTOR:
+                key, position, entry = self._keys[i]
+                if not key.startswith(prefix):
+                    break
+                # Se conserva la mejor posición: coincidir al inicio del nombre pesa más
+                if entry not in candidates or position < candidates[entry]:
+                    candidates[entry] = position
+                i += 1
+            ranked = sorted(candidates, key=lambda e: (candidates[e], e[0] != 'brand', len(self._entries[e]['label'])))
+            return [self._entries[entry] for entry in ranked[:limit]]
+
+
+suggest_index = SuggestIndex(ttl=getattr(settings, 'SUGGEST_INDEX_TTL', DEFAULT_TTL))
+
+
+def product_saved_receiver(sender, instance, **kwargs):
+    suggest_index.update_product(instance)
+
+
+def product_deleted_receiver(sender, instance, **kwargs):
+    suggest_index.remove_product(instance.pk)
+
+
+def brand_changed_receiver(sender, instance, **kwargs):
+    # Cambia el nombre de marca mostrado en varios productos: se reconstruye completo
+    suggest_index.invalidate()
+
+
+post_save.connect(product_saved_receiver, sender=Product)
+post_delete.connect(product_deleted_receiver, sender=Product)
+post_save.connect(brand_changed_receiver, sender=Brand)
+post_delete.connect(brand_changed_receiver, sender=Brand)
@@ -0,0 +1,172 @@
+# Tablas paginadas en el servidor para los paneles del personal.
+# Cada tabla declara sus ordenamientos (sólo columnas indexadas, con un campo único
+# al final para que el cursor sea estable) y los filtros que acepta por GET; las
+# páginas se recorren con el KeysetPaginator del catálogo, así que una página
+# profunda cuesta lo mismo que la primera. Las plantillas usan
+# tables/pagination.html y los enlaces de table.sort_urls en los encabezados.
+from datetime import datetime, time
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import Employee, Order, Payment
+from .pagination import InvalidCursor, KeysetPaginator, clamp_page_size
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+LOW_STOCK = 5
+
+
+def parse_day(value, end=False):
+    # 'AAAA-MM-DD' -> inicio o fin de ese día en la zona horaria actual; None si no es válido
+    try:
+        day = parse_date(value or '')
+    except ValueError:
+        return None
+    if day is None:
+        return None
+    return timezone.make_aware(datetime.combine(day, time.max if end else time.min))
+
+
+class ServerTable:
+    orderings = {}  # clave de ?sort= -> campos de ordenamiento
+    default_ordering = None
+    filters = ()  # parámetros GET que entiende filter_queryset
+    page_size = DEFAULT_PAGE_SIZE
+
+    def __init__(self, request, queryset):
+        self.request = request
+        self.params = {name: request.GET.get(name, '').strip() for name in self.filters}
+        sort = request.GET.get('sort')
+        self.sort = sort if sort in self.orderings else self.default_ordering
+        page_size = clamp_page_size(request.GET.get('page_size'), self.page_size, MAX_PAGE_SIZE)
+        paginator = KeysetPaginator(self.filter_queryset(queryset, self.params), self.orderings[self.sort], page_size)
+        try:
+            self.page = paginator.get_page(request.GET.get('cursor'))
+        except InvalidCursor:
+            self.page = paginator.get_page()
+
+    def filter_queryset(self, queryset, params):
+        return queryset
+
+    def filter_dates(self, queryset, field, params):
+        start, end = parse_day(params.get('date_from')), parse_day(params.get('date_to'), end=True)
+        if start:
+            queryset = queryset.filter(**{f'{field}__gte': start})
+        if end:
+            queryset = queryset.filter(**{f'{field}__lte': end})
+        return queryset
+
+    def __iter__(self):
+        return iter(self.page)
+
+    def __len__(self):
+        return len(self.page)
+
+    @property
+    def filtered(self):
+        return any(self.params.values())
+
+    def _url(self, **changes):
+        # Conserva filtros y orden actuales; cualquier cambio vuelve a la primera página
+        params = self.request.GET.copy()
+        params.pop('cursor', None)
+        for key, value in changes.items():
+            params[key] = value
+        return f'?{params.urlencode()}'
+
+    @property
+    def next_url(self):
+        return self._url(cursor=self.page.next_cursor) if self.page.next_cursor else None
+
+    @property
+    def previous_url(self):
+        return self._url(cursor=self.page.previous_cursor) if self.page.previous_cursor else None
+
+    @property
+    def sort_urls(self):
+        return {key: self._url(sort=key) for key in self.orderings}
+
+
+class OrderTable(ServerTable):
+    # Índices: core_order_status_date_idx (status, ordered_date) y core_order_date_idx
+    orderings = {
+        'newest': ('-ordered_date', '-id'),
+        'oldest': ('ordered_date', 'id'),
+    }
+    default_ordering = 'newest'
+    filters = ('status', 'date_from', 'date_to', 'customer')
+    status_choices = Order.STATUS_CHOICES
+
+    def filter_queryset(self, queryset, params):
+        if params['status'] in dict(self.status_choices):
+            queryset = queryset.filter(status=params['status'])
+        if params['customer']:
+            queryset = queryset.filter(user__username=params['customer'])
+        return self.filter_dates(queryset, 'ordered_date', params)
+
+
+class WarehouseOrderTable(OrderTable):
+    status_choices = [choice for choice in Order.STATUS_CHOICES if choice[0] in ('approved', 'prepared')]
+
+
+class PaymentTable(ServerTable):
+    # Índices: core_payment_confirmed_idx (confirmed, created_at) y core_payment_date_idx
+    orderings = {
+        'newest': ('-created_at', '-id'),
+        'oldest': ('created_at', 'id'),
+    }
+    default_ordering = 'newest'
+    filters = ('confirmed', 'method', 'date_from', 'date_to', 'customer')
+    method_choices = Payment.PAYMENT_METHODS
+
+    def filter_queryset(self, queryset, params):
+        if params['confirmed'] in ('yes', 'no'):
+            queryset = queryset.filter(confirmed=params['confirmed'] == 'yes')
+        if params['method'] in dict(self.method_choices):
+            queryset = queryset.filter(method=params['method'])
+        if params['customer']:
+            queryset = queryset.filter(order__user__username=params['customer'])
+        return self.filter_dates(queryset, 'created_at', params)
+
+
+class ProductTable(ServerTable):
+    orderings = {
+        'name': ('name',),
+        'name_desc': ('-name',),
+        'newest': ('-id',),
+    }
+    default_ordering = 'name'
+    filters = ('q', 'category', 'brand', 'stock')
+
+    def filter_queryset(self, queryset, params):
+        if params['q']:
+            queryset = queryset.filter(name__istartswith=params['q'])
+        if params['category'].isdigit():
+            queryset = queryset.filter(category_id=params['category'])
+        if params['brand'].isdigit():
+            queryset = queryset.filter(brand_id=params['brand'])
+        if params['stock'] == 'out':
+            queryset = queryset.filter(stock=0)
+        elif params['stock'] == 'low':
+            queryset = queryset.filter(stock__lte=LOW_STOCK)
+        return queryset
+
+
+class UserTable(ServerTable):
+    orderings = {
+        'username': ('username',),
+        'newest': ('-id',),
+    }
+    default_ordering = 'username'
+    filters = ('q', 'role')
+    role_choices = Employee.ROLE_CHOICES + (('customer', 'Cliente'),)
+
+    def filter_queryset(self, queryset, params):
+        if params['q']:
+            queryset = queryset.filter(username__istartswith=params['q'])
+        if params['role'] == 'customer':
+            queryset = queryset.filter(employee__isnull=True)
+        elif params['role'] in dict(Employee.ROLE_CHOICES):
+            queryset = queryset.filter(employee__role=params['role'])
+        return queryset
@@ -1,9 +1,19 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client
 from django.urls import reverse
 from django.contrib.auth.models import User, Group, Permission
 from rest_framework.test import APIClient
 from rest_framework import status
-from .models import Product, Category, Brand, Cart, CartItem, Order, OrderItem, Payment, Address, Coupon, Refund, Employee, UserProfile
+from .models import Product, Category, Brand, Cart, CartItem, Order, OrderItem, Payment, Address, Coupon, Refund, Employee, UserProfile, SearchTerm, PriceRollup, PriceHistory, StockReservation, Sequence, WebhookEvent, ExchangeRateTable
+from .search import search_products
+from .facets import catalog_facets
+from .page_cache import get_page_cache, CSRF_PLACEHOLDER
+from .suggest import suggest_index
+from .price_history import record_price_points
+from django.utils import timezone
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from django.core.management import call_command
 from django_countries.fields import Country
 import stripe
 from django.conf import settings
@@ -204,4 +214,1414 @@ class FerremasTests(TestCase):
         payment = Payment.objects.create(order=order, amount=order.get_total(), method='credit')
         self.api_client.force_authenticate(user=self.warehouse_user)
         response = self.api_client.post(f'/api/payments/{payment.id}/confirm/')
-        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Herramientas Manuales')
+        self.brand = Brand.objects.create(name='Stanley')
+        self.hammer = Product.objects.create(
+            name='Martíllo Carpintero', description='Mango de fibra', category=self.category, brand=self.brand, price=15990, stock=5
+        )
+        self.drill = Product.objects.create(
+            name='Taladro Percutor', description='Incluye martillo percutor', category=self.category, brand=self.brand, price=59990, stock=3
+        )
+
+    def test_accent_insensitive_and_ranked_by_field(self):
+        results = list(search_products(Product.objects.all(), 'martillo').order_by('-search_rank', 'id'))
+        self.assertEqual(results, [self.hammer, self.drill])  # Nombre pesa más que descripción
+        self.assertEqual(search_products(Product.objects.all(), 'MART').count(), 2)  # Búsqueda por prefijo
+        self.assertEqual(search_products(Product.objects.all(), 'martillos stanley').count(), 2)
+        self.assertEqual(search_products(Product.objects.all(), 'martillo bosch').count(), 0)
+
+    def test_index_updated_on_save_and_delete(self):
+        self.drill.name = 'Rotomartillo SDS'
+        self.drill.save()
+        self.assertEqual(list(search_products(Product.objects.all(), 'rotomartillo')), [self.drill])
+        self.brand.name = 'DeWalt'
+        self.brand.save()
+        self.assertEqual(search_products(Product.objects.all(), 'dewalt').count(), 2)
+        self.hammer.delete()
+        self.assertFalse(SearchTerm.objects.filter(product_id=self.hammer.id).exists())
+
+    def test_catalog_view_uses_index(self):
+        response = self.client.get(reverse('customer_catalog'), {'search': 'Martíllo'})
+        self.assertEqual(list(response.context['products']), [self.hammer, self.drill])
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Iluminación')
+        brand = Brand.objects.create(name='Philips')
+        self.products = [
+            Product.objects.create(name=f'Ampolleta {i}', description='LED', category=category, brand=brand, price=1000 + (i % 3) * 100, stock=1)
+            for i in range(7)
+        ]
+        self.user = User.objects.create_user(username='cliente', password='clave12345')
+
+    def test_catalog_pages_forward_and_back(self):
+        url = reverse('customer_catalog')
+        response = self.client.get(url, {'page_size': 3, 'sort': 'price'})
+        first = list(response.context['products'])
+        self.assertEqual(len(first), 3)
+        seen = list(first)
+        next_url = response.context['next_url']
+        while next_url:
+            response = self.client.get(url + next_url)
+            seen.extend(response.context['products'])
+            next_url = response.context['next_url']
+        expected = sorted(self.products, key=lambda p: (p.get_final_price(), p.id))
+        self.assertEqual(seen, expected)
+        response = self.client.get(url + response.context['previous_url'])
+        self.assertEqual(list(response.context['products']), expected[3:6])
+
+    def test_api_cursor_is_opaque_and_capped(self):
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.user)
+        response = self.api_client.get('/api/products/', {'page_size': 1000})
+        self.assertEqual(len(response.data['results']), 7)
+        response = self.api_client.get('/api/products/', {'page_size': 4})
+        self.assertEqual([p['id'] for p in response.data['results']], [p.id for p in reversed(self.products)][:4])
+        response = self.api_client.get(response.data['next'])
+        self.assertEqual([p['id'] for p in response.data['results']], [p.id for p in reversed(self.products)][4:])
+        self.assertIsNone(response.data['next'])
+        response = self.api_client.get('/api/products/', {'cursor': 'no-es-un-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_values_are_type_checked(self):
+        from .pagination import PRODUCT_ORDERINGS, encode_cursor
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.user)
+        for values, ordering in ((['abc'], 'newest'), ([['abc']], 'newest'), (['barato', '1'], 'price')):
+            cursor = encode_cursor(PRODUCT_ORDERINGS[ordering], values)
+            response = self.api_client.get('/api/products/', {'cursor': cursor, 'ordering': ordering})
+            self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('customer_catalog'), {'cursor': encode_cursor(('final_price', 'id'), ['1000', 'x']), 'sort': 'price'})
+        self.assertEqual(response.status_code, 200)  # El catálogo HTML vuelve a la primera página
+
+
+class CatalogFacetTests(TestCase):
+    def setUp(self):
+        self.tools = Category.objects.create(name='Herramientas')
+        self.lights = Category.objects.create(name='Iluminación')
+        self.bosch = Brand.objects.create(name='Bosch')
+        self.philips = Brand.objects.create(name='Philips')
+        Product.objects.create(name='Taladro Bosch', description='Taladro', category=self.tools, brand=self.bosch, price=1000, stock=1)
+        Product.objects.create(name='Sierra Bosch', description='Sierra', category=self.tools, brand=self.bosch, price=1000, stock=1)
+        Product.objects.create(name='Linterna Bosch', description='Linterna', category=self.lights, brand=self.bosch, price=1000, stock=1)
+        Product.objects.create(name='Ampolleta Philips', description='LED', category=self.lights, brand=self.philips, price=1000, stock=1)
+
+    def test_counts_follow_filters_in_one_query(self):
+        with self.assertNumQueries(1):
+            facets = catalog_facets(category_id=str(self.lights.id))
+        self.assertEqual([(f['name'], f['count']) for f in facets['categories']], [('Herramientas', 2), ('Iluminación', 2)])
+        self.assertEqual([(f['name'], f['count']) for f in facets['brands']], [('Bosch', 1), ('Philips', 1)])
+        facets = catalog_facets(search_query='bosch')
+        self.assertEqual([(f['name'], f['count']) for f in facets['brands']], [('Bosch', 3)])
+
+    def test_cached_until_catalog_changes(self):
+        catalog_facets()
+        with self.assertNumQueries(0):
+            facets = catalog_facets()
+        self.assertEqual(facets['brands'][0]['count'], 3)
+        Product.objects.create(name='Esmeril Bosch', description='Esmeril', category=self.tools, brand=self.bosch, price=1000, stock=1)
+        self.assertEqual(catalog_facets()['brands'][0]['count'], 4)
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        get_page_cache().backend.clear()
+        self.category = Category.objects.create(name='Herramientas')
+        self.other_category = Category.objects.create(name='Pinturas')
+        self.brand = Brand.objects.create(name='Truper')
+        self.hammer = Product.objects.create(name='Martillo', description='Acero', category=self.category, brand=self.brand, price=5000, stock=3)
+        self.brush = Product.objects.create(name='Brocha', description='Cerda', category=self.other_category, brand=self.brand, price=900, stock=3)
+
+    def test_anonymous_pages_served_from_cache(self):
+        url = reverse('customer_catalog')
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertNotContains(response, CSRF_PLACEHOLDER)
+
+    def test_product_save_invalidates_only_related_pages(self):
+        hammer_url = reverse('customer_product_detail', args=[self.hammer.slug])
+        brush_url = reverse('customer_product_detail', args=[self.brush.slug])
+        paint_url = reverse('customer_catalog') + f'?category={self.other_category.id}'
+        for url in (hammer_url, brush_url, paint_url, reverse('customer_catalog')):
+            self.client.get(url)
+        self.hammer.price = 4500
+        self.hammer.save()
+        self.assertEqual(self.client.get(hammer_url)['X-Page-Cache'], 'miss')
+        self.assertEqual(self.client.get(reverse('customer_catalog'))['X-Page-Cache'], 'miss')
+        self.assertEqual(self.client.get(brush_url)['X-Page-Cache'], 'hit')
+        self.assertEqual(self.client.get(paint_url)['X-Page-Cache'], 'hit')
+
+    def test_facet_changes_invalidate_other_category_pages(self):
+        # La página de Pinturas cuenta productos de Herramientas en sus facetas
+        paint_url = reverse('customer_catalog') + f'?category={self.other_category.id}'
+        self.client.get(paint_url)
+        self.hammer.brand = Brand.objects.create(name='Stanley')
+        self.hammer.save()
+        self.assertEqual(self.client.get(paint_url)['X-Page-Cache'], 'miss')
+        Product.objects.create(name='Serrucho', description='Acero', category=self.category, brand=self.brand, price=7000, stock=1)
+        self.assertEqual(self.client.get(paint_url)['X-Page-Cache'], 'miss')
+        self.hammer.delete()
+        self.assertEqual(self.client.get(paint_url)['X-Page-Cache'], 'miss')
+
+    def test_authenticated_users_bypass_cache(self):
+        User.objects.create_user(username='cliente', password='clave12345')
+        self.client.login(username='cliente', password='clave12345')
+        response = self.client.get(reverse('customer_catalog'))
+        self.assertFalse(response.has_header('X-Page-Cache'))
+
+
+class SuggestIndexTests(TestCase):
+    def setUp(self):
+        suggest_index.invalidate()
+        category = Category.objects.create(name='Herramientas')
+        self.brand = Brand.objects.create(name='Bosch')
+        self.drill = Product.objects.create(name='Taladro Percutor Bosch', description='.', category=category, brand=self.brand, price=1000, stock=1)
+        self.saw = Product.objects.create(name='Sierra Circular', description='.', category=category, brand=self.brand, price=1000, stock=1)
+
+    def test_prefix_lookup_without_queries(self):
+        suggest_index.build()
+        with self.assertNumQueries(0):
+            results = suggest_index.suggest('bos')
+        self.assertEqual([(r['type'], r['label']) for r in results], [('brand', 'Bosch'), ('product', 'Taladro Percutor Bosch')])
+        self.assertEqual(suggest_index.suggest(self.drill.code.lower())[0]['id'], self.drill.id)
+        self.assertEqual(suggest_index.suggest('SIÉR')[0]['label'], 'Sierra Circular')
+
+    def test_index_patched_on_product_changes(self):
+        suggest_index.build()
+        self.saw.name = 'Sierra Caladora'
+        self.saw.save()
+        self.drill.delete()
+        with self.assertNumQueries(0):
+            self.assertEqual([r['label'] for r in suggest_index.suggest('sierra')], ['Sierra Caladora'])
+            self.assertEqual(suggest_index.suggest('taladro'), [])
+
+    def test_expired_index_is_served_while_rebuilt_once_in_background(self):
+        from unittest import mock
+        suggest_index.build()
+        suggest_index.built_at -= suggest_index.ttl + 1
+        Product.objects.filter(pk=self.saw.pk).update(name='Sierra Caladora')  # Cambio de otro proceso
+        with mock.patch.object(suggest_index, '_get_executor') as executor, self.assertNumQueries(0):
+            self.assertEqual([r['label'] for r in suggest_index.suggest('sierra')], ['Sierra Circular'])
+            suggest_index.suggest('sierra')
+        executor.return_value.submit.assert_called_once_with(suggest_index._rebuild_job)
+        suggest_index._rebuild_job()  # Lo que corre el hilo
+        self.assertFalse(suggest_index.is_stale)
+        self.assertEqual([r['label'] for r in suggest_index.suggest('sierra')], ['Sierra Caladora'])
+
+    def test_invalidate_during_rebuild_discards_it(self):
+        from unittest import mock
+        suggest_index.build()
+        original = Brand.objects.values_list
+
+        def invalidated_meanwhile(*args, **kwargs):
+            suggest_index.invalidate()  # Se renombra una marca mientras se leen los productos
+            return original(*args, **kwargs)
+        with mock.patch.object(Brand.objects, 'values_list', side_effect=invalidated_meanwhile):
+            suggest_index.build()
+        self.assertIsNone(suggest_index.built_at)  # La próxima consulta construye de nuevo
+
+    def test_suggest_endpoint_is_public(self):
+        response = APIClient().get('/api/products/suggest/', {'q': 'tal'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['slug'], self.drill.slug)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=User.objects.create_user(username='pos', password='clave12345'))
+        self.category = Category.objects.create(name='Herramientas')
+        self.brand = Brand.objects.create(name='Makita')
+        self.product = Product.objects.create(name='Esmeril', description='Angular', category=self.category, brand=self.brand, price=39990, stock=4)
+
+    def test_not_modified_until_data_changes(self):
+        for url in ('/api/products/', f'/api/products/{self.product.id}/', '/api/categories/', '/api/brands/'):
+            response = self.api_client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            response = self.api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.content, b'')
+
+    def test_related_change_invalidates_product_etag(self):
+        url = f'/api/products/{self.product.id}/'
+        etag = self.api_client.get(url)['ETag']
+        self.brand.name = 'Makita Pro'
+        self.brand.save()
+        self.assertEqual(self.api_client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = self.api_client.get('/api/brands/')['ETag']
+        Brand.objects.create(name='Stanley')
+        self.assertEqual(self.api_client.get('/api/brands/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class PriceHistoryRollupTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bahco')
+        self.product = Product.objects.create(name='Alicate', description='Universal', category=category, brand=brand, price=1000, stock=5)
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=User.objects.create_user(username='analista', password='clave12345'))
+
+    def test_rollups_maintained_incrementally(self):
+        PriceRollup.objects.all().delete()
+        day = timezone.make_aware(datetime(2025, 3, 5, 10))  # Miércoles
+        record_price_points([(self.product.id, Decimal('900'), day), (self.product.id, Decimal('1200'), day + timedelta(hours=2))])
+        record_price_points([(self.product.id, Decimal('800'), day + timedelta(days=1))])
+        week = PriceRollup.objects.get(product=self.product, period='week')
+        self.assertEqual(week.bucket_start, date(2025, 3, 3))
+        self.assertEqual((week.open, week.high, week.low, week.close), (900, 1200, 800, 800))
+        self.assertEqual(PriceRollup.objects.filter(product=self.product, period='day').count(), 2)
+
+        response = self.api_client.get(f'/api/products/{self.product.id}/price-history/', {'interval': 'month', 'start': '2025-03-01', 'end': '2025-03-31', 'mode': 'last'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['buckets'], [{'start': date(2025, 3, 1), 'price': Decimal('800.00')}])
+
+    def test_existing_rollups_are_looked_up_in_chunks(self):
+        from unittest import mock
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        products = [self.product] + [
+            Product.objects.create(name=f'Alicate {i}', description='x', category=self.product.category, brand=self.product.brand, price=1000, stock=1)
+            for i in range(4)
+        ]
+        day = timezone.make_aware(datetime(2025, 3, 5, 10))
+        record_price_points([(p.id, Decimal('900'), day) for p in products])
+        with mock.patch('core.price_history.LOOKUP_CHUNK_SIZE', 2), CaptureQueriesContext(connection) as ctx:
+            record_price_points([(p.id, Decimal('700'), day + timedelta(hours=1)) for p in products])
+        selects = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT') and 'core_pricerollup' in q['sql']]
+        self.assertEqual(len(selects), 3)
+        self.assertTrue(all(sql.count(' OR ') == 0 for sql in selects))
+        day_rollups = PriceRollup.objects.filter(period='day', bucket_start=date(2025, 3, 5), product__in=products)
+        self.assertEqual(sorted((r.open, r.low, r.close) for r in day_rollups), [(900, 700, 700)] * 5)
+
+    def test_product_payload_has_no_raw_history(self):
+        response = self.api_client.get(f'/api/products/{self.product.id}/')
+        self.assertNotIn('price_history', response.data)
+        self.assertTrue(PriceRollup.objects.filter(product=self.product, period='day').exists())
+
+
+class PriceHistoryDedupTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Fluke')
+        self.product = Product.objects.create(name='Multímetro', description='Digital', category=category, brand=brand, price=89990, stock=2)
+
+    def test_only_price_changes_are_recorded(self):
+        self.assertEqual(self.product.price_history.count(), 1)
+        product = Product.objects.get(pk=self.product.pk)
+        product.stock = 10
+        product.save()
+        product.slug = 'multimetro-fluke'
+        product.save()
+        self.assertEqual(product.price_history.count(), 1)
+        product.discount_price = 79990
+        product.save()
+        self.assertEqual(list(product.price_history.order_by('id').values_list('price', flat=True)), [Decimal('89990'), Decimal('79990')])
+
+    def test_compaction_collapses_consecutive_duplicates(self):
+        for price in (89990, 89990, 79990, 79990, 89990):
+            PriceHistory.objects.create(product=self.product, price=price)
+        call_command('compact_price_history', batch_size=2, stdout=StringIO())
+        self.assertEqual(list(self.product.price_history.order_by('created_at', 'id').values_list('price', flat=True)), [Decimal('89990'), Decimal('79990'), Decimal('89990')])
+
+
+class ProductImportTests(TestCase):
+    CSV = (
+        'name,description,category,brand,price,discount_price,stock\n'
+        'Taladro Percutor,Taladro 800W,Herramientas,Bosch,59990,,10\n'
+        'Sierra Circular,Sierra 1400W,Herramientas,Makita,89990,79990,5\n'
+        'Martillo,Sin precio,Herramientas,Stanley,,,3\n'
+        'Taladro Percutor,Repetido,Herramientas,Bosch,1000,,1\n'
+    )
+
+    def setUp(self):
+        Brand.objects.create(name='Bosch')
+        suggest_index.invalidate()
+
+    def test_import_csv_in_chunks(self):
+        from .importers import import_products
+        result = import_products(StringIO(self.CSV), 'csv', chunk_size=2)
+        self.assertEqual(result.created, 2)
+        self.assertEqual([line for line, _ in result.errors], [3, 4])
+        saw = Product.objects.get(name='Sierra Circular')
+        drill = Product.objects.get(name='Taladro Percutor')
+        self.assertEqual(int(saw.code[4:]), int(drill.code[4:]) + 1)  # Correlativos, sin depender del id
+        self.assertEqual(saw.slug, 'sierra-circular')
+        self.assertEqual(Brand.objects.filter(name__in=['Bosch', 'Makita']).count(), 2)
+        self.assertEqual(list(saw.price_history.values_list('price', flat=True)), [Decimal('79990')])
+        self.assertTrue(PriceRollup.objects.filter(product=saw, period='day', close=79990).exists())
+        self.assertEqual(list(search_products(Product.objects.all(), 'sierra')), [saw])
+
+    def test_import_endpoint_requires_admin(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        api_client = APIClient()
+        rows = '\n'.join(json.dumps(row) for row in [
+            {'name': 'Esmeril', 'description': 'Angular', 'category': 'Herramientas', 'brand': 'Bosch', 'price': '45990', 'stock': 4},
+            {'name': 'Nivel', 'description': 'Láser', 'category': 'Medición', 'brand': 'Inexistente', 'price': 'abc'},
+        ])
+        upload = lambda: SimpleUploadedFile('catalogo.jsonl', rows.encode(), content_type='application/octet-stream')
+        api_client.force_authenticate(user=User.objects.create_user(username='cliente', password='x'))
+        self.assertEqual(api_client.post('/api/products/import/', {'file': upload()}, format='multipart').status_code, 403)
+        api_client.force_authenticate(user=User.objects.create_user(username='staff', password='x', is_staff=True))
+        response = api_client.post('/api/products/import/', {'file': upload()}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['errors'], [{'row': 2, 'error': 'price no es un número válido'}])
+        self.assertEqual(suggest_index.suggest('esme')[0]['label'], 'Esmeril')
+
+    def test_unreadable_file_reports_partial_import(self):
+        import io
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        header = 'name,description,category,brand,price,stock\n'
+        rows = ''.join(f'Producto {i},Descripción {i},Herramientas,Bosch,1000,1\n' for i in range(400))
+        body = header.encode() + rows.encode() + b'Roto,\xff\xfe,Herramientas,Bosch,1000,1\n'
+        from .importers import import_products
+        result = import_products(io.TextIOWrapper(io.BytesIO(body), encoding='utf-8'), 'csv', chunk_size=50)
+        self.assertEqual(result.stopped_at, result.created + 1)
+        self.assertEqual(Product.objects.count(), result.created)
+        self.assertGreater(result.created, 0)
+        api_client = APIClient()
+        api_client.force_authenticate(user=User.objects.create_user(username='staff', password='x', is_staff=True))
+        upload = SimpleUploadedFile('catalogo.csv', body.replace(b'Producto ', b'Otro '), content_type='text/csv')
+        response = api_client.post('/api/products/import/', {'file': upload, 'format': 'csv'}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['stopped_at_row'], response.data['created'] + 1)
+        self.assertIn('Archivo inválido', response.data['errors'][-1]['error'])
+
+    def test_quoted_line_breaks_survive_the_upload(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        body = 'name,description,category,brand,price,stock\r\nEsmeril,"Disco 4,5\r\nIncluye llave",Herramientas,Bosch,1000,1\r\n'
+        api_client = APIClient()
+        api_client.force_authenticate(user=User.objects.create_user(username='staff', password='x', is_staff=True))
+        upload = SimpleUploadedFile('catalogo.csv', body.encode(), content_type='text/csv')
+        response = api_client.post('/api/products/import/', {'file': upload}, format='multipart')
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(Product.objects.get(name='Esmeril').description, 'Disco 4,5\r\nIncluye llave')
+
+    def test_bad_json_line_is_a_row_error(self):
+        from .importers import import_products
+        rows = '{"name": "Esmeril", "description": "Angular", "category": "Herramientas", "brand": "Bosch", "price": "45990"}\n{roto\n'
+        result = import_products(StringIO(rows), 'jsonl')
+        self.assertEqual(result.created, 1)
+        self.assertEqual([line for line, _ in result.errors], [2])
+
+    def test_rolled_back_chunk_leaves_no_lookups(self):
+        from unittest import mock
+        from django.db import IntegrityError
+        from .importers import import_products
+        csv_rows = 'name,description,category,brand,price\nEsmeril,Angular,Nueva,Nueva Marca,45990\n'
+        with mock.patch('core.importers.index_products', side_effect=IntegrityError('choque')):
+            result = import_products(StringIO(csv_rows), 'csv')
+        self.assertEqual(result.created, 0)
+        self.assertFalse(Category.objects.filter(name='Nueva').exists())
+        self.assertFalse(Brand.objects.filter(name='Nueva Marca').exists())
+        result = import_products(StringIO(csv_rows), 'csv')
+        self.assertEqual(Product.objects.get(name='Esmeril').category.name, 'Nueva')
+
+
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        import tempfile
+        from django.test import override_settings
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, IMAGE_PIPELINE={'ASYNC': False})
+        self.settings_override.enable()
+        get_page_cache().backend.clear()
+        self.category = Category.objects.create(name='Herramientas')
+        self.brand = Brand.objects.create(name='Bosch')
+
+    def tearDown(self):
+        import shutil
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def _upload(self, size=(1000, 800), mode='RGBA'):
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from io import BytesIO
+        buffer = BytesIO()
+        Image.new(mode, size, (200, 30, 30, 255) if mode == 'RGBA' else (200, 30, 30)).save(buffer, 'PNG')
+        return SimpleUploadedFile('taladro.png', buffer.getvalue(), content_type='image/png')
+
+    def test_variants_generated_on_upload(self):
+        import os
+        product = Product.objects.create(name='Taladro', description='800W', category=self.category, brand=self.brand, price=59990, stock=3, image=self._upload())
+        product.refresh_from_db()
+        self.assertEqual(product.image_variants['source'], product.image.name)
+        card = product.images['card']
+        self.assertEqual((card['width'], card['height']), (400, 300))
+        self.assertIn('800w', card['webp_srcset'])  # El original alcanza para la versión 2x
+        self.assertEqual(len(product.image_variants['detail']['files']), 1)  # 1000px: sin 2x para detail
+        for data in (v for k, v in product.image_variants.items() if k != 'source'):
+            for names in data['files']:
+                self.assertTrue(os.path.exists(os.path.join(self.media_root, names['webp'])))
+        response = self.client.get(reverse('customer_catalog'))
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, card['jpeg'])
+
+    def test_backfill_and_replacement_cleanup(self):
+        import os
+        product = Product.objects.create(name='Sierra', description='1400W', category=self.category, brand=self.brand, price=89990, stock=3)
+        # Imagen cargada sin pasar por save(): la deja el backfill
+        from django.core.files.storage import default_storage
+        Product.objects.filter(pk=product.pk).update(image=default_storage.save('products/sierra.png', self._upload(size=(400, 320), mode='RGB')))
+        call_command('build_image_variants', workers=1, stdout=StringIO())
+        product.refresh_from_db()
+        old_files = [names['jpeg'] for k, v in product.image_variants.items() if k != 'source' for names in v['files']]
+        self.assertEqual(len(product.image_variants['thumbnail']['files']), 2)
+        self.assertEqual(len(product.image_variants['card']['files']), 1)  # 400x320 no llena 800x600
+        product.image = self._upload()
+        product.save()
+        self.assertTrue(product.image_variants['source'].startswith('products/taladro'))
+        self.assertFalse(any(os.path.exists(os.path.join(self.media_root, name)) for name in old_files))
+
+    def test_stale_instance_save_keeps_stored_variants(self):
+        product = Product.objects.create(name='Esmeril', description='Angular', category=self.category, brand=self.brand, price=45990, stock=3)
+        stale = Product.objects.get(pk=product.pk)
+        variants = {'source': 'products/esmeril.png', 'card': {'width': 400, 'height': 300, 'files': []}}
+        Product.objects.filter(pk=product.pk).update(image_variants=variants)  # Lo que hace store_variants al terminar
+        stale.stock = 9
+        stale.save()
+        product.refresh_from_db()
+        self.assertEqual((product.stock, product.image_variants), (9, variants))
+
+
+class CartServiceTests(TestCase):
+    def setUp(self):
+        from . import cart_service
+        self.service = cart_service
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        self.product = Product.objects.create(name='Taladro', description='800W', category=category, brand=brand, price=59990, discount_price=54990, stock=5)
+        self.user = User.objects.create_user(username='cliente', password='password123')
+        self.cart = Cart.objects.create(user=self.user)
+
+    def _queries(self, func, *args):
+        # Cuenta sólo las sentencias reales; los SAVEPOINT vienen del TestCase
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            result = func(*args)
+        return result, len([q for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']])
+
+    def test_mutations_use_read_write_and_totals_queries(self):
+        # Lectura + escritura del ítem + UPDATE de los totales del carrito
+        change, queries = self._queries(self.service.add_item, self.cart, self.product.id, '2')
+        self.assertTrue(change.created)
+        self.assertLessEqual(queries, 3)
+        change, queries = self._queries(self.service.add_item, self.cart, str(self.product.id), 3)
+        self.assertFalse(change.created)
+        self.assertLessEqual(queries, 3)
+        item = CartItem.objects.get(cart=self.cart)
+        self.assertEqual((item.quantity, item.price), (5, Decimal('54990')))
+        with self.assertRaises(self.service.InsufficientStock):
+            self.service.add_item(self.cart, self.product.id, 1)
+        _, queries = self._queries(self.service.set_quantity, self.cart, item.id, 1)
+        self.assertLessEqual(queries, 3)
+        self.assertEqual(CartItem.objects.get(pk=item.pk).quantity, 1)
+        _, queries = self._queries(self.service.remove_item, self.cart, item.id)
+        self.assertLessEqual(queries, 3)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_update_checks_current_stock(self):
+        self.service.add_item(self.cart, self.product.id, 2)
+        Product.objects.filter(pk=self.product.pk).update(stock=3)  # Otra venta bajó el stock
+        with self.assertRaises(self.service.InsufficientStock):
+            self.service.add_item(self.cart, self.product.id, 2)
+        self.assertEqual(CartItem.objects.get(cart=self.cart).quantity, 2)
+        for bad in ('0', 'x', None):
+            with self.assertRaises(self.service.InvalidQuantity):
+                self.service.add_item(self.cart, self.product.id, bad)
+        with self.assertRaises(self.service.ProductNotFound):
+            self.service.add_item(self.cart, 'abc', 1)
+        other_cart = Cart.objects.create(user=User.objects.create_user(username='otro', password='x'))
+        with self.assertRaises(self.service.ItemNotFound):
+            self.service.set_quantity(other_cart, CartItem.objects.get(cart=self.cart).pk, 1)
+
+    def test_html_view_and_api_share_the_service(self):
+        self.client.login(username='cliente', password='password123')
+        response = self.client.post(reverse('customer_cart'), {'action': 'add', 'product_id': self.product.id, 'quantity': 2})
+        self.assertRedirects(response, reverse('customer_cart'))
+        api_client = APIClient()
+        api_client.force_authenticate(user=self.user)
+        response = api_client.post(f'/api/carts/{self.cart.id}/add_item/', {'product_id': self.product.id, 'quantity': 2}, format='json')
+        self.assertEqual(response.status_code, 200)
+        response = api_client.post(f'/api/carts/{self.cart.id}/add_item/', {'product_id': self.product.id, 'quantity': 2}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(CartItem.objects.get(cart=self.cart).quantity, 4)
+
+
+class CartTotalsTests(TestCase):
+    def setUp(self):
+        from . import cart_service
+        self.service = cart_service
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        self.drill = Product.objects.create(name='Taladro', description='800W', category=category, brand=brand, price=59990, discount_price=54990, stock=5)
+        self.saw = Product.objects.create(name='Sierra', description='1400W', category=category, brand=brand, price=89990, stock=5)
+        self.user = User.objects.create_user(username='cliente', password='password123')
+        self.cart = Cart.objects.create(user=self.user)
+
+    def test_totals_follow_every_mutation(self):
+        self.service.add_item(self.cart, self.drill.id, 2)
+        self.service.add_item(self.cart, self.saw.id, 1)
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.item_count, self.cart.total), (3, Decimal('199970')))
+        item = CartItem.objects.get(cart=self.cart, product=self.drill)
+        self.service.set_quantity(self.cart, item.id, 1)
+        self.service.remove_item(self.cart, CartItem.objects.get(cart=self.cart, product=self.saw).id)
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.item_count, self.cart.get_total()), (1, Decimal('54990')))
+        self.service.clear_cart(self.cart)
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.item_count, self.cart.total), (0, 0))
+
+    def test_checkout_loads_items_once(self):
+        self.service.add_item(self.cart, self.drill.id, 2)
+        self.client.login(username='cliente', password='password123')
+        response = self.client.get(reverse('customer_checkout'))
+        self.assertEqual(response.context['cart'].total, Decimal('109980'))
+        self.assertContains(response, '<span class="badge')
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('customer_checkout'))
+        self.assertEqual(len([q for q in ctx.captured_queries if 'core_cartitem' in q['sql']]), 1)
+
+    def test_verify_command_detects_and_fixes_drift(self):
+        self.service.add_item(self.cart, self.drill.id, 2)
+        Cart.objects.filter(pk=self.cart.pk).update(item_count=7, total=1)
+        out, err = StringIO(), StringIO()
+        call_command('verify_cart_totals', stdout=out, stderr=err)
+        self.assertIn('1 con diferencias', out.getvalue())
+        self.assertIn(f'Carrito {self.cart.pk}', err.getvalue())
+        call_command('verify_cart_totals', fix=True, stdout=StringIO(), stderr=StringIO())
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.item_count, self.cart.total), (2, Decimal('109980')))
+
+
+class SessionCartTests(TestCase):
+    def setUp(self):
+        get_page_cache().backend.clear()
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        self.drill = Product.objects.create(name='Taladro', description='800W', category=category, brand=brand, price=59990, stock=3)
+        self.saw = Product.objects.create(name='Sierra', description='1400W', category=category, brand=brand, price=89990, stock=5)
+        self.user = User.objects.create_user(username='cliente', password='password123')
+
+    def test_anonymous_cart_does_not_write_to_database(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .session_cart import COOKIE_NAME
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('customer_cart'), {'action': 'add', 'product_id': self.drill.id, 'quantity': 2})
+        self.assertRedirects(response, reverse('customer_cart'))
+        self.assertIn(COOKIE_NAME, response.cookies)
+        writes = [q['sql'] for q in ctx.captured_queries if q['sql'].split()[0] in ('INSERT', 'UPDATE', 'DELETE')]
+        self.assertEqual(writes, [])
+        self.assertFalse(Cart.objects.exists())
+        self.client.post(reverse('customer_cart'), {'action': 'add', 'product_id': self.drill.id, 'quantity': 2})  # Supera el stock
+        response = self.client.get(reverse('customer_cart'))
+        self.assertEqual([(i.product, i.quantity) for i in response.context['items']], [(self.drill, 2)])
+        self.assertEqual(response.context['cart'].total, Decimal('119980'))
+        # Con carrito propio la página del catálogo no sale de la caché compartida
+        self.assertNotIn('X-Page-Cache', self.client.get(reverse('customer_catalog')))
+
+    def test_tampered_cookie_is_ignored(self):
+        from .session_cart import COOKIE_NAME
+        self.client.cookies[COOKIE_NAME] = '{"%d": 99}' % self.drill.id
+        response = self.client.get(reverse('customer_cart'))
+        self.assertEqual(response.context['items'], [])
+
+    def test_login_merges_respecting_stock(self):
+        from . import cart_service
+        cart = Cart.objects.create(user=self.user)
+        cart_service.add_item(cart, self.drill.id, 2)
+        self.client.post(reverse('customer_cart'), {'action': 'add', 'product_id': self.drill.id, 'quantity': 3})
+        self.client.post(reverse('customer_cart'), {'action': 'add', 'product_id': self.saw.id, 'quantity': 1})
+        response = self.client.post(reverse('login'), {'username': 'cliente', 'password': 'password123'})
+        self.assertRedirects(response, reverse('index'), fetch_redirect_response=False)
+        self.assertEqual(dict(CartItem.objects.filter(cart=cart).values_list('product_id', 'quantity')), {self.drill.id: 3, self.saw.id: 1})
+        cart.refresh_from_db()
+        self.assertEqual(cart.item_count, 4)
+        from .session_cart import COOKIE_NAME
+        self.assertEqual(response.cookies[COOKIE_NAME].value, '')
+
+
+class CartBatchTests(TestCase):
+    def setUp(self):
+        from . import cart_service
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        self.products = [
+            Product.objects.create(name=f'Producto {i}', description='Test', category=category, brand=brand, price=1000 + i, stock=10)
+            for i in range(20)
+        ]
+        self.user = User.objects.create_user(username='cliente', password='password123')
+        self.cart = Cart.objects.create(user=self.user)
+        cart_service.add_item(self.cart, self.products[0].id, 2)
+        cart_service.add_item(self.cart, self.products[1].id, 1)
+        self.api_client = APIClient()
+        self.api_client.force_authenticate(user=self.user)
+        self.url = f'/api/carts/{self.cart.id}/batch/'
+
+    def test_twenty_item_sync_uses_constant_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        operations = [{'op': 'set', 'product_id': p.id, 'quantity': 3} for p in self.products[2:]]
+        operations += [{'op': 'add', 'product_id': self.products[0].id, 'quantity': 1}, {'op': 'remove', 'product_id': self.products[1].id}]
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.api_client.post(self.url, {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['created'], response.data['updated'], response.data['removed']), (18, 1, 1))
+        # Sesión/usuario de DRF aparte: carrito, ítems, productos y 4 escrituras
+        self.assertLessEqual(len([q for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]), 8)
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.item_count, 18 * 3 + 3)
+        self.assertFalse(CartItem.objects.filter(cart=self.cart, product=self.products[1]).exists())
+
+    def test_batch_is_all_or_nothing(self):
+        operations = [
+            {'op': 'add', 'product_id': self.products[2].id, 'quantity': 1},
+            {'op': 'set', 'product_id': self.products[3].id, 'quantity': 11},
+            {'op': 'remove', 'product_id': self.products[4].id},
+            {'op': 'add', 'product_id': 999999},
+        ]
+        response = self.api_client.post(self.url, {'operations': operations}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([e['index'] for e in response.data['errors']], [1, 2, 3])
+        self.assertEqual(CartItem.objects.filter(cart=self.cart).count(), 2)
+        response = self.api_client.post(self.url, {'operations': [{'op': 'move', 'product_id': 1}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        self.drill = Product.objects.create(name='Taladro', description='800W', category=category, brand=brand, price=59990, stock=3)
+        self.saw = Product.objects.create(name='Sierra', description='1400W', category=category, brand=brand, price=89990, stock=2)
+        self.user = User.objects.create_user(username='cliente', password='password123', email='cliente@ferremas.cl')
+        self.address = Address.objects.create(user=self.user, street_address='Calle 1', country='CL', zip_code='8320000', address_type='S')
+
+    def _order(self, lines):
+        order = Order.objects.create(user=self.user, delivery_method='store')
+        for product, quantity in lines:
+            OrderItem.objects.create(order=order, product=product, quantity=quantity, price=product.price)
+        return order
+
+    def test_reserve_is_all_or_nothing(self):
+        from .reservations import reserve_order, ReservationError
+        reserve_order(self._order([(self.drill, 2), (self.saw, 1)]))
+        self.drill.refresh_from_db()
+        self.assertEqual((self.drill.reserved, self.drill.available_stock), (2, 1))
+        with self.assertRaises(ReservationError) as ctx:
+            reserve_order(self._order([(self.drill, 2), (self.saw, 1)]))
+        self.assertEqual(ctx.exception.products, ['Taladro'])
+        self.assertEqual(list(Product.objects.order_by('id').values_list('reserved', flat=True)), [2, 1])
+
+    def test_expired_reservations_are_released(self):
+        from .reservations import reserve_order
+        reserve_order(self._order([(self.drill, 3)]))
+        call_command('release_expired_reservations', stdout=StringIO())
+        self.assertEqual(Product.objects.get(pk=self.drill.pk).reserved, 3)  # Aún vigente
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        out = StringIO()
+        call_command('release_expired_reservations', stdout=out)
+        self.assertIn('Liberadas 1', out.getvalue())
+        self.assertEqual(Product.objects.get(pk=self.drill.pk).reserved, 0)
+        self.assertEqual(StockReservation.objects.get().status, 'released')
+
+    def test_payment_converts_reservations(self):
+        from .reservations import reserve_order, convert_order, release_expired, ReservationError
+        order = self._order([(self.drill, 2), (self.saw, 1)])
+        reserve_order(order)
+        StockReservation.objects.filter(product=self.saw).update(expires_at=timezone.now())
+        release_expired()
+        convert_order(order)  # La Sierra ya no estaba reservada pero queda stock libre
+        self.assertEqual(
+            list(Product.objects.order_by('id').values_list('stock', 'reserved')), [(1, 0), (1, 0)]
+        )
+        # Ambas líneas quedan registradas como descontadas, también la que no tenía reserva
+        self.assertEqual(
+            sorted(StockReservation.objects.filter(order=order, status='converted').values_list('product__name', 'quantity')),
+            [('Sierra', 1), ('Taladro', 2)],
+        )
+        late = self._order([(self.saw, 2)])
+        with self.assertRaises(ReservationError):
+            convert_order(late)
+        self.assertEqual(Product.objects.get(pk=self.saw.pk).stock, 1)
+
+    def test_checkout_session_reserves_stock(self):
+        from unittest import mock
+        self.client.login(username='cliente', password='password123')
+        payload = {'cart_items': [{'product_id': self.drill.id, 'quantity': 2, 'price': 1}], 'delivery_method': 'store', 'shipping_address_id': self.address.id}
+        with mock.patch('core.payments.PaymentGateway.create_checkout_session', return_value=mock.Mock(id='cs_test_1')) as create:
+            response = self.client.post('/api/create-checkout-session/', json.dumps(payload), content_type='application/json')
+            self.assertEqual(response.json(), {'sessionId': 'cs_test_1'})
+            self.assertEqual(create.call_args.args[0]['line_items'][0]['price_data']['unit_amount'], 5999000)  # Precio del catálogo
+            response = self.client.post('/api/create-checkout-session/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Product.objects.get(pk=self.drill.pk).reserved, 2)
+
+
+class BulkStockTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        self.products = [
+            Product.objects.create(name=f'Producto {i}', description='x', category=category, brand=brand, price=1000, stock=3)
+            for i in range(4)
+        ]
+
+    def test_decrement_is_one_update(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from . import stock
+        quantities = stock.quantities_by_product([(p.id, 1) for p in self.products] + [(self.products[0].id, 1)])
+        history = PriceHistory.objects.count()
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(stock.decrement(quantities), 5)
+        self.assertEqual(len([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(list(Product.objects.order_by('id').values_list('stock', flat=True)), [1, 2, 2, 2])
+        self.assertEqual(PriceHistory.objects.count(), history)
+
+    def test_shortage_rolls_back_every_line(self):
+        from . import stock
+        Product.objects.filter(pk=self.products[1].pk).update(reserved=2)
+        with self.assertRaises(stock.OutOfStock) as ctx:
+            stock.decrement({self.products[0].id: 2, self.products[1].id: 2, self.products[2].id: 3})
+        self.assertEqual(ctx.exception.products, ['Producto 1'])  # Sólo 1 unidad libre
+        self.assertEqual(list(Product.objects.order_by('id').values_list('stock', flat=True)), [3, 3, 3, 3])
+
+
+class StockEditTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        self.product = Product.objects.create(name='Taladro', description='800W', category=category, brand=brand, price=59990, stock=5)
+        for number, role in enumerate(['seller', 'warehouse']):
+            user = User.objects.create_user(username=role, password='password123')
+            Employee.objects.create(user=user, rut=f'5000000{number}-{number}', role=role, first_name=role, last_name='Ferremas')
+
+    def _hold_after_read(self, quantity):
+        # Un checkout retiene unidades justo después de que la vista leyó el producto
+        from unittest import mock
+        from django.shortcuts import get_object_or_404
+        from . import stock
+
+        def read_then_hold(*args, **kwargs):
+            product = get_object_or_404(*args, **kwargs)
+            stock.hold({self.product.pk: quantity})
+            return product
+        return mock.patch('core.views.get_object_or_404', side_effect=read_then_hold)
+
+    def test_inventory_update_keeps_concurrent_hold(self):
+        self.client.login(username='warehouse', password='password123')
+        with self._hold_after_read(2):
+            self.client.post(reverse('warehouse_inventory'), {'action': 'stock_update', 'product_id': self.product.pk, 'stock': 8})
+        self.assertEqual(Product.objects.filter(pk=self.product.pk).values_list('stock', 'reserved').get(), (8, 2))
+        with self._hold_after_read(2):
+            self.client.post(reverse('warehouse_inventory'), {'action': 'stock_update', 'product_id': self.product.pk, 'stock': 3})
+        self.assertEqual(Product.objects.filter(pk=self.product.pk).values_list('stock', 'reserved').get(), (8, 4))  # Bajo lo retenido
+
+    def test_restock_above_reserved_never_subtracts_from_reserved(self):
+        # En MySQL las columnas son sin signo: reserved - delta < 0 sería un error 1690
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from . import stock
+        stock.hold({self.product.pk: 1})
+        with CaptureQueriesContext(connection) as ctx:
+            stock.adjust(self.product.pk, 10)
+            stock.adjust(self.product.pk, -3)
+        updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertNotIn('reserved', updates[0])
+        self.assertRegex(updates[1], r'"reserved" \+ ')
+        self.assertEqual(Product.objects.filter(pk=self.product.pk).values_list('stock', 'reserved').get(), (12, 1))
+        with self.assertRaises(stock.OutOfStock):
+            stock.adjust(self.product.pk, -12)
+
+    def test_seller_edit_keeps_concurrent_hold(self):
+        self.client.login(username='seller', password='password123')
+        data = {'product_id': self.product.pk, 'name': 'Taladro percutor', 'description': '800W', 'category': self.product.category_id,
+                'brand': self.product.brand_id, 'price': 54990, 'stock': 7, 'slug': self.product.slug}
+        with self._hold_after_read(3):
+            response = self.client.post(reverse('seller_products'), data)
+        self.assertRedirects(response, reverse('seller_products'))
+        self.assertEqual(Product.objects.filter(pk=self.product.pk).values_list('name', 'stock', 'reserved').get(), ('Taladro percutor', 7, 3))
+
+
+class SequenceTests(TransactionTestCase):  # Los bloques se confirman fuera de la transacción de la prueba
+    def setUp(self):
+        from .sequences import allocator
+        allocator.reset()
+        for name in ('product', 'order'):
+            Sequence.objects.get_or_create(name=name)  # Las crea la migración 0011
+        self.category = Category.objects.create(name='Herramientas')
+        self.brand = Brand.objects.create(name='Bosch')
+        self.user = User.objects.create_user(username='cliente', password='password123')
+
+    def _sequence_writes(self, ctx):
+        return [q['sql'] for q in ctx.captured_queries if 'core_sequence' in q['sql'] and q['sql'].startswith('UPDATE')]
+
+    def test_codes_come_from_blocks_without_count(self):
+        from django.db import connection
+        from django.test import override_settings
+        from django.test.utils import CaptureQueriesContext
+        with override_settings(SEQUENCE_BLOCK_SIZE=5), CaptureQueriesContext(connection) as ctx:
+            orders = [Order.objects.create(user=self.user) for _ in range(6)]
+            product = Product.objects.create(name='Taladro', description='800W', category=self.category, brand=self.brand, price=100, stock=1)
+        self.assertFalse([q['sql'] for q in ctx.captured_queries if 'COUNT(' in q['sql']])
+        self.assertEqual(len(self._sequence_writes(ctx)), 3)  # Dos bloques de órdenes y uno de productos
+        numbers = [int(order.ref_code[4:]) for order in orders]
+        self.assertEqual(numbers, list(range(numbers[0], numbers[0] + 6)))
+        self.assertRegex(product.code, r'^FER-\d{5}$')
+        self.assertEqual(len([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "core_product"')]), 0)
+
+    def test_block_is_committed_outside_callers_transaction(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from unittest import mock
+        from django.db import close_old_connections, connection, transaction
+        from .sequences import allocator
+
+        def stored_next_value():
+            # Lo que ve otra conexión
+            try:
+                return Sequence.objects.get(name='order').next_value
+            finally:
+                close_old_connections()
+
+        before = Sequence.objects.get(name='order').next_value
+        # Como en MySQL; la transacción de la prueba no escribe, así que SQLite admite la segunda conexión
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    inside = allocator.allocate('order')[0]
+                    with ThreadPoolExecutor(max_workers=1) as pool:
+                        self.assertEqual(pool.submit(stored_next_value).result(), before + allocator.block_size())
+                    raise RuntimeError
+        # El rollback no devuelve el bloque: se sigue entregando sin repetir valores
+        self.assertEqual(allocator.allocate('order')[0], inside + 1)
+        self.assertEqual(Sequence.objects.get(name='order').next_value, before + allocator.block_size())
+
+    def test_single_writer_database_reserves_in_callers_transaction(self):
+        from unittest import mock
+        from django.db import connection, transaction
+        from .sequences import allocator
+        with mock.patch.object(connection, 'vendor', 'sqlite'), self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                inside = allocator.allocate('order')[0]
+                raise RuntimeError
+        # La reserva se revierte con la transacción y no queda un
+        # bloque en memoria que vuelva a entregar valores que la tabla también entregará
+        self.assertEqual(allocator.allocate('order')[0], inside)
+
+
+class OrderTotalsTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        self.drill = Product.objects.create(name='Taladro', description='800W', category=category, brand=brand, price=59990, stock=50)
+        self.customer = User.objects.create_user(username='cliente', password='password123')
+        self.seller = User.objects.create_user(username='vendedor', password='password123')
+        Employee.objects.create(user=self.seller, rut='11111111-1', role='seller', first_name='Ana', last_name='Pérez')
+        self.coupon = Coupon.objects.create(code='DESC', amount=20000, valid_from=timezone.now(), valid_to=timezone.now() + timedelta(days=1))
+
+    def _order(self, quantity, coupon=None):
+        from .order_totals import finalize_totals
+        order = Order.objects.create(user=self.customer, delivery_method='store', coupon=coupon)
+        OrderItem.objects.create(order=order, product=self.drill, quantity=quantity, price=self.drill.price)
+        OrderItem.objects.create(order=order, product=self.drill, quantity=1, price=10)
+        finalize_totals(order)
+        order.refresh_from_db()
+        return order
+
+    def test_totals_are_stored_once(self):
+        order = self._order(2, self.coupon)
+        self.assertEqual((order.item_count, order.subtotal, order.discount, order.total), (3, Decimal('119990'), Decimal('20000'), Decimal('99990')))
+        self.assertEqual(order.get_total(), Decimal('99990'))
+        # Un cupón mayor que el subtotal deja el total en cero; uno inactivo no descuenta
+        Coupon.objects.filter(pk=self.coupon.pk).update(amount=500000)
+        self.assertEqual(self._order(1, self.coupon).total, Decimal('0'))
+        Coupon.objects.filter(pk=self.coupon.pk).update(active=False)
+        self.assertEqual(self._order(1, self.coupon).discount, Decimal('0'))
+
+    def test_seller_orders_query_count_is_constant(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        self.client.login(username='vendedor', password='password123')
+        self._order(1)
+        with CaptureQueriesContext(connection) as one:
+            self.client.get(reverse('seller_orders'))
+        for quantity in range(2, 7):
+            self._order(quantity)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(reverse('seller_orders'))
+        self.assertEqual(len(many), len(one))
+        self.assertContains(response, '$119990.00')  # 2 x 59990 + 10
+
+
+class DashboardQueryTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Herramientas')
+        self.brand = Brand.objects.create(name='Bosch')
+        self.staff = {}
+        for number, role in enumerate(['admin', 'seller', 'warehouse', 'accountant']):
+            user = User.objects.create_user(username=role, password='password123')
+            Employee.objects.create(user=user, rut=f'1000000{number}-{number}', role=role, first_name=role, last_name='Ferremas')
+            self.staff[role] = user
+        self.order = self._add_rows()
+
+    def _add_rows(self):
+        # Una orden aprobada con cliente, dos ítems, pago confirmado y reembolso
+        n = Order.objects.count()
+        customer = User.objects.create_user(username=f'cliente{n}', password='password123')
+        product = Product.objects.create(name=f'Producto {n}', description='-', category=self.category, brand=self.brand, price=1000, stock=5)
+        order = Order.objects.create(user=customer, delivery_method='store', status='approved')
+        OrderItem.objects.create(order=order, product=product, quantity=1, price=1000)
+        OrderItem.objects.create(order=order, product=product, quantity=2, price=900)
+        Payment.objects.create(order=order, amount=2800, method='credit', confirmed=True, confirmed_by=self.staff['accountant'])
+        Refund.objects.create(order=order, reason='Producto dañado')
+        return order
+
+    def assertConstantQueries(self, role, url):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        self.client.login(username=role, password='password123')
+        with CaptureQueriesContext(connection) as before:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        for _ in range(4):
+            self._add_rows()
+        with CaptureQueriesContext(connection) as after:
+            self.client.get(url)
+        self.assertEqual(len(after), len(before), url)
+
+    def test_seller_orders(self):
+        self.assertConstantQueries('seller', reverse('seller_orders'))
+
+    def test_warehouse_orders(self):
+        self.assertConstantQueries('warehouse', reverse('warehouse_orders'))
+
+    def test_warehouse_order_detail(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        for _ in range(5):
+            OrderItem.objects.create(order=self.order, product=Product.objects.first(), quantity=1, price=10)
+        self.client.login(username='warehouse', password='password123')
+        self.client.get(reverse('warehouse_order_detail', args=[self.order.id]))  # Sesión y empleado en caché
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('warehouse_order_detail', args=[self.order.id]))
+        # Sesión, usuario, empleado, orden con cliente, ítems con producto y contador del carrito
+        self.assertLessEqual(len(ctx), 6)
+
+    def test_accountant_payments(self):
+        self.assertConstantQueries('accountant', reverse('accountant_payments'))
+
+    def test_admin_refund_management(self):
+        self.assertConstantQueries('admin', reverse('admin_refund_management'))
+
+    def test_admin_user_management(self):
+        self.assertConstantQueries('admin', reverse('admin_user_management'))
+
+
+class StaffTableTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        self.products = [
+            Product.objects.create(name=name, description='-', category=category, brand=brand, price=1000, stock=stock)
+            for name, stock in [('Alicate', 0), ('Broca', 3), ('Cincel', 40)]
+        ]
+        for number, role in enumerate(['seller', 'warehouse', 'accountant', 'admin']):
+            user = User.objects.create_user(username=role, password='password123')
+            Employee.objects.create(user=user, rut=f'2000000{number}-{number}', role=role, first_name=role, last_name='Ferremas')
+        self.ana = User.objects.create_user(username='ana', password='password123')
+        self.luis = User.objects.create_user(username='luis', password='password123')
+        self.orders = []
+        for day, (user, status_) in enumerate([(self.ana, 'pending'), (self.luis, 'approved'), (self.ana, 'approved'), (self.luis, 'prepared'), (self.ana, 'pending')]):
+            order = Order.objects.create(user=user, delivery_method='store', status=status_)
+            Order.objects.filter(pk=order.pk).update(ordered_date=timezone.make_aware(datetime(2026, 3, day + 1, 12)))
+            Payment.objects.create(order=order, amount=1000, method='credit', confirmed=day % 2 == 0)
+            self.orders.append(order)
+
+    def _codes(self, response, name='orders'):
+        return [order.ref_code for order in response.context[name]]
+
+    def test_orders_page_through_newest_first(self):
+        self.client.login(username='seller', password='password123')
+        response = self.client.get(reverse('seller_orders'), {'page_size': 2})
+        self.assertEqual(self._codes(response), [self.orders[4].ref_code, self.orders[3].ref_code])
+        next_url = response.context['table'].next_url
+        self.assertIn('page_size=2', next_url)
+        response = self.client.get(reverse('seller_orders') + next_url)
+        self.assertEqual(self._codes(response), [self.orders[2].ref_code, self.orders[1].ref_code])
+        self.assertIsNotNone(response.context['table'].previous_url)
+
+    def test_orders_filter_by_status_date_and_customer(self):
+        self.client.login(username='seller', password='password123')
+        response = self.client.get(reverse('seller_orders'), {'status': 'approved', 'customer': 'ana'})
+        self.assertEqual(self._codes(response), [self.orders[2].ref_code])
+        response = self.client.get(reverse('seller_orders'), {'date_from': '2026-03-02', 'date_to': '2026-03-03', 'sort': 'oldest'})
+        self.assertEqual(self._codes(response), [self.orders[1].ref_code, self.orders[2].ref_code])
+        # Filtros inválidos se ignoran en vez de fallar
+        response = self.client.get(reverse('seller_orders'), {'status': 'x', 'date_from': '2026-13-40'})
+        self.assertEqual(len(response.context['orders']), 5)
+
+    def test_warehouse_accountant_and_admin_tables(self):
+        self.client.login(username='warehouse', password='password123')
+        response = self.client.get(reverse('warehouse_inventory'), {'stock': 'low'})
+        self.assertEqual([p.name for p in response.context['products']], ['Alicate', 'Broca'])
+        response = self.client.get(reverse('warehouse_inventory'), {'sort': 'name_desc', 'page_size': 1})
+        self.assertEqual([p.name for p in response.context['products']], ['Cincel'])
+        response = self.client.get(reverse('warehouse_orders'), {'status': 'prepared'})
+        self.assertEqual(self._codes(response), [self.orders[3].ref_code])
+
+        self.client.login(username='accountant', password='password123')
+        response = self.client.get(reverse('accountant_payments'), {'confirmed': 'no'})
+        self.assertEqual([p.order.ref_code for p in response.context['payments']], [self.orders[3].ref_code, self.orders[1].ref_code])
+
+        self.client.login(username='admin', password='password123')
+        response = self.client.get(reverse('admin_user_management'), {'role': 'customer'})
+        self.assertEqual([u.username for u in response.context['users']], ['ana', 'luis'])
+
+
+class OrderTransitionTests(TestCase):
+    def setUp(self):
+        self.customer = User.objects.create_user(username='cliente', password='password123')
+        for number, role in enumerate(['seller', 'warehouse']):
+            user = User.objects.create_user(username=role, password='password123')
+            Employee.objects.create(user=user, rut=f'3000000{number}-{number}', role=role, first_name=role, last_name='Ferremas')
+        self.orders = [Order.objects.create(user=self.customer, delivery_method='store', status=s) for s in ['pending', 'pending', 'approved']]
+
+    def test_single_update_enforces_source_state(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .order_states import transition
+        ids = [order.id for order in self.orders] + [999999]
+        with CaptureQueriesContext(connection) as ctx:
+            result = transition(ids, 'approve')
+        updates = [q for q in ctx.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(result.updated, ids[:2])
+        self.assertEqual(set(result.failed), {self.orders[2].id, 999999})
+        self.assertEqual([r['ok'] for r in result.as_list()], [True, True, False, False])
+        # Repetir el lote no vuelve a aplicar el paso
+        self.assertEqual(transition(ids[:2], 'approve').updated, [])
+        self.assertEqual(transition(ids[:3], 'prepare').updated, ids[:3])
+
+    def test_api_bulk_transition_checks_role(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.get(username='warehouse'))
+        url = '/api/orders/transition/'
+        response = client.post(url, {'action': 'approve', 'order_ids': [self.orders[0].id]}, format='json')
+        self.assertEqual(response.status_code, 403)
+        response = client.post(url, {'action': 'prepare', 'order_ids': [o.id for o in self.orders]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['updated'], response.data['failed']), (1, 2))
+        self.assertEqual(response.data['results'][2], {'id': self.orders[2].id, 'ok': True})
+        response = client.post(url, {'action': 'prepare', 'order_ids': ['x']}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_seller_page_approves_selected_orders(self):
+        self.client.login(username='seller', password='password123')
+        response = self.client.post(reverse('seller_orders'), {'action': 'approve', 'order_id': [o.id for o in self.orders]}, follow=True)
+        self.assertEqual(list(Order.objects.order_by('id').values_list('status', flat=True)), ['approved'] * 3)
+        self.assertContains(response, '2 orden(es) pasaron a')
+        self.client.post(reverse('seller_orders'), {'action': 'deliver', 'order_id': [self.orders[0].id]})
+        self.assertEqual(Order.objects.get(pk=self.orders[0].id).status, 'approved')
+
+
+class PickListTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        self.drill = Product.objects.create(name='Taladro', description='-', category=category, brand=brand, price=1000, stock=5)
+        self.saw = Product.objects.create(name='Sierra', description='-', category=category, brand=brand, price=2000, stock=1)
+        customer = User.objects.create_user(username='cliente', password='password123')
+        user = User.objects.create_user(username='bodega', password='password123')
+        Employee.objects.create(user=user, rut='40000000-0', role='warehouse', first_name='Bo', last_name='Dega')
+        self.orders = []
+        for status_, lines in [('approved', [(self.drill, 2), (self.saw, 1)]), ('approved', [(self.drill, 1), (self.saw, 1)]), ('pending', [(self.drill, 9)])]:
+            order = Order.objects.create(user=customer, delivery_method='store', status=status_)
+            for product, quantity in lines:
+                OrderItem.objects.create(order=order, product=product, quantity=quantity, price=product.price)
+            self.orders.append(order)
+
+    def test_single_grouped_query(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .picking import iter_pick_list
+        with CaptureQueriesContext(connection) as ctx:
+            rows = {row['name']: row for row in iter_pick_list()}
+        self.assertEqual(len(ctx), 1)
+        self.assertEqual((rows['Taladro']['units'], rows['Taladro']['orders'], rows['Taladro']['remaining'], rows['Taladro']['shortage']), (3, 2, 2, 0))
+        self.assertEqual((rows['Sierra']['units'], rows['Sierra']['remaining'], rows['Sierra']['shortage']), (2, -1, 1))
+        batch = {row['name']: row['units'] for row in iter_pick_list([self.orders[1].id, self.orders[2].id])}
+        self.assertEqual(batch, {'Taladro': 1, 'Sierra': 1})  # La orden pendiente no se retira
+
+    def test_pages_and_streamed_csv(self):
+        self.client.login(username='bodega', password='password123')
+        response = self.client.get(reverse('warehouse_pick_list'))
+        self.assertContains(response, 'faltan 1')
+        response = self.client.get(reverse('warehouse_pick_list_csv'), {'order_id': self.orders[0].id})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(lines[0].split(',')[:4], ['Código', 'Producto', 'Categoría', 'Unidades'])
+        self.assertEqual([line.split(',')[1:4] for line in lines[1:]], [['Sierra', 'Herramientas', '1'], ['Taladro', 'Herramientas', '2']])
+
+    def test_paid_orders_are_not_counted_twice(self):
+        from django.test import override_settings
+        from .reservations import reserve_order
+        from .order_states import transition
+        from .picking import iter_pick_list
+        from .webhook_fakes import FakeStripeEvents
+        Order.objects.filter(pk__in=[o.pk for o in self.orders]).update(status='delivered')
+        Product.objects.filter(pk=self.drill.pk).update(stock=10)
+        order = Order.objects.create(user=User.objects.get(username='cliente'), delivery_method='store')
+        OrderItem.objects.create(order=order, product=self.drill, quantity=10, price=1000)
+        reserve_order(order)
+        with override_settings(STRIPE_WEBHOOK_SECRET='whsec_test', WEBHOOK_QUEUE={'ASYNC': False}):
+            events = FakeStripeEvents()
+            with self.captureOnCommitCallbacks(execute=True):
+                events.post(self.client, events.checkout_completed(order))
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'pending')
+        transition([order.pk], 'approve')  # El vendedor la aprueba
+        self.assertEqual(Product.objects.get(pk=self.drill.pk).stock, 0)  # El pago ya descontó las 10
+        # Un contador vuelve a confirmar el pago: no cambia lo que pasó con el stock
+        Payment.objects.filter(order=order).update(confirmed_by=User.objects.get(username='bodega'))
+        # Otra orden pagada por otro medio y confirmada a mano: su stock sigue sin descontar
+        manual = Order.objects.create(user=order.user, delivery_method='store', status='approved')
+        OrderItem.objects.create(order=manual, product=self.drill, quantity=1, price=1000)
+        Payment.objects.create(order=manual, amount=1000, method='transfer', confirmed=True, confirmed_by=User.objects.get(username='bodega'))
+        row = next(row for row in iter_pick_list() if row['name'] == 'Taladro')
+        self.assertEqual((row['units'], row['stock'], row['remaining'], row['shortage']), (11, 10, -1, 1))
+        row = next(row for row in iter_pick_list([order.pk]) if row['name'] == 'Taladro')
+        self.assertEqual((row['units'], row['stock'], row['remaining'], row['shortage']), (10, 10, 0, 0))
+
+
+class WebhookQueueTests(TestCase):
+    def setUp(self):
+        from django.test import override_settings
+        from .webhook_fakes import FakeStripeEvents
+        self.settings_override = override_settings(STRIPE_WEBHOOK_SECRET='whsec_test', WEBHOOK_QUEUE={'ASYNC': False, 'MAX_ATTEMPTS': 2, 'RETRY_DELAY': 60})
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.events = FakeStripeEvents()
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        self.drill = Product.objects.create(name='Taladro', description='-', category=category, brand=brand, price=1000, stock=5)
+        self.user = User.objects.create_user(username='cliente', password='password123')
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.drill, quantity=2, price=1000)
+        self.order = Order.objects.create(user=self.user, delivery_method='store')
+        OrderItem.objects.create(order=self.order, product=self.drill, quantity=2, price=1000)
+
+    def _post(self, event):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.events.post(self.client, event)
+
+    def test_duplicate_deliveries_are_processed_once(self):
+        from .reservations import reserve_order
+        reserve_order(self.order)
+        event = self.events.checkout_completed(self.order, payment_intent_id='pi_1')
+        self.assertEqual(self._post(event).json()['status'], 'queued')
+        self.assertEqual(self._post(event).json()['status'], 'duplicate')
+        # El mismo pago notificado como payment_intent.succeeded no vuelve a descontar stock
+        self._post(self.events.payment_intent('payment_intent.succeeded', 'pi_1'))
+        self.assertEqual(list(WebhookEvent.objects.values_list('status', flat=True)), ['done', 'done'])
+        self.drill.refresh_from_db()
+        self.assertEqual((self.drill.stock, self.drill.reserved), (3, 0))
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'pending')  # Pagada, a la espera de la aprobación del vendedor
+        self.assertTrue(Payment.objects.get(order=self.order).confirmed)
+        self.assertFalse(CartItem.objects.filter(cart__user=self.user).exists())
+
+    def test_invalid_signature_is_rejected(self):
+        from .webhook_fakes import FakeStripeEvents
+        response = FakeStripeEvents(secret='whsec_other').post(self.client, self.events.checkout_completed(self.order))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_retries_keep_events_of_an_order_in_sequence(self):
+        from unittest import mock
+        from . import webhooks
+        first = self._queue(self.events.payment_intent('payment_intent.succeeded', 'pi_2', order=self.order))
+        second = self._queue(self.events.checkout_expired(self.order))
+        with mock.patch.dict(webhooks.HANDLERS, {'payment_intent.succeeded': mock.Mock(side_effect=RuntimeError('Stripe caído'))}):
+            webhooks.drain()
+            first.refresh_from_db()
+            self.assertEqual((first.status, first.attempts, first.last_error), ('pending', 1, 'Stripe caído'))
+            self.assertEqual(WebhookEvent.objects.get(pk=second.pk).status, 'pending')  # Espera a la anterior de su orden
+            WebhookEvent.objects.filter(pk=first.pk).update(available_at=timezone.now())
+            call_command('process_webhook_events', stdout=StringIO())
+        self.assertEqual(list(WebhookEvent.objects.order_by('pk').values_list('status', 'attempts')), [('failed', 2), ('done', 1)])
+
+    def _queue(self, event):
+        from .webhooks import receive
+        payload, header = self.events.sign(event)
+        return receive(payload.encode(), header)[0]
+
+
+class PaymentGatewayTests(TestCase):
+    def setUp(self):
+        from django.test import override_settings
+        from .payment_fakes import FakeStripeServer
+        from .payments import reset_gateway
+        self.server = FakeStripeServer().start()
+        self.addCleanup(self.server.stop)
+        override = override_settings(STRIPE_SECRET_KEY='sk_test_fake', PAYMENT_GATEWAY={
+            'API_BASE': self.server.url, 'BACKOFF': 0, 'MAX_RETRIES': 2, 'BREAKER_THRESHOLD': 3, 'BREAKER_RESET': 60,
+        })
+        override.enable()
+        self.addCleanup(override.disable)
+        reset_gateway()
+        self.addCleanup(reset_gateway)
+
+    def test_retries_reuse_idempotency_key(self):
+        from .payments import get_gateway
+        self.server.fail(2)
+        intent = get_gateway().create_payment_intent({'amount': 1000, 'currency': 'clp'}, idempotency_key='payment-intent-1-1000')
+        self.assertTrue(intent.client_secret.startswith(intent.id))
+        self.assertEqual([key for _, _, key in self.server.requests], ['payment-intent-1-1000'] * 3)
+        again = get_gateway().create_payment_intent({'amount': 1000, 'currency': 'clp'}, idempotency_key='payment-intent-1-1000')
+        self.assertEqual(again.id, intent.id)  # Stripe devuelve la misma respuesta
+        stats = get_gateway().metrics_snapshot()['payment_intent']
+        self.assertEqual((stats['calls'], stats['errors'], stats['retries']), (4, 2, 2))
+
+    def test_request_errors_are_not_retried(self):
+        from .payments import get_gateway
+        self.server.fail(1, status=400)
+        with self.assertRaises(stripe.error.InvalidRequestError):
+            get_gateway().create_customer({'email': 'cliente@ferremas.cl'})
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(get_gateway().breaker.state, 'closed')
+
+    def test_breaker_fails_fast_and_recovers(self):
+        from .payments import PaymentUnavailable, get_gateway
+        gateway = get_gateway()
+        self.server.fail(3)
+        with self.assertRaises(PaymentUnavailable):
+            gateway.create_customer({'email': 'cliente@ferremas.cl'})
+        self.assertEqual(gateway.breaker.state, 'open')
+        with self.assertRaises(PaymentUnavailable):
+            gateway.create_customer({'email': 'cliente@ferremas.cl'})
+        self.assertEqual(len(self.server.requests), 3)  # La segunda no salió del proceso
+        gateway.breaker.opened_at -= 60  # Pasa el tiempo de espera: una llamada de prueba
+        gateway.create_customer({'email': 'cliente@ferremas.cl'})
+        self.assertEqual(gateway.breaker.state, 'closed')
+
+    def test_checkout_releases_stock_when_gateway_is_down(self):
+        import time
+        from .payments import get_gateway
+        category = Category.objects.create(name='Herramientas')
+        brand = Brand.objects.create(name='Bosch')
+        drill = Product.objects.create(name='Taladro', description='800W', category=category, brand=brand, price=59990, stock=3)
+        user = User.objects.create_user(username='cliente', password='password123', email='cliente@ferremas.cl')
+        address = Address.objects.create(user=user, street_address='Calle 1', country='CL', zip_code='8320000', address_type='S')
+        self.client.login(username='cliente', password='password123')
+        payload = {'cart_items': [{'product_id': drill.id, 'quantity': 2}], 'delivery_method': 'store', 'shipping_address_id': address.id}
+        response = self.client.post('/api/create-checkout-session/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        order = Order.objects.get()
+        self.assertEqual(self.server.requests[-1][2], f'checkout-session-{order.id}')
+        self.assertEqual(self.server.requests[-1][1]['metadata'], {'order_id': str(order.id)})
+        get_gateway().breaker.opened_at = time.monotonic()
+        payload['cart_items'][0]['quantity'] = 1
+        response = self.client.post('/api/create-checkout-session/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Product.objects.get(pk=drill.pk).reserved, 2)
+
+
+class ExchangeRateTests(TestCase):
+    def setUp(self):
+        from unittest import mock
+        from django.test import override_settings
+        from .exchange_rates import reset_service
+        override = override_settings(EXCHANGE_RATES={'URL': 'https://rates.test/CLP', 'TTL': 60, 'MAX_STALE': 600, 'ASYNC': False})
+        override.enable()
+        self.addCleanup(override.disable)
+        reset_service()
+        self.addCleanup(reset_service)
+        self.get = mock.patch('requests.Session.get').start()
+        self.addCleanup(mock.patch.stopall)
+        self.get.return_value.json.return_value = {'base': 'CLP', 'rates': {'USD': 0.001, 'EUR': 0.0009}}
+
+    def _convert(self, amount, currency):
+        return self.client.post('/api/convert-currency/', json.dumps({'amount_clp': amount, 'target_currency': currency}), content_type='application/json')
+
+    def test_cold_start_uses_persisted_table(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        ExchangeRateTable.objects.create(base='CLP', rates={'USD': 0.002}, fetched_at=timezone.now())
+        self.assertEqual(self._convert(1000, 'USD').json()['converted_amount'], 2.0)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self._convert(5000, 'USD')
+        self.assertEqual(response.json()['converted_amount'], 10.0)
+        self.assertEqual(len(ctx.captured_queries), 0)
+        self.get.assert_not_called()
+        self.assertEqual(self._convert(1000, 'JPY').status_code, 400)
+
+    def test_concurrent_cold_start_fetches_once(self):
+        import time
+        import requests
+        from concurrent.futures import ThreadPoolExecutor
+        from unittest import mock
+        from .exchange_rates import ExchangeRateService, RatesUnavailable, _config
+
+        def slow_get(*args, **kwargs):
+            time.sleep(0.05)
+            return response
+        response = self.get.return_value
+        self.get.side_effect = slow_get
+
+        def convert_all(service):
+            def convert(_):
+                try:
+                    return service.convert(1000, 'USD')
+                except RatesUnavailable:
+                    return None
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                return list(pool.map(convert, range(8)))
+
+        # Sin tabla guardada; la base se deja fuera para que los hilos no compitan por ella
+        with mock.patch.object(ExchangeRateService, '_load', return_value=None), \
+                mock.patch('core.exchange_rates.ExchangeRateTable.objects.update_or_create'):
+            self.assertEqual(convert_all(ExchangeRateService(_config())), [1.0] * 8)
+            self.assertEqual(self.get.call_count, 1)
+            self.get.reset_mock()
+            self.get.side_effect = requests.ConnectionError('sin red')
+            self.assertEqual(convert_all(ExchangeRateService(_config())), [None] * 8)
+            self.assertEqual(self.get.call_count, 1)  # Las demás no repiten la llamada fallida
+
+    def test_stale_table_is_served_and_refreshed(self):
+        ExchangeRateTable.objects.create(base='CLP', rates={'USD': 0.002}, fetched_at=timezone.now() - timedelta(seconds=120))
+        self.assertEqual(self._convert(1000, 'USD').status_code, 200)
+        self.get.assert_called_once()
+        self.assertEqual(self.get.call_args.args[0], 'https://rates.test/CLP')
+        self.assertEqual(ExchangeRateTable.objects.get().rates['USD'], 0.001)
+        self.assertEqual(self._convert(1000, 'USD').json()['converted_amount'], 1.0)
+        self.get.assert_called_once()
+
+    def test_failed_refresh_keeps_table_until_max_stale(self):
+        import requests
+        self.get.side_effect = requests.ConnectionError('sin red')
+        self.assertEqual(self._convert(1000, 'USD').status_code, 503)
+        ExchangeRateTable.objects.create(base='CLP', rates={'USD': 0.002}, fetched_at=timezone.now() - timedelta(seconds=120))
+        from .exchange_rates import get_service, reset_service
+        get_service()._retry_at = 0
+        self.assertEqual(self._convert(1000, 'USD').json()['converted_amount'], 2.0)  # Vencida pero utilizable
+        self.assertEqual(self.get.call_count, 2)
+        self._convert(1000, 'USD')
+        self.assertEqual(self.get.call_count, 2)  # Espera RETRY_DELAY antes de volver a intentar
+        ExchangeRateTable.objects.update(fetched_at=timezone.now() - timedelta(seconds=900))
+        reset_service()  # Proceso nuevo con una tabla guardada más vieja que MAX_STALE
+        self.assertEqual(self._convert(1000, 'USD').status_code, 503)
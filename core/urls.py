@@ -47,11 +47,14 @@ urlpatterns = [
     path('warehouse/orders/', views.warehouse_orders, name='warehouse_orders'),
     path('warehouse/inventory/', views.warehouse_inventory, name='warehouse_inventory'),
     path('warehouse/orders/<int:order_id>/', views.warehouse_order_detail, name='warehouse_order_detail'),
+    path('warehouse/pick-list/', views.warehouse_pick_list, name='warehouse_pick_list'),
+    path('warehouse/pick-list.csv', views.warehouse_pick_list_csv, name='warehouse_pick_list_csv'),
     # Vistas para contadores
     path('accountant/payments/', views.accountant_payments, name='accountant_payments'),
     # APIs
     path('api/', include(router.urls)),
     path('api/create-payment-intent/', api_views.create_payment_intent, name='create_payment_intent'),
+    path('api/create-checkout-session/', views.create_checkout_session, name='create_checkout_session'),
     path('api/webhook/', api_views.stripe_webhook, name='stripe_webhook'),
     path('api/convert-currency/', api_views.convert_currency, name='convert_currency'),
 ]
\ No newline at end of file
@@ -2,7 +2,8 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm, PasswordChangeForm, UserCreationForm
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from urllib.parse import urlencode
 from django.views.decorators.csrf import csrf_exempt
 from django import forms
 from django.contrib import messages
@@ -13,13 +14,30 @@ from django.conf import settings
 from rest_framework import viewsets, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from .models import Product, Category, Brand, Cart, CartItem, Order, OrderItem, Payment, Address, Coupon, Refund, Employee, UserProfile, PriceHistory
+from .models import Product, Category, Brand, Cart, Order, OrderItem, Payment, Address, Coupon, Refund, Employee, UserProfile, PriceHistory
 from .serializers import ProductSerializer, CategorySerializer, BrandSerializer, CartSerializer, OrderSerializer, PaymentSerializer, AddressSerializer, CouponSerializer, RefundSerializer, EmployeeSerializer, UserProfileSerializer, UserSerializer
 from django.contrib.auth.models import User
 from .permissions import IsSeller, IsWarehouse, IsAccountant, IsAdmin
 from .forms import UserForm, EmployeeForm, AddressForm
-from django.db.models import Q
 from django.core.serializers.json import DjangoJSONEncoder
+from .search import search_products
+from .facets import catalog_facets
+from .page_cache import cache_page_with_tags, catalog_tags, index_tags, product_tags
+from .price_history import price_buckets
+from . import cart_service
+from .session_cart import SessionCart, merge_into_user_cart
+from .order_totals import finalize_totals
+from .querysets import order_with_items, staff_orders, staff_payments, staff_refunds, staff_users
+from .order_states import STATUS_LABELS, TRANSITIONS, TransitionError, allowed_actions, transition
+from .picking import iter_pick_list, pick_list_csv_rows
+from .tables import OrderTable, PaymentTable, ProductTable, UserTable, WarehouseOrderTable
+from .reservations import ReservationError, release_order, reservation_ttl, reserve_order
+from .stock import OutOfStock, adjust as adjust_stock
+from .payments import PaymentUnavailable, get_gateway
+from .webhooks import InvalidWebhook, receive
+from django.db import transaction
+from django.utils import timezone
+from .pagination import KeysetPaginator, InvalidCursor, PRODUCT_ORDERINGS, SEARCH_ORDERING, clamp_page_size, with_final_price
 
 # Configurar logging
 logger = logging.getLogger(__name__)
@@ -106,14 +124,15 @@ class ProductViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'], permission_classes=[permissions.AllowAny])
     def details(self, request, pk=None):
         product = self.get_object()
-        serializer = ProductSerializer(product)
+        # Cierre mensual desde los resúmenes en vez de todas las filas de PriceHistory
+        buckets = price_buckets(product, 'month', product.created_at, timezone.localdate())
         return Response({
             'Código del producto': product.code,
             'Marca': product.brand.name,
             'Nombre': product.name,
             'Precio': [
-                {'Fecha': history.created_at.isoformat(), 'Valor': float(history.price)}
-                for history in product.price_history.all()
+                {'Fecha': bucket['bucket_start'].isoformat(), 'Valor': float(bucket['close'])}
+                for bucket in buckets
             ]
         })
 
@@ -136,16 +155,13 @@ class CartViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def add_item(self, request, pk=None):
         cart = self.get_object()
-        product_id = request.data.get('product_id')
-        quantity = int(request.data.get('quantity', 1))
         try:
-            product = Product.objects.get(id=product_id)
-            if product.stock < quantity:
-                return Response({'error': 'Stock insuficiente'}, status=400)
-            CartItem.objects.create(cart=cart, product=product, quantity=quantity, price=product.get_final_price())
-            return Response({'status': 'item added'})
-        except Product.DoesNotExist:
+            cart_service.add_item(cart, request.data.get('product_id'), request.data.get('quantity', 1))
+        except cart_service.ProductNotFound:
             return Response({'error': 'Producto no encontrado'}, status=404)
+        except cart_service.CartError as e:
+            return Response({'error': str(e)}, status=400)
+        return Response({'status': 'item added'})
 
 class OrderViewSet(viewsets.ModelViewSet):
     queryset = Order.objects.all()
@@ -164,19 +180,20 @@ class OrderViewSet(viewsets.ModelViewSet):
             return Order.objects.all()
         return Order.objects.filter(user=self.request.user)
 
+    def _transition(self, action):
+        order = self.get_object()
+        result = transition([order.pk], action)
+        if result.failed:
+            return Response({'error': result.failed[order.pk]}, status=409)
+        return Response({'status': f'order {TRANSITIONS[action][1]}'})
+
     @action(detail=True, methods=['post'], permission_classes=[IsSeller])
     def approve(self, request, pk=None):
-        order = self.get_object()
-        order.status = 'approved'
-        order.save()
-        return Response({'status': 'order approved'})
+        return self._transition('approve')
 
     @action(detail=True, methods=['post'], permission_classes=[IsWarehouse])
     def prepare(self, request, pk=None):
-        order = self.get_object()
-        order.status = 'prepared'
-        order.save()
-        return Response({'status': 'order prepared'})
+        return self._transition('prepare')
 
 class PaymentViewSet(viewsets.ModelViewSet):
     queryset = Payment.objects.all()
@@ -219,10 +236,17 @@ class UserViewSet(viewsets.ModelViewSet):
     serializer_class = UserSerializer
     permission_classes = [IsAdmin]
 
+@cache_page_with_tags(index_tags)
 def index(request):
     featured_products = Product.objects.filter(stock__gt=0).order_by('-id')[:3]
     return render(request, 'index.html', {'featured_products': featured_products})
 
+def _merge_session_cart(request, response, user):
+    # Pasa el carrito anónimo (cookie) al carrito del usuario recién autenticado
+    trimmed = merge_into_user_cart(request, response, user)
+    if trimmed:
+        messages.warning(request, f'Se ajustó la cantidad por stock disponible de: {", ".join(trimmed)}.')
+
 def register(request):
     if request.method == 'POST':
         form = UserCreationForm(request.POST)
@@ -230,7 +254,9 @@ def register(request):
             user = form.save()
             login(request, user)
             messages.success(request, 'Registro exitoso. ¡Bienvenido!')
-            return redirect('index')
+            response = redirect('index')
+            _merge_session_cart(request, response, user)
+            return response
     else:
         form = UserCreationForm()
     return render(request, 'register.html', {'form': form})
@@ -247,7 +273,9 @@ def login_view(request):
             if user is not None:
                 login(request, user)
                 messages.success(request, 'Bienvenido de nuevo.')
-                return redirect('index')
+                response = redirect('index')
+                _merge_session_cart(request, response, user)
+                return response
         messages.error(request, 'Credenciales incorrectas. Por favor, intenta de nuevo.')
     else:
         form = AuthenticationForm()
@@ -271,116 +299,119 @@ def change_password(request):
         form = PasswordChangeForm(user=request.user)
     return render(request, 'change_password.html', {'form': form})
 
+@cache_page_with_tags(catalog_tags)
 def customer_catalog(request):
-    products = Product.objects.all()
-    categories = Category.objects.all()
-    brands = Brand.objects.all()
+    products = Product.objects.select_related('category', 'brand')
     
     search_query = request.GET.get('search')
     category_id = request.GET.get('category')
     brand_id = request.GET.get('brand')
+    sort = request.GET.get('sort')
     
+    ordering = PRODUCT_ORDERINGS.get(sort, PRODUCT_ORDERINGS['newest'])
     if search_query:
-        products = products.filter(Q(name__icontains=search_query) | Q(description__icontains=search_query))
+        products = search_products(products, search_query)
+        if sort not in PRODUCT_ORDERINGS:
+            ordering = SEARCH_ORDERING
     if category_id:
         products = products.filter(category_id=category_id)
     if brand_id:
         products = products.filter(brand_id=brand_id)
     
+    page_size = clamp_page_size(request.GET.get('page_size'))
+    paginator = KeysetPaginator(with_final_price(products), ordering, page_size)
+    try:
+        page = paginator.get_page(request.GET.get('cursor'))
+    except InvalidCursor:
+        page = paginator.get_page()
+    
+    # Enlaces de navegación conservando los filtros actuales
+    params = request.GET.copy()
+    params.pop('cursor', None)
+    next_url = previous_url = None
+    if page.next_cursor:
+        params['cursor'] = page.next_cursor
+        next_url = f'?{params.urlencode()}'
+    if page.previous_cursor:
+        params['cursor'] = page.previous_cursor
+        previous_url = f'?{params.urlencode()}'
+    
+    # Conteos por categoría y marca desde caché (una consulta agrupada si no está)
+    facets = catalog_facets(search_query, category_id, brand_id)
+    
     return render(request, 'customer/catalog.html', {
-        'products': products,
-        'categories': categories,
-        'brands': brands
+        'products': page,
+        'categories': facets['categories'],
+        'brands': facets['brands'],
+        'next_url': next_url,
+        'previous_url': previous_url,
     })
 
+@cache_page_with_tags(product_tags)
 def customer_product_detail(request, slug):
     product = get_object_or_404(Product, slug=slug)
     return render(request, 'customer/product_detail.html', {'product': product})
 
-@login_required
+def anonymous_cart(request):
+    # Carrito en cookie firmada: no escribe en la base de datos hasta iniciar sesión
+    session_cart = SessionCart.from_request(request)
+    if request.method == 'POST':
+        action = request.POST.get('action')
+        try:
+            if action == 'add':
+                change = session_cart.add(request.POST.get('product_id'), request.POST.get('quantity', '1'))
+                if change.created:
+                    messages.success(request, f'{change.product_name} añadido al carrito.')
+                else:
+                    messages.success(request, f'Se añadieron {change.quantity} unidad(es) de {change.product_name} al carrito.')
+            elif action == 'remove':
+                change = session_cart.remove(request.POST.get('item_id'))
+                messages.success(request, f'{change.product_name} eliminado del carrito.')
+            elif action == 'update':
+                change = session_cart.set_quantity(request.POST.get('item_id'), request.POST.get('quantity', '1'))
+                messages.success(request, f'Cantidad de {change.product_name} actualizada.')
+        except cart_service.CartError as e:
+            messages.error(request, str(e))
+        response = redirect('customer_cart')
+        session_cart.save(response)
+        return response
+    items = session_cart.items()
+    return render(request, 'customer/cart.html', {'cart': session_cart, 'items': items})
+
 def customer_cart(request):
+    if not request.user.is_authenticated:
+        return anonymous_cart(request)
     cart, created = Cart.objects.get_or_create(user=request.user)
     logger.debug(f"Carrito para {request.user.username}: ID {cart.id}, Creado: {created}")
 
     if request.method == 'POST':
         logger.debug(f"Solicitud POST: {request.POST}")
         action = request.POST.get('action')
-        if action == 'add':
-            product_id = request.POST.get('product_id')
-            quantity = request.POST.get('quantity', '1')
-            try:
-                quantity = int(quantity)
-                product = get_object_or_404(Product, id=product_id)
-                if quantity <= 0:
-                    messages.error(request, 'La cantidad debe ser mayor a 0.')
-                    logger.warning(f"Cantidad inválida: {quantity}")
-                elif quantity <= product.stock:
-                    cart_item, item_created = CartItem.objects.get_or_create(
-                        cart=cart, product=product, defaults={'price': product.get_final_price(), 'quantity': quantity}
-                    )
-                    if not item_created:
-                        new_quantity = cart_item.quantity + quantity
-                        if new_quantity <= product.stock:
-                            cart_item.quantity = new_quantity
-                            cart_item.price = product.get_final_price()
-                            cart_item.save()
-                            messages.success(request, f'Se añadieron {quantity} unidad(es) de {product.name} al carrito.')
-                            logger.debug(f"Actualizado {product.name}: Cantidad {cart_item.quantity}")
-                        else:
-                            messages.error(request, f'No hay suficiente stock para añadir {quantity} unidad(es) más.')
-                            logger.warning(f"Stock insuficiente para {product.name}: Solicitado {new_quantity}, Disponible {product.stock}")
-                    else:
-                        messages.success(request, f'{product.name} añadido al carrito.')
-                        logger.debug(f"Añadido nuevo ítem: {product.name}, Cantidad {quantity}")
-                else:
-                    messages.error(request, f'No hay suficiente stock. Solo hay {product.stock} unidad(es) disponibles.')
-                    logger.warning(f"Stock insuficiente para {product.name}: Solicitado {quantity}, Disponible {product.stock}")
-            except ValueError:
-                messages.error(request, 'Cantidad inválida.')
-                logger.error(f"Cantidad no válida: {quantity}")
-            except Product.DoesNotExist:
-                messages.error(request, 'Producto no encontrado.')
-                logger.error(f"Producto no encontrado: ID {product_id}")
-        elif action == 'remove':
-            item_id = request.POST.get('item_id')
-            try:
-                cart_item = get_object_or_404(CartItem, id=item_id, cart=cart)
-                product_name = cart_item.product.name
-                cart_item.delete()
-                messages.success(request, f'{product_name} eliminado del carrito.')
-                logger.debug(f"Eliminado {product_name}: ID {item_id}")
-            except CartItem.DoesNotExist:
-                messages.error(request, 'Ítem no encontrado.')
-                logger.error(f"Ítem no encontrado: ID {item_id}")
-        elif action == 'update':
-            item_id = request.POST.get('item_id')
-            quantity = request.POST.get('quantity', '1')
-            try:
-                quantity = int(quantity)
-                cart_item = get_object_or_404(CartItem, id=item_id, cart=cart)
-                if quantity <= 0:
-                    messages.error(request, 'La cantidad debe ser mayor a 0.')
-                    logger.warning(f"Cantidad inválida: {quantity}")
-                elif quantity <= cart_item.product.stock:
-                    cart_item.quantity = quantity
-                    cart_item.price = cart_item.product.get_final_price()
-                    cart_item.save()
-                    messages.success(request, f'Cantidad de {cart_item.product.name} actualizada.')
-                    logger.debug(f"Actualizado {cart_item.product.name}: Nueva cantidad {quantity}")
+        # Cada acción es una lectura y una escritura atómica (ver core.cart_service)
+        try:
+            if action == 'add':
+                change = cart_service.add_item(cart, request.POST.get('product_id'), request.POST.get('quantity', '1'))
+                if change.created:
+                    messages.success(request, f'{change.product_name} añadido al carrito.')
                 else:
-                    messages.error(request, f'No hay suficiente stock. Solo hay {cart_item.product.stock} unidad(es) disponibles.')
-                    logger.warning(f"Stock insuficiente para {cart_item.product.name}: Solicitado {quantity}, Disponible {cart_item.product.stock}")
-            except ValueError:
-                messages.error(request, 'Cantidad inválida.')
-                logger.error(f"Cantidad no válida: {quantity}")
-            except CartItem.DoesNotExist:
-                messages.error(request, 'Ítem no encontrado.')
-                logger.error(f"Ítem no encontrado: ID {item_id}")
+                    messages.success(request, f'Se añadieron {change.quantity} unidad(es) de {change.product_name} al carrito.')
+                logger.debug(f"Añadido {change.product_name}: Cantidad {change.quantity}")
+            elif action == 'remove':
+                change = cart_service.remove_item(cart, request.POST.get('item_id'))
+                messages.success(request, f'{change.product_name} eliminado del carrito.')
+                logger.debug(f"Eliminado {change.product_name}: ID {request.POST.get('item_id')}")
+            elif action == 'update':
+                change = cart_service.set_quantity(cart, request.POST.get('item_id'), request.POST.get('quantity', '1'))
+                messages.success(request, f'Cantidad de {change.product_name} actualizada.')
+                logger.debug(f"Actualizado {change.product_name}: Nueva cantidad {change.quantity}")
+        except cart_service.CartError as e:
+            messages.error(request, str(e))
+            logger.warning(f"Acción de carrito '{action}' rechazada: {e}")
         return redirect('customer_cart')
 
-    items = cart.items.all()
+    items = list(cart.items.select_related('product'))
     logger.debug(f"Ítems en carrito ID {cart.id}: {[f'{item.product.name} x {item.quantity}' for item in items]}")
-    return render(request, 'customer/cart.html', {'cart': cart})
+    return render(request, 'customer/cart.html', {'cart': cart, 'items': items})
 
 @login_required
 def customer_add_address(request):
@@ -400,6 +431,8 @@ def customer_add_address(request):
 def customer_checkout(request):
     cart, created = Cart.objects.get_or_create(user=request.user)
     addresses = Address.objects.filter(user=request.user)
+    # Los ítems se cargan una sola vez (con su producto); el total viene almacenado en el carrito
+    items = list(cart.items.select_related('product'))
     cart_items = [
         {
             'product_id': item.product.id,
@@ -408,22 +441,23 @@ def customer_checkout(request):
             'total_price': float(item.get_total_price()),
             'name': item.product.name
         }
-        for item in cart.items.all()
+        for item in items
     ]
-    cart_total_cents = int(cart.get_total() * 100)
+    cart_total_cents = int(cart.total * 100)
     return render(request, 'customer/checkout.html', {
         'cart': cart,
+        'items': items,
         'addresses': addresses,
         'publishable_key': settings.STRIPE_PUBLISHABLE_KEY,
         'cart_items_json': json.dumps(cart_items, cls=DjangoJSONEncoder),
         'cart_total_cents': cart_total_cents
     })
 
-@csrf_exempt
+@login_required
 def create_checkout_session(request):
     if request.method != 'POST':
         return JsonResponse({'error': 'Método no permitido'}, status=405)
-    
+
     try:
         data = json.loads(request.body)
         cart_items = data.get('cart_items')
@@ -434,52 +468,71 @@ def create_checkout_session(request):
             return JsonResponse({'error': 'Datos incompletos'}, status=400)
 
         shipping_address = get_object_or_404(Address, id=shipping_address_id, user=request.user)
-        
-        # Crear la orden
-        order = Order.objects.create(
-            user=request.user,
-            delivery_method=delivery_method,
-            shipping_address=shipping_address,
-            status='pending'
-        )
 
-        # Añadir ítems a la orden
+        # Productos en una sola consulta; precios y nombres salen del catálogo, no del cliente
+        quantities = {}
         for item in cart_items:
-            product = get_object_or_404(Product, id=item['product_id'])
-            if product.stock < item['quantity']:
-                order.delete()
-                return JsonResponse({'error': f'Stock insuficiente para {product.name}'}, status=400)
-            OrderItem.objects.create(
-                order=order,
-                product=product,
-                quantity=item['quantity'],
-                price=item['price']
+            product_id, quantity = int(item['product_id']), int(item['quantity'])
+            if quantity <= 0:
+                return JsonResponse({'error': 'Cantidad inválida'}, status=400)
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        products = Product.objects.in_bulk(quantities.keys())
+        if len(products) != len(quantities):
+            return JsonResponse({'error': 'Producto no encontrado'}, status=404)
+
+        # Orden, ítems y reserva de stock en una transacción: si falta stock no queda nada
+        with transaction.atomic():
+            order = Order.objects.create(
+                user=request.user,
+                delivery_method=delivery_method,
+                shipping_address=shipping_address,
+                status='pending'
             )
-
-        # Crear la sesión de Stripe Checkout
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=products[pk], quantity=quantity, price=products[pk].get_final_price())
+                for pk, quantity in quantities.items()
+            ])
+            finalize_totals(order)
+            reserve_order(order, quantities.items())
+
+        # Crear la sesión de Stripe Checkout; vence junto con la reserva
         line_items = [{
             'price_data': {
                 'currency': 'clp',
                 'product_data': {
-                    'name': item['name'],
+                    'name': products[pk].name,
                 },
-                'unit_amount': int(item['price'] * 100),
+                'unit_amount': int(products[pk].get_final_price() * 100),
             },
-            'quantity': item['quantity'],
-        } for item in cart_items]
-
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=line_items,
-            mode='payment',
-            success_url=request.build_absolute_uri('/order/confirmation/') + f'{order.id}/',
-            cancel_url=request.build_absolute_uri('/customer/checkout/'),
-            metadata={'order_id': order.id},
-            customer_email=request.user.email,
-            shipping_address_collection={'allowed_countries': ['CL']},
-        )
+            'quantity': quantity,
+        } for pk, quantity in quantities.items()]
+
+        try:
+            session = get_gateway().create_checkout_session({
+                'payment_method_types': ['card'],
+                'line_items': line_items,
+                'mode': 'payment',
+                'success_url': request.build_absolute_uri('/order/confirmation/') + f'{order.id}/',
+                'cancel_url': request.build_absolute_uri('/customer/checkout/'),
+                'metadata': {'order_id': order.id},
+                'customer_email': request.user.email,
+                'shipping_address_collection': {'allowed_countries': ['CL']},
+                'expires_at': int((timezone.now() + reservation_ttl()).timestamp()),
+            }, idempotency_key=f'checkout-session-{order.id}')
+        except stripe.error.StripeError:
+            release_order(order)
+            order.delete()
+            raise
 
         return JsonResponse({'sessionId': session.id})
+    except PaymentUnavailable as e:
+        logger.warning(f"Checkout sin pasarela: {e}")
+        return JsonResponse({'error': 'El servicio de pagos no está disponible, intenta nuevamente en unos minutos.'}, status=503)
+    except ReservationError as e:
+        logger.warning(f"Reserva rechazada: {e}")
+        return JsonResponse({'error': str(e), 'products': e.products}, status=409)
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({'error': 'Ítems del carrito inválidos'}, status=400)
     except Exception as e:
         logger.error(f"Error al crear sesión de checkout: {str(e)}")
         return JsonResponse({'error': str(e)}, status=400)
@@ -565,9 +618,10 @@ def admin_user_management(request):
             user_form = UserForm()
             employee_form = EmployeeForm()
     
-    users = User.objects.all()
+    users = UserTable(request, staff_users())
     return render(request, 'admin/user_management.html', {
         'users': users,
+        'table': users,
         'user_form': user_form,
         'employee_form': employee_form,
         'editing': editing,
@@ -732,9 +786,26 @@ def admin_refund_management(request):
             messages.success(request, 'Reembolso eliminado exitosamente.')
         return redirect('admin_refund_management')
     
-    refunds = Refund.objects.all()
+    refunds = staff_refunds()
     return render(request, 'admin/refund_management.html', {'refunds': refunds})
 
+def _apply_order_transition(request, action):
+    # Aplica la acción a todas las órdenes marcadas (una o varias) y resume el resultado
+    if action not in allowed_actions(request.user):
+        messages.error(request, 'Acción no permitida para tu rol.')
+        return
+    try:
+        result = transition(request.POST.getlist('order_id'), action)
+    except TransitionError as e:
+        messages.error(request, str(e))
+        return
+    if result.updated:
+        messages.success(request, f'{len(result.updated)} orden(es) pasaron a "{STATUS_LABELS[TRANSITIONS[action][1]]}".')
+    for pk, reason in list(result.failed.items())[:10]:
+        messages.warning(request, f'{result.ref_codes.get(pk) or pk}: {reason}')
+    if len(result.failed) > 10:
+        messages.warning(request, f'Y {len(result.failed) - 10} orden(es) más sin procesar.')
+
 @login_required
 def seller_orders(request):
     if not hasattr(request.user, 'employee') or request.user.employee.role != 'seller':
@@ -742,17 +813,11 @@ def seller_orders(request):
         return redirect('index')
     
     if request.method == 'POST':
-        order_id = request.POST.get('order_id')
-        action = request.POST.get('action')
-        order = get_object_or_404(Order, id=order_id)
-        if action == 'approve':
-            order.status = 'approved'
-            order.save()
-            messages.success(request, 'Pedido aprobado.')
+        _apply_order_transition(request, request.POST.get('action', 'approve'))
         return redirect('seller_orders')
     
-    orders = Order.objects.all()
-    return render(request, 'seller/orders.html', {'orders': orders})
+    orders = OrderTable(request, staff_orders())
+    return render(request, 'seller/orders.html', {'orders': orders, 'table': orders})
 
 @login_required
 def seller_products(request):
@@ -774,14 +839,27 @@ def seller_products(request):
             product_id = request.POST.get('product_id')
             if product_id:
                 product_to_edit = get_object_or_404(Product, id=product_id)
+                loaded_stock = product_to_edit.stock
                 form = ProductForm(request.POST, request.FILES, instance=product_to_edit)
                 editing = True
             else:
                 form = ProductForm(request.POST, request.FILES)
             if form.is_valid():
-                product = form.save()
-                messages.success(request, f'Producto {"actualizado" if product_id else "creado"} exitosamente.')
-                return redirect('seller_products')
+                if not product_id:
+                    product = form.save()
+                    messages.success(request, 'Producto creado exitosamente.')
+                    return redirect('seller_products')
+                # El stock se ajusta con un UPDATE relativo: guardar el valor leído
+                # pisaría las ventas y reservas ocurridas mientras se editaba
+                try:
+                    with transaction.atomic():
+                        adjust_stock(product_to_edit.pk, form.cleaned_data['stock'] - loaded_stock)
+                        product = form.save(commit=False)
+                        product.save(update_fields=[name for name in ProductForm.Meta.fields if name != 'stock'] + ['updated_at'])
+                    messages.success(request, 'Producto actualizado exitosamente.')
+                    return redirect('seller_products')
+                except OutOfStock:
+                    form.add_error('stock', 'El stock no puede quedar por debajo de las unidades reservadas.')
     else:
         edit_id = request.GET.get('edit')
         if edit_id:
@@ -806,17 +884,11 @@ def warehouse_orders(request):
         return redirect('index')
     
     if request.method == 'POST':
-        action = request.POST.get('action')
-        order_id = request.POST.get('order_id')
-        order = get_object_or_404(Order, id=order_id)
-        if action == 'prepare' and order.status == 'approved':
-            order.status = 'prepared'
-            order.save()
-            messages.success(request, 'Orden preparada exitosamente.')
+        _apply_order_transition(request, request.POST.get('action'))
         return redirect('warehouse_orders')
     
-    orders = Order.objects.filter(status__in=['approved', 'prepared'])
-    return render(request, 'warehouse/orders.html', {'orders': orders})
+    orders = WarehouseOrderTable(request, staff_orders(['approved', 'prepared']))
+    return render(request, 'warehouse/orders.html', {'orders': orders, 'table': orders})
 
 @login_required
 def warehouse_order_detail(request, order_id):
@@ -824,9 +896,39 @@ def warehouse_order_detail(request, order_id):
         messages.error(request, 'Acceso denegado.')
         return redirect('index')
     
-    order = get_object_or_404(Order, id=order_id)
+    order = get_object_or_404(order_with_items(), id=order_id)
     return render(request, 'warehouse/order_detail.html', {'order': order})
 
+def _pick_list_order_ids(request):
+    # Lote elegido en la lista de órdenes (?order_id=1&order_id=2); vacío = todas las aprobadas
+    return [int(pk) for pk in request.GET.getlist('order_id') if pk.isdigit()]
+
+@login_required
+def warehouse_pick_list(request):
+    if not hasattr(request.user, 'employee') or request.user.employee.role != 'warehouse':
+        messages.error(request, 'Acceso denegado.')
+        return redirect('index')
+    
+    order_ids = _pick_list_order_ids(request)
+    rows = list(iter_pick_list(order_ids))
+    return render(request, 'warehouse/pick_list.html', {
+        'rows': rows,
+        'order_ids': order_ids,
+        'total_units': sum(row['units'] for row in rows),
+        'shortages': sum(1 for row in rows if row['shortage']),
+        'csv_query': urlencode({'order_id': order_ids}, doseq=True),
+    })
+
+@login_required
+def warehouse_pick_list_csv(request):
+    if not hasattr(request.user, 'employee') or request.user.employee.role != 'warehouse':
+        messages.error(request, 'Acceso denegado.')
+        return redirect('index')
+    
+    response = StreamingHttpResponse(pick_list_csv_rows(_pick_list_order_ids(request)), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="picking-{timezone.localdate():%Y%m%d}.csv"'
+    return response
+
 @login_required
 def warehouse_inventory(request):
     if not hasattr(request.user, 'employee') or request.user.employee.role != 'warehouse':
@@ -840,15 +942,23 @@ def warehouse_inventory(request):
             stock = int(request.POST.get('stock', '0'))
             product = get_object_or_404(Product, id=product_id)
             if stock >= 0:
-                product.stock = stock
-                product.save()
-                messages.success(request, f'Stock actualizado para {product.name}.')
+                # Relativo al valor leído, sin pisar ventas ni reservas concurrentes
+                try:
+                    adjust_stock(product.pk, stock - product.stock)
+                    messages.success(request, f'Stock actualizado para {product.name}.')
+                except OutOfStock:
+                    messages.error(request, f'El stock de {product.name} no puede quedar por debajo de las unidades reservadas.')
             else:
                 messages.error(request, 'El stock debe ser mayor o igual a cero.')
             return redirect('warehouse_inventory')
     
-    products = Product.objects.all()
-    return render(request, 'warehouse/inventory.html', {'products': products})
+    products = ProductTable(request, Product.objects.select_related('category', 'brand'))
+    return render(request, 'warehouse/inventory.html', {
+        'products': products,
+        'table': products,
+        'categories': Category.objects.order_by('name'),
+        'brands': Brand.objects.order_by('name'),
+    })
 
 @login_required
 def accountant_payments(request):
@@ -867,8 +977,8 @@ def accountant_payments(request):
             messages.success(request, 'Pago confirmado exitosamente.')
         return redirect('accountant_payments')
     
-    payments = Payment.objects.all()
-    return render(request, 'accountant/payments.html', {'payments': payments})
+    payments = PaymentTable(request, staff_payments())
+    return render(request, 'accountant/payments.html', {'payments': payments, 'table': payments})
 
 @csrf_exempt
 def create_payment_intent(request):
@@ -880,18 +990,19 @@ def create_payment_intent(request):
         user = order.user
 
         user_profile, created = UserProfile.objects.get_or_create(user=user)
+        gateway = get_gateway()
         if not user_profile.stripe_customer_id:
-            customer = stripe.Customer.create(email=user.email)
+            customer = gateway.create_customer({'email': user.email}, idempotency_key=f'customer-{user.id}')
             user_profile.stripe_customer_id = customer['id']
             user_profile.save()
 
-        intent = stripe.PaymentIntent.create(
-            amount=int(amount),
-            currency='clp',
-            payment_method_types=['card'],
-            customer=user_profile.stripe_customer_id,
-            metadata={'order_id': order_id},
-        )
+        intent = gateway.create_payment_intent({
+            'amount': int(amount),
+            'currency': 'clp',
+            'payment_method_types': ['card'],
+            'customer': user_profile.stripe_customer_id,
+            'metadata': {'order_id': order_id},
+        }, idempotency_key=f'payment-intent-{order.id}-{int(amount)}')
 
         payment = Payment.objects.create(
             order=order,
@@ -906,114 +1017,19 @@ def create_payment_intent(request):
         })
     except Order.DoesNotExist:
         return JsonResponse({'error': 'Orden no encontrada'}, status=404)
+    except PaymentUnavailable as e:
+        logger.warning(f"Payment intent sin pasarela: {e}")
+        return JsonResponse({'error': 'El servicio de pagos no está disponible, intenta nuevamente en unos minutos.'}, status=503)
     except Exception as e:
         logger.error(f"Error creating payment intent: {str(e)}")
         return JsonResponse({'error': str(e)}, status=400)
 
 @csrf_exempt
 def stripe_webhook(request):
-    payload = request.body
-    sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
-    endpoint_secret = settings.STRIPE_WEBHOOK_SECRET
-
+    # Sólo verifica y encola el evento; core.webhooks lo procesa en segundo plano
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, endpoint_secret
-        )
-    except stripe.error.SignatureVerificationError:
-        logger.error("Invalid webhook signature")
-        return JsonResponse({'status': 'invalid signature'}, status=400)
-    except stripe.error.StripeError as e:
-        logger.error(f"Stripe error: {str(e)}")
-        return JsonResponse({'status': 'stripe error', 'error': str(e)}, status=400)
-
-    if event['type'] == 'payment_intent.succeeded':
-        payment_intent = event['data']['object']
-        order_id = payment_intent.get('metadata', {}).get('order_id')
-        try:
-            payment = Payment.objects.get(stripe_payment_intent_id=payment_intent.id)
-            payment.confirmed = True
-            payment.confirmed_by = None
-            payment.save()
-            order = payment.order
-            order.status = 'paid'
-            order.save()
-
-            # Reducir stock
-            for item in order.items.all():
-                product = item.product
-                if product.stock >= item.quantity:
-                    product.stock -= item.quantity
-                    product.save()
-                    logger.debug(f"Stock reducido para {product.name}: -{item.quantity}, Nuevo stock: {product.stock}")
-                else:
-                    logger.error(f"Stock insuficiente para {product.name} en orden {order_id}")
-                    order.status = 'error'
-                    order.save()
-                    return JsonResponse({'status': 'insufficient stock'}, status=400)
-
-            # Limpiar carrito
-            cart = Cart.objects.get(user=order.user)
-            cart.items.all().delete()
-            logger.info(f"Carrito limpiado para usuario {order.user.username}")
-
-            return JsonResponse({'status': 'payment confirmed'})
-        except Payment.DoesNotExist:
-            logger.error(f"Pago no encontrado: ID {payment_intent.id}")
-            return JsonResponse({'status': 'payment not found'}, status=404)
-        except Order.DoesNotExist:
-            logger.error(f"Orden no encontrada: {order_id}")
-            return JsonResponse({'status': 'order not found'}, status=404)
-    elif event['type'] == 'payment_intent.payment_failed':
-        payment_intent = event['data']['object']
-        try:
-            payment = Payment.objects.get(stripe_payment_intent_id=payment_intent.id)
-            payment.confirmed = False
-            payment.save()
-            logger.info(f"Pago fallido: ID {payment_intent.id}")
-            return JsonResponse({'status': 'payment failed'})
-        except Payment.DoesNotExist:
-            logger.error(f"Pago no encontrado: ID {payment_intent.id}")
-            return JsonResponse({'status': 'payment not found'}, status=404)
-    elif event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        order_id = session.get('metadata', {}).get('order_id')
-        try:
-            order = Order.objects.get(id=order_id)
-            payment = Payment.objects.create(
-                order=order,
-                amount=order.get_total(),
-                method='credit',
-                stripe_payment_intent_id=session.payment_intent,
-                confirmed=True
-            )
-            order.status = 'processing'
-            order.save()
-
-            # Reducir stock
-            for item in order.items.all():
-                product = item.product
-                if product.stock >= item.quantity:
-                    product.stock -= item.quantity
-                    product.save()
-                    logger.debug(f"Stock reducido para {product.name}: -{item.quantity}, Nuevo stock: {product.stock}")
-                else:
-                    logger.error(f"Stock insuficiente para {product.name} en orden {order_id}")
-                    order.status = 'error'
-                    order.save()
-                    return JsonResponse({'status': 'insufficient stock'}, status=400)
-
-            # Limpiar carrito
-            cart = Cart.objects.get(user=order.user)
-            cart.items.all().delete()
-            logger.info(f"Carrito limpiado para: {order.user.username}")
-
-            return JsonResponse({'status': 'payment processed'})
-        except Order.DoesNotExist:
-            logger.error(f"Orden no encontrada: {order_id}")
-            return JsonResponse({'status': 'order not found'}, status=404)
-        except Exception as e:
-            logger.error(f"Error procesando webhook: {str(e)}")
-            return JsonResponse({'error': str(e)}, status=400)
-
-    return JsonResponse({'status': 'event handled'})
\ No newline at end of file
+        event, created = receive(request.body, request.META.get('HTTP_STRIPE_SIGNATURE'))
+    except InvalidWebhook as e:
+        logger.error(f"Webhook rechazado: {e}")
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'status': 'queued' if created else 'duplicate', 'event': event.event_id})
\ No newline at end of file
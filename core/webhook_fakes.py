@@ -0,0 +1,55 @@
+# Generador local de eventos de Stripe firmados, para pruebas y desarrollo sin
+# conexión a Stripe. Produce el cuerpo y la cabecera Stripe-Signature que
+# stripe.Webhook.construct_event acepta con el mismo secreto de webhook.
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+from django.conf import settings
+
+
+class FakeStripeEvents:
+    def __init__(self, secret=None):
+        self.secret = secret if secret is not None else settings.STRIPE_WEBHOOK_SECRET
+
+    def event(self, event_type, obj, event_id=None):
+        return {
+            'id': event_id or f'evt_{uuid.uuid4().hex[:24]}',
+            'object': 'event',
+            'type': event_type,
+            'created': int(time.time()),
+            'livemode': False,
+            'data': {'object': obj},
+        }
+
+    def checkout_completed(self, order, payment_intent_id=None, **kwargs):
+        return self.event('checkout.session.completed', {
+            'id': f'cs_test_{uuid.uuid4().hex[:24]}',
+            'object': 'checkout.session',
+            'payment_intent': payment_intent_id or f'pi_{uuid.uuid4().hex[:24]}',
+            'payment_status': 'paid',
+            'metadata': {'order_id': str(order.pk)},
+        }, **kwargs)
+
+    def checkout_expired(self, order, **kwargs):
+        return self.event('checkout.session.expired', {
+            'id': f'cs_test_{uuid.uuid4().hex[:24]}',
+            'object': 'checkout.session',
+            'metadata': {'order_id': str(order.pk)},
+        }, **kwargs)
+
+    def payment_intent(self, event_type, payment_intent_id, order=None, **kwargs):
+        metadata = {'order_id': str(order.pk)} if order is not None else {}
+        return self.event(event_type, {'id': payment_intent_id, 'object': 'payment_intent', 'metadata': metadata}, **kwargs)
+
+    def sign(self, event, timestamp=None):
+        payload = json.dumps(event)
+        timestamp = timestamp or int(time.time())
+        signature = hmac.new(self.secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        return payload, f't={timestamp},v1={signature}'
+
+    def post(self, client, event, path='/api/webhook/'):
+        payload, header = self.sign(event)
+        return client.post(path, payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=header)
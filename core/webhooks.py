@@ -0,0 +1,227 @@
+# Cola de eventos del webhook de Stripe.
+# La vista sólo verifica la firma, guarda el evento (el id de Stripe es único, así
+# que un reintento de Stripe no lo duplica) y responde 200 de inmediato. Un pool de
+# hilos local procesa luego los eventos pendientes, cada uno en su transacción, con
+# reintentos espaciados y sin adelantar un evento de una orden mientras otro
+# anterior de la misma orden siga sin terminar. El comando process_webhook_events
+# recoge los reintentos programados y lo que quede pendiente tras un reinicio.
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from . import cart_service
+from .models import Cart, Order, Payment, WebhookEvent
+from .reservations import ReservationError, convert_order, release_order
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 30  # Segundos antes del primer reintento; se duplica en cada intento
+PROCESSING_LEASE = timedelta(minutes=5)  # Un evento "procesando" más tiempo se da por abandonado
+CLAIM_BATCH_SIZE = 20
+UNFINISHED = ('pending', 'processing')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class InvalidWebhook(Exception):
+    pass
+
+
+class PermanentError(Exception):
+    # Un reintento no lo va a resolver: el evento queda como fallido para revisión
+    pass
+
+
+def _config():
+    return {
+        'WORKERS': DEFAULT_WORKERS,
+        'ASYNC': True,
+        'MAX_ATTEMPTS': DEFAULT_MAX_ATTEMPTS,
+        'RETRY_DELAY': DEFAULT_RETRY_DELAY,
+        **getattr(settings, 'WEBHOOK_QUEUE', {}),
+    }
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_config()['WORKERS'], thread_name_prefix='webhooks')
+        return _executor
+
+
+def event_order_id(data):
+    metadata = (data.get('data') or {}).get('object', {}).get('metadata') or {}
+    try:
+        return int(metadata.get('order_id'))
+    except (TypeError, ValueError):
+        return None
+
+
+def receive(payload, sig_header):
+    # Verifica y encola; devuelve (evento, creado). Un id repetido no se vuelve a encolar
+    try:
+        stripe.Webhook.construct_event(payload, sig_header, settings.STRIPE_WEBHOOK_SECRET)
+    except ValueError:
+        raise InvalidWebhook('Payload inválido')
+    except stripe.error.SignatureVerificationError:
+        raise InvalidWebhook('Firma inválida')
+    data = json.loads(payload)
+    event, created = WebhookEvent.objects.get_or_create(
+        event_id=data['id'],
+        defaults={'type': data['type'], 'payload': data, 'order_id': event_order_id(data)},
+    )
+    if created:
+        transaction.on_commit(dispatch)
+    return event, created
+
+
+# Manejadores por tipo de evento. Corren dentro de una transacción: si fallan no
+# queda nada a medias y el evento se reintenta.
+
+def _pay_order(order, payment_intent_id):
+    # Confirmar el pago descuenta el stock una sola vez aunque el mismo pago llegue
+    # como checkout.session.completed y como payment_intent.succeeded. El estado de la
+    # orden no cambia: sigue en la cola de aprobación del vendedor
+    payment, _ = Payment.objects.get_or_create(order=order, defaults={'amount': order.total, 'method': 'credit'})
+    confirmed = Payment.objects.filter(pk=payment.pk, confirmed=False).update(
+        confirmed=True, confirmed_by=None, stripe_payment_intent_id=payment_intent_id or payment.stripe_payment_intent_id,
+    )
+    if not confirmed:
+        return
+    try:
+        convert_order(order)  # Las reservas del checkout pasan a descuento de stock
+    except ReservationError as e:
+        raise PermanentError(str(e))
+    cart = Cart.objects.filter(user_id=order.user_id).first()
+    if cart:
+        cart_service.clear_cart(cart)
+
+
+def handle_checkout_completed(data):
+    session = data['data']['object']
+    order = Order.objects.filter(pk=event_order_id(data)).first()
+    if order is None:
+        raise PermanentError(f'Orden no encontrada: {event_order_id(data)}')
+    _pay_order(order, session.get('payment_intent'))
+
+
+def handle_checkout_expired(data):
+    order = Order.objects.filter(pk=event_order_id(data), status='pending').first()
+    if order is not None:
+        release_order(order)  # Devuelve las unidades retenidas
+
+
+def handle_payment_succeeded(data):
+    intent = data['data']['object']
+    payment = Payment.objects.filter(stripe_payment_intent_id=intent['id']).select_related('order').first()
+    order = payment.order if payment else Order.objects.filter(pk=event_order_id(data)).first()
+    if order is None:
+        # Puede llegar antes que checkout.session.completed: se reintenta más tarde
+        raise LookupError(f'Pago no encontrado: {intent["id"]}')
+    _pay_order(order, intent['id'])
+
+
+def handle_payment_failed(data):
+    intent = data['data']['object']
+    payment = Payment.objects.filter(stripe_payment_intent_id=intent['id']).select_related('order').first()
+    if payment is None:
+        raise PermanentError(f'Pago no encontrado: {intent["id"]}')
+    Payment.objects.filter(pk=payment.pk).update(confirmed=False)
+    release_order(payment.order)
+
+
+HANDLERS = {
+    'checkout.session.completed': handle_checkout_completed,
+    'checkout.session.expired': handle_checkout_expired,
+    'payment_intent.succeeded': handle_payment_succeeded,
+    'payment_intent.payment_failed': handle_payment_failed,
+}
+
+
+def claim(limit=CLAIM_BATCH_SIZE, now=None):
+    # Toma eventos listos cuya orden no tenga uno anterior sin terminar. El UPDATE
+    # condicional por id evita que dos trabajadores tomen el mismo evento.
+    now = now or timezone.now()
+    WebhookEvent.objects.filter(status='processing', available_at__lte=now).update(status='pending')
+    earlier = WebhookEvent.objects.filter(order_id=OuterRef('order_id'), pk__lt=OuterRef('pk'), status__in=UNFINISHED)
+    candidates = (
+        WebhookEvent.objects.filter(status='pending', available_at__lte=now)
+        .filter(~Exists(earlier))
+        .order_by('pk')
+        .values_list('pk', flat=True)[:limit]
+    )
+    claimed = []
+    for pk in candidates:
+        if WebhookEvent.objects.filter(pk=pk, status='pending').update(
+            status='processing', attempts=F('attempts') + 1, available_at=now + PROCESSING_LEASE,
+        ):
+            claimed.append(pk)
+    return claimed
+
+
+def process_event(pk):
+    event = WebhookEvent.objects.get(pk=pk)
+    handler = HANDLERS.get(event.type)
+    now = timezone.now()
+    try:
+        if handler is not None:  # Tipos sin manejador se dan por procesados
+            with transaction.atomic():
+                handler(event.payload)
+    except PermanentError as e:
+        logger.error(f'Evento {event.event_id} fallido: {e}')
+        WebhookEvent.objects.filter(pk=pk).update(status='failed', last_error=str(e), processed_at=now)
+        return 'failed'
+    except Exception as e:
+        config = _config()
+        if event.attempts >= config['MAX_ATTEMPTS']:
+            logger.exception(f'Evento {event.event_id} fallido tras {event.attempts} intentos')
+            WebhookEvent.objects.filter(pk=pk).update(status='failed', last_error=str(e), processed_at=now)
+            return 'failed'
+        delay = timedelta(seconds=config['RETRY_DELAY'] * 2 ** (event.attempts - 1))
+        logger.warning(f'Evento {event.event_id} se reintentará en {delay}: {e}')
+        WebhookEvent.objects.filter(pk=pk).update(status='pending', last_error=str(e), available_at=now + delay)
+        return 'retry'
+    WebhookEvent.objects.filter(pk=pk).update(status='done', last_error='', processed_at=now)
+    return 'done'
+
+
+def drain(limit=None):
+    # Procesa hasta que no queden eventos listos; devuelve cuántos se procesaron
+    processed = 0
+    while limit is None or processed < limit:
+        batch = claim()
+        if not batch:
+            break
+        for pk in batch:
+            process_event(pk)
+            processed += 1
+    return processed
+
+
+def _drain_job():
+    close_old_connections()
+    try:
+        return drain()
+    except Exception:
+        logger.exception('Error procesando la cola de webhooks')
+    finally:
+        close_old_connections()
+
+
+def dispatch():
+    if _config()['ASYNC']:
+        get_executor().submit(_drain_job)
+    else:
+        drain()
@@ -64,6 +64,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'core.context_processors.cart_summary',
             ],
         },
     },
@@ -124,6 +125,65 @@ STRIPE_WEBHOOK_SECRET = ''
 
 LOGIN_URL = '/login/'
 
+# Caché de páginas del catálogo (core/page_cache.py). Para compartirla entre
+# workers usar 'core.page_cache.DjangoCacheBackend' con OPTIONS {'alias': ...}
+PAGE_CACHE = {
+    'BACKEND': 'core.page_cache.LRUBackend',
+    'OPTIONS': {'max_entries': 2000},
+    'TIMEOUT': 60 * 5,
+}
+
+# Variantes de imágenes de producto (core.image_pipeline): procesos del pool y
+# si se generan en segundo plano o dentro de la misma petición
+IMAGE_PIPELINE = {
+    'WORKERS': 2,
+    'ASYNC': True,
+}
+
+# Segundos que el checkout retiene el stock antes de que release_expired_reservations
+# lo devuelva (Stripe exige al menos 30 minutos de vigencia para la sesión de pago)
+STOCK_RESERVATION_TTL = 60 * 30
+
+# Cola del webhook de Stripe (core.webhooks): hilos que procesan los eventos, si lo
+# hacen en segundo plano, intentos máximos y segundos antes del primer reintento
+WEBHOOK_QUEUE = {
+    'WORKERS': 2,
+    'ASYNC': True,
+    'MAX_ATTEMPTS': 5,
+    'RETRY_DELAY': 30,
+}
+
+# Pasarela de pagos (core/payments.py): segundos de conexión y de lectura por
+# operación, conexiones keep-alive del pool, reintentos con espera exponencial y
+# fallas seguidas que abren el circuito (y segundos que permanece abierto)
+PAYMENT_GATEWAY = {
+    'CONNECT_TIMEOUT': 3,
+    'TIMEOUTS': {'customer': 5, 'payment_intent': 10, 'checkout_session': 10},
+    'POOL_SIZE': 10,
+    'MAX_RETRIES': 2,
+    'BACKOFF': 0.25,
+    'MAX_BACKOFF': 2,
+    'BREAKER_THRESHOLD': 5,
+    'BREAKER_RESET': 30,
+}
+
+# Tasas de cambio de convert_currency (core/exchange_rates.py): API (alternativa del
+# Banco Central de Chile: https://api.sbif.cl/api-sbifv3/recursos_api/dolar), segundos
+# de vigencia de la tabla, cuánto se sigue usando vencida si la API falla y tiempos
+# límite. El comando refresh_exchange_rates la renueva desde cron.
+EXCHANGE_RATES = {
+    'URL': 'https://api.exchangerate-api.com/v4/latest/CLP',
+    'BASE': 'CLP',
+    'TTL': 60 * 60,
+    'MAX_STALE': 60 * 60 * 24,
+    'CONNECT_TIMEOUT': 3,
+    'TIMEOUT': 5,
+    'ASYNC': True,
+}
+
+# Valores que cada proceso reserva de una vez para los códigos FER-/ORD- (core/sequences.py)
+SEQUENCE_BLOCK_SIZE = 50
+
 # Logging configuration
 LOGGING = {
     'version': 1,